@@ -0,0 +1,589 @@
+import functools
+
+from flask import Blueprint, current_app, jsonify, request, session, url_for
+
+from cache import invalidate_profile
+from database import get_db, get_read_db, bump_notes_version, note_search_vector_sql, NOTE_EXCERPT_LENGTH, PoolTimeout
+from pagination import fetch_page
+from passwords import authenticate, HashingBusy
+from jobs import enqueue
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Selectable fields per resource, mapped to the SQL producing them. Each
+# listing always reads its keyset columns, whatever fields were asked for.
+NOTE_FIELDS = {
+    'id': 'id',
+    'user_id': 'user_id',
+    'title': 'title',
+    'content': 'content',
+    'excerpt': 'excerpt',
+    'content_length': 'content_length',
+    'is_public': 'is_public',
+    'created_at': 'created_at',
+    'updated_at': 'updated_at',
+    'version': 'version',
+    'attachments': None,  # fetched with one extra query per page
+}
+NOTE_LIST_FIELDS = ['id', 'title', 'excerpt', 'content_length', 'is_public', 'created_at', 'updated_at']
+NOTE_DETAIL_FIELDS = list(NOTE_FIELDS)
+
+USER_FIELDS = {
+    'id': 'id',
+    'username': 'username',
+    'description': 'description',
+    'avatar': 'avatar',
+    'created_at': 'created_at',
+}
+
+ATTACHMENT_FIELDS = ['id', 'note_id', 'original_filename', 'file_size', 'checksum', 'uploaded_at', 'download_url']
+
+
+class ApiError(Exception):
+    """Turned into a JSON {"error": message} response with the given status"""
+    
+    def __init__(self, status, message, details=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.details = details
+
+
+@api.errorhandler(ApiError)
+def api_error(error):
+    """Render an ApiError as JSON"""
+    body = {'error': error.message}
+    if error.details is not None:
+        body['details'] = error.details
+    return jsonify(body), error.status
+
+
+@api.errorhandler(PoolTimeout)
+@api.errorhandler(HashingBusy)
+def api_busy(error):
+    """No pooled connection or hashing worker became free in time"""
+    return jsonify({'error': 'Server busy, retry shortly'}), 503
+
+
+def api_login_required(view):
+    """Like login_required, but answers 401 instead of redirecting to the login page"""
+    @functools.wraps(view)
+    def wrapped_view(**kwargs):
+        if 'user_id' not in session:
+            raise ApiError(401, 'Authentication required')
+        return view(**kwargs)
+    return wrapped_view
+
+
+def json_body():
+    """The request's JSON object; anything else is a 400"""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise ApiError(400, 'Expected a JSON object body')
+    return body
+
+
+def requested_fields(allowed, default):
+    """Fields named in ?fields=a,b,c, checked against the allowed ones"""
+    raw = request.args.get('fields')
+    if not raw:
+        return list(default)
+    fields = [field.strip() for field in raw.split(',') if field.strip()]
+    unknown = sorted(set(fields) - set(allowed))
+    if unknown:
+        raise ApiError(400, f'Unknown fields: {", ".join(unknown)}')
+    return fields
+
+
+def select_list(columns, fields, always=()):
+    """SQL select list for the requested fields plus the columns paging needs"""
+    names = list(dict.fromkeys(list(always) + [f for f in fields if columns.get(f)]))
+    return ', '.join(f'{columns[name]} AS {name}' for name in names)
+
+
+def page_limit():
+    """?limit=, defaulting to NOTES_PAGE_SIZE and capped at API_MAX_PAGE_SIZE"""
+    try:
+        limit = int(request.args.get('limit', current_app.config['NOTES_PAGE_SIZE']))
+    except ValueError:
+        raise ApiError(400, 'limit must be an integer')
+    return max(1, min(limit, current_app.config['API_MAX_PAGE_SIZE']))
+
+
+def serialize(row, fields):
+    """Project a row onto the requested fields, with timestamps in ISO 8601"""
+    item = {}
+    for field in fields:
+        value = row.get(field)
+        item[field] = value.isoformat() if hasattr(value, 'isoformat') else value
+    return item
+
+
+def page_response(page, fields):
+    """JSON body for one page of a keyset-paginated listing"""
+    return jsonify({
+        'data': [serialize(row, fields) for row in page.items],
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor,
+    })
+
+
+def attach_attachments(cur, notes):
+    """Add each note's attachment metadata, for all notes in one query"""
+    by_note = {note['id']: note for note in notes}
+    for note in notes:
+        note['attachments'] = []
+    if not by_note:
+        return
+    cur.execute(
+        'SELECT id, note_id, original_filename, file_size, checksum, uploaded_at FROM attachments '
+        'WHERE note_id = ANY(%s) ORDER BY uploaded_at, id',
+        (list(by_note),)
+    )
+    for attachment in cur.fetchall():
+        attachment['download_url'] = url_for('download_attachment', attachment_id=attachment['id'])
+        by_note[attachment['note_id']]['attachments'].append(serialize(attachment, ATTACHMENT_FIELDS))
+
+
+# Session
+
+@api.route('/session', methods=['POST'])
+def create_session():
+    """Log in with {"username", "password"}; later requests authenticate with the session cookie"""
+    body = json_body()
+    username = str(body.get('username') or '').strip()
+    password = str(body.get('password') or '')
+    if not username or not password:
+        raise ApiError(400, 'username and password are required')
+    user = authenticate(get_db(), username, password)
+    if not user:
+        raise ApiError(401, 'Invalid username or password')
+    session['user_id'] = user['id']
+    session['username'] = user['username']
+    return jsonify(user)
+
+
+@api.route('/session', methods=['DELETE'])
+def delete_session():
+    """Log out"""
+    session.clear()
+    return '', 204
+
+
+# Users
+
+@api.route('/users')
+@api_login_required
+def list_users():
+    """All users, newest account first"""
+    fields = requested_fields(USER_FIELDS, USER_FIELDS)
+    cur = get_read_db().cursor()
+    page = fetch_page(
+        cur,
+        f'SELECT {select_list(USER_FIELDS, fields, always=("id", "created_at"))} FROM users WHERE TRUE',
+        (),
+        'created_at',
+        page_limit(),
+        after=request.args.get('after'),
+        before=request.args.get('before')
+    )
+    cur.close()
+    return page_response(page, fields)
+
+
+@api.route('/users/<int:user_id>')
+@api_login_required
+def get_user(user_id):
+    """One user's public profile"""
+    fields = requested_fields(USER_FIELDS, USER_FIELDS)
+    cur = get_read_db().cursor()
+    cur.execute(f'SELECT {select_list(USER_FIELDS, fields, always=("id",))} FROM users WHERE id = %s', (user_id,))
+    user = cur.fetchone()
+    cur.close()
+    if not user:
+        raise ApiError(404, 'User not found')
+    return jsonify(serialize(user, fields))
+
+
+@api.route('/users/<int:user_id>/notes')
+@api_login_required
+def list_user_public_notes(user_id):
+    """A user's public notes, newest first"""
+    fields = requested_fields(NOTE_FIELDS, NOTE_LIST_FIELDS)
+    cur = get_read_db().cursor()
+    page = fetch_page(
+        cur,
+        f'SELECT {select_list(NOTE_FIELDS, fields, always=("id", "created_at"))} FROM notes '
+        'WHERE user_id = %s AND is_public = TRUE',
+        (user_id,),
+        'created_at',
+        page_limit(),
+        after=request.args.get('after'),
+        before=request.args.get('before')
+    )
+    if 'attachments' in fields:
+        attach_attachments(cur, page.items)
+    cur.close()
+    return page_response(page, fields)
+
+
+# Notes
+
+@api.route('/notes')
+@api_login_required
+def list_notes():
+    """The current user's notes, most recently updated first"""
+    fields = requested_fields(NOTE_FIELDS, NOTE_LIST_FIELDS)
+    cur = get_read_db().cursor()
+    page = fetch_page(
+        cur,
+        f'SELECT {select_list(NOTE_FIELDS, fields, always=("id", "updated_at"))} FROM notes WHERE user_id = %s',
+        (session['user_id'],),
+        'updated_at',
+        page_limit(),
+        after=request.args.get('after'),
+        before=request.args.get('before')
+    )
+    if 'attachments' in fields:
+        attach_attachments(cur, page.items)
+    cur.close()
+    return page_response(page, fields)
+
+
+@api.route('/notes/<int:note_id>')
+@api_login_required
+def get_note(note_id):
+    """One of the current user's notes, or another user's public note"""
+    fields = requested_fields(NOTE_FIELDS, NOTE_DETAIL_FIELDS)
+    cur = get_read_db().cursor()
+    cur.execute(
+        f'SELECT {select_list(NOTE_FIELDS, fields, always=("id", "user_id", "is_public"))} FROM notes WHERE id = %s',
+        (note_id,)
+    )
+    note = cur.fetchone()
+    if not note or (note['user_id'] != session['user_id'] and not note['is_public']):
+        cur.close()
+        raise ApiError(404, 'Note not found')
+    if 'attachments' in fields:
+        attach_attachments(cur, [note])
+    cur.close()
+    return jsonify(serialize(note, fields))
+
+
+@api.route('/notes/<int:note_id>/attachments')
+@api_login_required
+def list_note_attachments(note_id):
+    """Metadata of a note's attachments"""
+    cur = get_read_db().cursor()
+    cur.execute('SELECT id, user_id, is_public FROM notes WHERE id = %s', (note_id,))
+    note = cur.fetchone()
+    if not note or (note['user_id'] != session['user_id'] and not note['is_public']):
+        cur.close()
+        raise ApiError(404, 'Note not found')
+    attach_attachments(cur, [note])
+    cur.close()
+    return jsonify({'data': note['attachments']})
+
+
+def bulk_items(body, key):
+    """The list under body[key], bounded by API_BULK_LIMIT"""
+    items = body.get(key)
+    if not isinstance(items, list) or not items:
+        raise ApiError(400, f'Expected a non-empty "{key}" list')
+    if len(items) > current_app.config['API_BULK_LIMIT']:
+        raise ApiError(413, f'At most {current_app.config["API_BULK_LIMIT"]} items per request')
+    return items
+
+
+def clean_note(item, partial):
+    """Validate one note from a bulk request, returning (title, content, is_public, errors)
+    
+    For updates (partial) a missing field is returned as None and left unchanged.
+    """
+    errors = []
+    if not isinstance(item, dict):
+        return None, None, None, ['must be an object']
+    title = item.get('title')
+    if title is None and partial:
+        pass
+    elif not isinstance(title, str) or not title.strip():
+        errors.append('title is required')
+    elif len(title.strip()) > 200:
+        errors.append('title must be 200 characters or less')
+    else:
+        title = title.strip()
+    content = item.get('content', None if partial else '')
+    if content is not None:
+        if isinstance(content, str):
+            content = content.strip()
+        else:
+            errors.append('content must be a string')
+    is_public = item.get('is_public', None if partial else False)
+    if is_public is not None and not isinstance(is_public, bool):
+        errors.append('is_public must be a boolean')
+    return title, content, is_public, errors
+
+
+def raise_item_errors(errors):
+    """Reject a bulk request if any item failed validation"""
+    if errors:
+        raise ApiError(400, 'Invalid notes', details=[{'index': i, 'errors': e} for i, e in errors])
+
+
+@api.route('/notes', methods=['POST'])
+@api_login_required
+def create_notes():
+    """Create {"notes": [{title, content, is_public}, ...]} in one statement and one transaction"""
+    items = bulk_items(json_body(), 'notes')
+    titles, contents, publics, errors = [], [], [], []
+    for index, item in enumerate(items):
+        title, content, is_public, item_errors = clean_note(item, partial=False)
+        if item_errors:
+            errors.append((index, item_errors))
+        titles.append(title)
+        contents.append(content)
+        publics.append(is_public)
+    raise_item_errors(errors)
+    
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            f'''
+            INSERT INTO notes (user_id, title, content, excerpt, content_length, is_public, search_vector)
+            SELECT %s, v.title, v.content, LEFT(v.content, %s), CHAR_LENGTH(v.content), v.is_public,
+                {note_search_vector_sql('v.title', 'v.content')}
+            FROM unnest(%s::varchar[], %s::text[], %s::boolean[]) WITH ORDINALITY AS v(title, content, is_public, position)
+            ORDER BY v.position
+            RETURNING id, created_at, updated_at
+            ''',
+            (session['user_id'], NOTE_EXCERPT_LENGTH, titles, contents, publics)
+        )
+        created = cur.fetchall()
+        bump_notes_version(cur, session['user_id'])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    if any(publics):
+        invalidate_profile(session['user_id'])
+    # INSERT ... SELECT ... ORDER BY assigns serial ids in input order
+    created.sort(key=lambda row: row['id'])
+    return jsonify({'data': [serialize(row, ['id', 'created_at', 'updated_at']) for row in created]}), 201
+
+
+@api.route('/notes', methods=['PATCH'])
+@api_login_required
+def update_notes():
+    """Update {"notes": [{id, title?, content?, is_public?}, ...]}; all of them or none"""
+    items = bulk_items(json_body(), 'notes')
+    ids, titles, contents, publics, errors = [], [], [], [], []
+    for index, item in enumerate(items):
+        title, content, is_public, item_errors = clean_note(item, partial=True)
+        note_id = item.get('id') if isinstance(item, dict) else None
+        if not isinstance(note_id, int) or isinstance(note_id, bool):
+            item_errors.append('id must be an integer')
+        elif note_id in ids:
+            item_errors.append('duplicate id')
+        if item_errors:
+            errors.append((index, item_errors))
+        ids.append(note_id)
+        titles.append(title)
+        contents.append(content)
+        publics.append(is_public)
+    raise_item_errors(errors)
+    
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        # Joining the old row in returns its visibility before the update
+        new_title = 'COALESCE(v.title, n.title)'
+        new_content = "COALESCE(v.content, n.content, '')"
+        cur.execute(
+            f'''
+            UPDATE notes n SET
+                title = {new_title},
+                content = {new_content},
+                excerpt = LEFT({new_content}, %s),
+                content_length = CHAR_LENGTH({new_content}),
+                is_public = COALESCE(v.is_public, n.is_public),
+                search_vector = {note_search_vector_sql(new_title, new_content)},
+                version = n.version + 1,
+                updated_at = CURRENT_TIMESTAMP
+            FROM unnest(%s::integer[], %s::varchar[], %s::text[], %s::boolean[]) AS v(id, title, content, is_public),
+                notes old
+            WHERE n.id = v.id AND old.id = n.id AND n.user_id = %s
+            RETURNING n.id, n.updated_at, n.version, n.is_public, old.is_public AS was_public
+            ''',
+            (NOTE_EXCERPT_LENGTH, ids, titles, contents, publics, session['user_id'])
+        )
+        updated = cur.fetchall()
+        missing = sorted(set(ids) - {row['id'] for row in updated})
+        if missing:
+            conn.rollback()
+            raise ApiError(404, 'Notes not found', details={'ids': missing})
+        bump_notes_version(cur, session['user_id'])
+        conn.commit()
+    except ApiError:
+        raise
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    if any(row['is_public'] or row['was_public'] for row in updated):
+        invalidate_profile(session['user_id'])
+    updated.sort(key=lambda row: ids.index(row['id']))
+    return jsonify({'data': [serialize(row, ['id', 'updated_at', 'version']) for row in updated]})
+
+
+def normalize_newlines(text):
+    """Line breaks as a browser textarea reports them, which edit offsets are counted against"""
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def apply_edits(content, edits):
+    """Apply [{start, end, text}, ...] to content; raises ApiError(400) for a malformed list
+    
+    Offsets count UTF-16 code units, as JavaScript string indices do, and all
+    refer to the original content, so edits must be sorted and not overlap.
+    """
+    if not isinstance(edits, list) or len(edits) > current_app.config['API_MAX_NOTE_EDITS']:
+        raise ApiError(400, f'content_edits must be a list of at most {current_app.config["API_MAX_NOTE_EDITS"]} edits')
+    units = content.encode('utf-16-le')
+    length = len(units) // 2
+    pieces, position = [], 0
+    for index, edit in enumerate(edits):
+        start = edit.get('start') if isinstance(edit, dict) else None
+        end = edit.get('end') if isinstance(edit, dict) else None
+        text = edit.get('text', '') if isinstance(edit, dict) else None
+        if not all(isinstance(n, int) and not isinstance(n, bool) for n in (start, end)) or not isinstance(text, str):
+            raise ApiError(400, 'Invalid content edit', details={'index': index, 'error': 'expected {start, end, text}'})
+        if not position <= start <= end <= length:
+            raise ApiError(400, 'Invalid content edit', details={'index': index, 'error': 'out of range or overlapping'})
+        pieces += [units[2 * position:2 * start], text.encode('utf-16-le')]
+        position = end
+    pieces.append(units[2 * position:])
+    try:
+        return b''.join(pieces).decode('utf-16-le')
+    except UnicodeDecodeError:
+        # An offset split a surrogate pair
+        raise ApiError(400, 'Content edits must not split a character')
+
+
+@api.route('/notes/<int:note_id>', methods=['PATCH'])
+@api_login_required
+def patch_note(note_id):
+    """Apply {"version", "content_edits"?, "title"?, "is_public"?} to one note
+    
+    The edits are applied to the note as it was at version; if it has changed
+    since, nothing is written and the current version comes back with a 409.
+    Only the columns that actually change are updated, and a patch that
+    changes nothing writes nothing.
+    """
+    body = json_body()
+    version = body.get('version')
+    if not isinstance(version, int) or isinstance(version, bool):
+        raise ApiError(400, 'version must be an integer')
+    title, _, is_public, errors = clean_note({'title': body.get('title'), 'is_public': body.get('is_public')}, partial=True)
+    if errors:
+        raise ApiError(400, 'Invalid note', details=errors)
+    
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT user_id, title, content, is_public, version FROM notes WHERE id = %s', (note_id,))
+        note = cur.fetchone()
+        if not note or note['user_id'] != session['user_id']:
+            raise ApiError(404, 'Note not found')
+        if note['version'] != version:
+            raise ApiError(409, 'Note has changed since that version', details={'version': note['version']})
+        
+        changes = {}
+        if 'content_edits' in body:
+            base = normalize_newlines(note['content'] or '')
+            content = apply_edits(base, body['content_edits'])
+            if content != base:
+                changes['content'] = content
+        if title is not None and title != note['title']:
+            changes['title'] = title
+        if is_public is not None and is_public != note['is_public']:
+            changes['is_public'] = is_public
+        if not changes:
+            return jsonify({'id': note_id, 'version': note['version'], 'changed': False})
+        
+        assignments = [f'{column} = %s' for column in changes]
+        params = list(changes.values())
+        if 'content' in changes:
+            assignments += ['excerpt = %s', 'content_length = %s']
+            params += [changes['content'][:NOTE_EXCERPT_LENGTH], len(changes['content'])]
+        if 'content' in changes or 'title' in changes:
+            assignments.append(f'search_vector = {note_search_vector_sql()}')
+            params += [changes.get('title', note['title']), changes.get('content', note['content'])]
+        # The version condition catches a write that landed after the SELECT
+        cur.execute(
+            f'UPDATE notes SET {", ".join(assignments)}, version = version + 1, updated_at = CURRENT_TIMESTAMP '
+            'WHERE id = %s AND version = %s RETURNING version, updated_at',
+            params + [note_id, version]
+        )
+        updated = cur.fetchone()
+        if not updated:
+            conn.rollback()
+            cur.execute('SELECT version FROM notes WHERE id = %s', (note_id,))
+            current = cur.fetchone()
+            raise ApiError(409, 'Note has changed since that version', details={'version': current and current['version']})
+        bump_notes_version(cur, session['user_id'])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    if note['is_public'] or changes.get('is_public'):
+        invalidate_profile(session['user_id'])
+    return jsonify({'id': note_id, 'version': updated['version'], 'updated_at': updated['updated_at'].isoformat(), 'changed': True})
+
+
+@api.route('/notes', methods=['DELETE'])
+@api_login_required
+def delete_notes():
+    """Delete {"ids": [...]}; all of them or none"""
+    ids = bulk_items(json_body(), 'ids')
+    if not all(isinstance(note_id, int) and not isinstance(note_id, bool) for note_id in ids):
+        raise ApiError(400, 'ids must be integers')
+    ids = sorted(set(ids))
+    
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            'SELECT a.filename FROM attachments a JOIN notes n ON n.id = a.note_id '
+            'WHERE n.id = ANY(%s) AND n.user_id = %s',
+            (ids, session['user_id'])
+        )
+        filenames = [row['filename'] for row in cur.fetchall()]
+        cur.execute(
+            'DELETE FROM notes WHERE id = ANY(%s) AND user_id = %s RETURNING id, is_public',
+            (ids, session['user_id'])
+        )
+        deleted = cur.fetchall()
+        missing = sorted(set(ids) - {row['id'] for row in deleted})
+        if missing:
+            conn.rollback()
+            raise ApiError(404, 'Notes not found', details={'ids': missing})
+        bump_notes_version(cur, session['user_id'])
+        if filenames:
+            enqueue(cur, 'release_blobs', {'filenames': filenames})
+        conn.commit()
+    except ApiError:
+        raise
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    if any(row['is_public'] for row in deleted):
+        invalidate_profile(session['user_id'])
+    return jsonify({'deleted': sorted(row['id'] for row in deleted)})
@@ -1,30 +1,65 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_from_directory
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
-from database import get_db_connection
+from flask import Flask, render_template, stream_template, request, redirect, url_for, session, flash, get_flashed_messages, send_from_directory, jsonify, make_response, stream_with_context
+from markupsafe import Markup, escape
+from werkzeug.http import is_resource_modified
+from database import get_db, get_read_db, get_pool, get_replicas, init_app, note_excerpt, bump_notes_version, NOTE_SEARCH_VECTOR_SQL, PoolTimeout
+from pagination import fetch_page
+from storage import store_uploads, place_blobs, insert_attachments, abandon_uploads, discard_uploads
+from avatars import process_avatar, avatar_url, avatar_srcset, InvalidAvatar
+from cache import get_cache, profile_cache_key, invalidate_profile
+from passwords import get_hasher, authenticate, HashingBusy
+from api import api
+from export import UserExport, ExportBusy
+from jobs import enqueue
+from metrics import init_app as init_metrics, count_upload, count_download
+from assets import init_app as init_assets, fingerprint as asset_fingerprint
+from compression import init_app as init_compression
 from config import Config
+import repository
 import functools
+import hashlib
+import mimetypes
 import os
-import uuid
 from pathlib import Path
 
 app = Flask(__name__)
 app.config.from_object(Config)
+init_app(app)
+init_metrics(app)
+init_assets(app)
+init_compression(app)
+app.jinja_env.globals.update(avatar_url=avatar_url, avatar_srcset=avatar_srcset)
+app.register_blueprint(api)
 
 # Configure upload settings
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'avatars')
-ATTACHMENTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'attachments')
+ATTACHMENTS_FOLDER = Config.ATTACHMENTS_FOLDER
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 ALLOWED_ATTACHMENT_EXTENSIONS = {
-		'pdf', 'doc', 'docx', 'txt', 'xls', 'xlsx', 'ppt', 'pptx',
-		'png', 'jpg', 'jpeg', 'gif', 'bmp', 'svg',
-		'zip', 'rar', '7z',
-		'mp3', 'wav', 'mp4', 'avi', 'mov',
-		'csv', 'json', 'xml'
+    'pdf', 'doc', 'docx', 'txt', 'xls', 'xlsx', 'ppt', 'pptx',
+    'png', 'jpg', 'jpeg', 'gif', 'bmp', 'svg',
+    'zip', 'rar', '7z',
+    'mp3', 'wav', 'mp4', 'avi', 'mov',
+    'csv', 'json', 'xml'
 }
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['ATTACHMENTS_FOLDER'] = ATTACHMENTS_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10MB max file size
+# X-Sendfile offload: Flask's send_file emits the header instead of the body
+app.config['USE_X_SENDFILE'] = app.config['ATTACHMENT_OFFLOAD'] == 'x-sendfile'
+
+# Search headline settings; matches are wrapped in control characters that do
+# not occur in normal text, then turned into <mark> tags after escaping
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_STOP = '\x03'
+SEARCH_HEADLINE_OPTIONS = f'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, MaxFragments=2, MaxWords=25, MinWords=10'
+SEARCH_TITLE_HEADLINE_OPTIONS = f'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, HighlightAll=true'
+
+# Digest of every template and of the asset manifest, part of each page
+# validator so a deploy that changes the markup or the fingerprinted asset
+# URLs in it also invalidates pages cached by browsers
+TEMPLATE_FINGERPRINT = hashlib.sha256(b''.join(
+    path.read_bytes() for path in sorted(Path(app.root_path, app.template_folder).glob('*.html'))
+) + asset_fingerprint().encode()).hexdigest()[:12]
 
 # Create upload folders if they don't exist
 Path(UPLOAD_FOLDER).mkdir(parents=True, exist_ok=True)
@@ -32,561 +67,716 @@ Path(ATTACHMENTS_FOLDER).mkdir(parents=True, exist_ok=True)
 
 
 def allowed_file(filename):
-		"""Check if file extension is allowed for avatars"""
-		return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    """Check if file extension is allowed for avatars"""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
 def allowed_attachment(filename):
-		"""Check if file extension is allowed for attachments"""
-		return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_ATTACHMENT_EXTENSIONS
+    """Check if file extension is allowed for attachments"""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_ATTACHMENT_EXTENSIONS
+
+
+def fetch_public_notes_page(cur, user_id):
+    """Fetch one page of a user's public notes, positioned by the request's cursor"""
+    return fetch_page(
+        cur,
+        'SELECT id, title, excerpt, content_length, created_at FROM notes WHERE user_id = %s AND is_public = TRUE',
+        (user_id,),
+        'created_at',
+        app.config['NOTES_PAGE_SIZE'],
+        after=request.args.get('after'),
+        before=request.args.get('before')
+    )
+
+
+def page_etag(*parts):
+    """Validator for a page rendered for the current viewer from data identified by parts"""
+    return '-'.join(str(part) for part in (session['user_id'], TEMPLATE_FINGERPRINT) + parts)
+
+
+def not_modified(etag):
+    """Return a 304 response if the client already has the current version of this page
+    
+    Pages with pending flash messages are always rendered, since the cached
+    copy would not show them.
+    """
+    if '_flashes' in session or is_resource_modified(request.environ, etag=etag):
+        return None
+    return revalidate(app.response_class(status=304), etag)
+
+
+def revalidate(response, etag):
+    """Mark a per-user page as cacheable only if revalidated against its ETag"""
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
+def stream_page(template_name, **context):
+    """Response that sends a page while its template is still rendering
+    
+    Output goes out in pieces of about STREAM_CHUNK_SIZE characters, so the
+    first bytes leave early and a long page is never held in memory whole.
+    """
+    # The session cookie is sent before the body, so flashed messages must be
+    # taken out of the session now rather than when base.html shows them
+    get_flashed_messages(with_categories=True)
+    # Keeps the request context around for as long as the template renders
+    pieces = stream_template(template_name, **context)
+    
+    def chunks():
+        buffered, size = [], 0
+        for piece in pieces:
+            buffered.append(piece)
+            size += len(piece)
+            if size >= app.config['STREAM_CHUNK_SIZE']:
+                yield ''.join(buffered)
+                buffered, size = [], 0
+        if buffered:
+            yield ''.join(buffered)
+    
+    return app.response_class(chunks(), mimetype='text/html')
+
+
+def streamed_rows(cur):
+    """Yield a server-side cursor's rows as a streamed template consumes them, then close it"""
+    try:
+        yield from cur
+    finally:
+        cur.close()
+
+
+@app.template_filter('highlight')
+def highlight(snippet):
+    """Escape a search headline and turn its match markers into <mark> tags"""
+    escaped = str(escape(snippet or ''))
+    return Markup(escaped.replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_STOP, '</mark>'))
 
 
 def login_required(view):
-		"""Decorator to require login for certain routes"""
-		@functools.wraps(view)
-		def wrapped_view(**kwargs):
-				if 'user_id' not in session:
-						return redirect(url_for('login'))
-				return view(**kwargs)
-		return wrapped_view
+    """Decorator to require login for certain routes"""
+    @functools.wraps(view)
+    def wrapped_view(**kwargs):
+        if 'user_id' not in session:
+            return redirect(url_for('login'))
+        return view(**kwargs)
+    return wrapped_view
+
+
+@app.errorhandler(PoolTimeout)
+@app.errorhandler(HashingBusy)
+@app.errorhandler(ExportBusy)
+def server_busy(error):
+    """All pooled connections, password hashing workers or export slots stayed busy"""
+    return render_template('busy.html'), 503
+
+
+@app.route('/stats/db-pool')
+@login_required
+def db_pool_stats():
+    """Connection pool usage, for sizing DB_POOL_MIN_SIZE/DB_POOL_MAX_SIZE"""
+    stats = get_pool().stats()
+    if get_replicas():
+        stats['replicas'] = [replica.stats() for replica in get_replicas()]
+    return jsonify(stats)
 
 
 @app.route('/')
 def index():
-		"""Home page"""
-		if 'user_id' in session:
-				return render_template('home.html', username=session.get('username'))
-		return redirect(url_for('login'))
+    """Home page"""
+    if 'user_id' in session:
+        return render_template('home.html', username=session.get('username'))
+    return redirect(url_for('login'))
 
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
-		"""User registration"""
-		if request.method == 'POST':
-				username = request.form.get('username', '').strip()
-				password = request.form.get('password', '')
-				confirm_password = request.form.get('confirm_password', '')
-				
-				# Validation
-				if not username or not password:
-						flash('Username and password are required', 'error')
-						return render_template('register.html')
-				
-				if len(username) < 3:
-						flash('Username must be at least 3 characters long', 'error')
-						return render_template('register.html')
-				
-				if len(password) < 6:
-						flash('Password must be at least 6 characters long', 'error')
-						return render_template('register.html')
-				
-				if password != confirm_password:
-						flash('Passwords do not match', 'error')
-						return render_template('register.html')
-				
-				# Check if username already exists
-				conn = get_db_connection()
-				cur = conn.cursor()
-				cur.execute('SELECT id FROM users WHERE username = %s', (username,))
-				existing_user = cur.fetchone()
-				
-				if existing_user:
-						flash('Username already exists', 'error')
-						cur.close()
-						conn.close()
-						return render_template('register.html')
-				
-				# Create new user
-				password_hash = generate_password_hash(password)
-				cur.execute(
-						'INSERT INTO users (username, password_hash) VALUES (%s, %s) RETURNING id',
-						(username, password_hash)
-				)
-				user_id = cur.fetchone()['id']
-				conn.commit()
-				cur.close()
-				conn.close()
-				
-				# Log user in
-				session['user_id'] = user_id
-				session['username'] = username
-				flash('Registration successful! Welcome to VibeNotes!', 'success')
-				return redirect(url_for('index'))
-		
-		return render_template('register.html')
+    """User registration"""
+    if request.method == 'POST':
+        username = request.form.get('username', '').strip()
+        password = request.form.get('password', '')
+        confirm_password = request.form.get('confirm_password', '')
+        
+        # Validation
+        if not username or not password:
+            flash('Username and password are required', 'error')
+            return render_template('register.html')
+        
+        if len(username) < 3:
+            flash('Username must be at least 3 characters long', 'error')
+            return render_template('register.html')
+        
+        if len(password) < 6:
+            flash('Password must be at least 6 characters long', 'error')
+            return render_template('register.html')
+        
+        if password != confirm_password:
+            flash('Passwords do not match', 'error')
+            return render_template('register.html')
+        
+        # Check if username already exists
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('SELECT id FROM users WHERE username = %s', (username,))
+        existing_user = cur.fetchone()
+        
+        if existing_user:
+            flash('Username already exists', 'error')
+            cur.close()
+            return render_template('register.html')
+        
+        # Create new user
+        password_hash = get_hasher().hash(password)
+        cur.execute(
+            'INSERT INTO users (username, password_hash) VALUES (%s, %s) RETURNING id',
+            (username, password_hash)
+        )
+        user_id = cur.fetchone()['id']
+        conn.commit()
+        cur.close()
+        
+        # Log user in
+        session['user_id'] = user_id
+        session['username'] = username
+        flash('Registration successful! Welcome to VibeNotes!', 'success')
+        return redirect(url_for('index'))
+    
+    return render_template('register.html')
 
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
-		"""User login"""
-		if request.method == 'POST':
-				username = request.form.get('username', '').strip()
-				password = request.form.get('password', '')
-				
-				if not username or not password:
-						flash('Username and password are required', 'error')
-						return render_template('login.html')
-				
-				# Find user
-				conn = get_db_connection()
-				cur = conn.cursor()
-				cur.execute('SELECT id, username, password_hash FROM users WHERE username = %s', (username,))
-				user = cur.fetchone()
-				cur.close()
-				conn.close()
-				
-				if user and check_password_hash(user['password_hash'], password):
-						# Login successful
-						session['user_id'] = user['id']
-						session['username'] = user['username']
-						flash('Login successful!', 'success')
-						return redirect(url_for('index'))
-				else:
-						flash('Invalid username or password', 'error')
-						return render_template('login.html')
-		
-		return render_template('login.html')
+    """User login"""
+    if request.method == 'POST':
+        username = request.form.get('username', '').strip()
+        password = request.form.get('password', '')
+        
+        if not username or not password:
+            flash('Username and password are required', 'error')
+            return render_template('login.html')
+        
+        user = authenticate(get_db(), username, password)
+        if user:
+            # Login successful
+            session['user_id'] = user['id']
+            session['username'] = user['username']
+            flash('Login successful!', 'success')
+            return redirect(url_for('index'))
+        else:
+            flash('Invalid username or password', 'error')
+            return render_template('login.html')
+    
+    return render_template('login.html')
 
 
 @app.route('/logout')
 def logout():
-		"""User logout"""
-		session.clear()
-		flash('You have been logged out', 'success')
-		return redirect(url_for('login'))
+    """User logout"""
+    session.clear()
+    flash('You have been logged out', 'success')
+    return redirect(url_for('login'))
 
 
 @app.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
-		"""View and edit user profile"""
-		conn = get_db_connection()
-		cur = conn.cursor()
-		
-		if request.method == 'POST':
-				description = request.form.get('description', '').strip()
-				
-				# Handle avatar upload
-				avatar_filename = None
-				if 'avatar' in request.files:
-						file = request.files['avatar']
-						if file and file.filename and allowed_file(file.filename):
-								# Create unique filename
-								filename = secure_filename(file.filename)
-								ext = filename.rsplit('.', 1)[1].lower()
-								avatar_filename = f"user_{session['user_id']}.{ext}"
-								file.save(os.path.join(app.config['UPLOAD_FOLDER'], avatar_filename))
-				
-				# Update user profile
-				if avatar_filename:
-						cur.execute(
-								'UPDATE users SET description = %s, avatar = %s WHERE id = %s',
-								(description, avatar_filename, session['user_id'])
-						)
-				else:
-						cur.execute(
-								'UPDATE users SET description = %s WHERE id = %s',
-								(description, session['user_id'])
-						)
-				
-				conn.commit()
-				flash('Profile updated successfully!', 'success')
-				
-				# Refresh user data
-				cur.execute(
-						'SELECT id, username, description, avatar FROM users WHERE id = %s',
-						(session['user_id'],)
-				)
-				user = cur.fetchone()
-				cur.close()
-				conn.close()
-				return render_template('profile.html', user=user, is_own_profile=True)
-		
-		# GET request - fetch user data
-		cur.execute(
-				'SELECT id, username, description, avatar FROM users WHERE id = %s',
-				(session['user_id'],)
-		)
-		user = cur.fetchone()
-		
-		# Get user's public notes
-		cur.execute(
-				'SELECT id, title, content, created_at FROM notes WHERE user_id = %s AND is_public = TRUE ORDER BY created_at DESC',
-				(session['user_id'],)
-		)
-		public_notes = cur.fetchall()
-		
-		cur.close()
-		conn.close()
-		return render_template('profile.html', user=user, is_own_profile=True, public_notes=public_notes)
+    """View and edit user profile"""
+    conn = get_db()
+    cur = conn.cursor()
+    
+    if request.method == 'POST':
+        description = request.form.get('description', '').strip()
+        
+        # Handle avatar upload: resized into fixed sizes under a content-versioned name
+        avatar_filename = None
+        if 'avatar' in request.files:
+            file = request.files['avatar']
+            if file and file.filename and allowed_file(file.filename):
+                try:
+                    avatar_filename = process_avatar(file.stream, app.config['UPLOAD_FOLDER'], session['user_id'])
+                    count_upload('avatar', file.stream.seek(0, os.SEEK_END))
+                except InvalidAvatar:
+                    flash('The avatar could not be read as an image', 'error')
+        
+        # Update user profile
+        if avatar_filename:
+            cur.execute(
+                '''
+                UPDATE users u SET description = %s, avatar = %s
+                FROM users old WHERE u.id = old.id AND u.id = %s
+                RETURNING old.avatar
+                ''',
+                (description, avatar_filename, session['user_id'])
+            )
+            old_avatar = cur.fetchone()['avatar']
+            if old_avatar and old_avatar != avatar_filename:
+                enqueue(cur, 'remove_avatar', {'user_id': session['user_id'], 'avatar': old_avatar})
+        else:
+            cur.execute(
+                'UPDATE users SET description = %s WHERE id = %s',
+                (description, session['user_id'])
+            )
+        
+        conn.commit()
+        invalidate_profile(session['user_id'])
+        flash('Profile updated successfully!', 'success')
+        
+        # Refresh user data
+        cur.execute(
+            'SELECT id, username, description, avatar FROM users WHERE id = %s',
+            (session['user_id'],)
+        )
+        user = cur.fetchone()
+        cur.close()
+        return render_template('profile.html', user=user, is_own_profile=True)
+    
+    # GET request - fetch user data
+    cur.execute(
+        'SELECT id, username, description, avatar FROM users WHERE id = %s',
+        (session['user_id'],)
+    )
+    user = cur.fetchone()
+    
+    # Get a page of the user's public notes
+    public_notes = fetch_public_notes_page(cur, session['user_id'])
+    
+    cur.close()
+    return stream_page('profile.html', user=user, is_own_profile=True, public_notes=public_notes.items, public_notes_page=public_notes)
 
 
 @app.route('/users')
 @login_required
 def users():
-		"""View all users"""
-		conn = get_db_connection()
-		cur = conn.cursor()
-		cur.execute(
-				'SELECT id, username, description, avatar FROM users ORDER BY username'
-		)
-		all_users = cur.fetchall()
-		cur.close()
-		conn.close()
-		return render_template('users.html', users=all_users)
+    """View all users"""
+    # A server-side cursor hands the rows over in batches while the page
+    # streams, so the whole user list is never loaded at once
+    conn = get_read_db()
+    cur = conn.cursor(name='users_list')
+    cur.itersize = app.config['STREAM_CURSOR_ITERSIZE']
+    cur.execute(
+        'SELECT id, username, description, avatar FROM users ORDER BY username'
+    )
+    return stream_page('users.html', users=streamed_rows(cur))
 
 
 @app.route('/user/<int:user_id>')
 @login_required
 def view_user(user_id):
-		"""View a specific user's profile"""
-		conn = get_db_connection()
-		cur = conn.cursor()
-		cur.execute(
-				'SELECT id, username, description, avatar FROM users WHERE id = %s',
-				(user_id,)
-		)
-		user = cur.fetchone()
-		
-		if not user:
-				cur.close()
-				conn.close()
-				flash('User not found', 'error')
-				return redirect(url_for('users'))
-		
-		# Get user's public notes
-		cur.execute(
-				'SELECT id, title, content, created_at FROM notes WHERE user_id = %s AND is_public = TRUE ORDER BY created_at DESC',
-				(user_id,)
-		)
-		public_notes = cur.fetchall()
-		
-		cur.close()
-		conn.close()
-		
-		is_own_profile = (user_id == session['user_id'])
-		return render_template('profile.html', user=user, is_own_profile=is_own_profile, public_notes=public_notes)
+    """View a specific user's profile"""
+    # Another user's profile looks the same to every viewer, so its rendered
+    # body is cached until the profile or one of its public notes changes
+    is_own_profile = (user_id == session['user_id'])
+    cache_key = None
+    if not is_own_profile:
+        cache_key = profile_cache_key(user_id, request.args.get('after'), request.args.get('before'))
+        profile_content = get_cache().get(cache_key)
+        if profile_content is not None:
+            return render_template('profile.html', profile_content=Markup(profile_content))
+    
+    # A render that fills the cache must come from the primary: a lagging
+    # replica could still show data from before the generation in the key
+    conn = get_read_db() if cache_key is None else get_db()
+    cur = conn.cursor()
+    cur.execute(
+        'SELECT id, username, description, avatar FROM users WHERE id = %s',
+        (user_id,)
+    )
+    user = cur.fetchone()
+    
+    if not user:
+        cur.close()
+        flash('User not found', 'error')
+        return redirect(url_for('users'))
+    
+    # Get a page of the user's public notes
+    public_notes = fetch_public_notes_page(cur, user_id)
+    
+    cur.close()
+    
+    if cache_key is None:
+        return stream_page('profile.html', user=user, is_own_profile=True, public_notes=public_notes.items, public_notes_page=public_notes)
+    profile_content = render_template('profile_content.html', user=user, is_own_profile=False, public_notes=public_notes.items, public_notes_page=public_notes)
+    get_cache().set(cache_key, profile_content)
+    return render_template('profile.html', profile_content=Markup(profile_content))
 
 
 @app.route('/notes')
 @login_required
 def notes():
-		"""List all notes for the current user"""
-		conn = get_db_connection()
-		cur = conn.cursor()
-		cur.execute(
-				'SELECT id, title, content, created_at, updated_at FROM notes WHERE user_id = %s ORDER BY updated_at DESC',
-				(session['user_id'],)
-		)
-		user_notes = cur.fetchall()
-		cur.close()
-		conn.close()
-		return render_template('notes.html', notes=user_notes)
+    """List all notes for the current user"""
+    conn = get_read_db()
+    cur = conn.cursor()
+    
+    # Answer revalidations from the user's change counter alone, without
+    # touching the notes table. It must be read before the notes themselves.
+    cur.execute('SELECT notes_version FROM users WHERE id = %s', (session['user_id'],))
+    etag = page_etag('notes', cur.fetchone()['notes_version'], request.args.get('after', ''), request.args.get('before', ''))
+    response = not_modified(etag)
+    if response:
+        cur.close()
+        return response
+    
+    page = fetch_page(
+        cur,
+        'SELECT id, title, excerpt, content_length, created_at, updated_at FROM notes WHERE user_id = %s',
+        (session['user_id'],),
+        'updated_at',
+        app.config['NOTES_PAGE_SIZE'],
+        after=request.args.get('after'),
+        before=request.args.get('before')
+    )
+    cur.close()
+    
+    # A stale cursor (e.g. after deleting notes) falls back to the first page
+    if not page.items and (request.args.get('after') or request.args.get('before')):
+        return redirect(url_for('notes'))
+    return revalidate(stream_page('notes.html', notes=page.items, page=page), etag)
+
+
+@app.route('/export')
+@login_required
+def export_notes():
+    """Download all of the user's notes as NDJSON, or with ?format=zip including attachments"""
+    as_zip = request.args.get('format') == 'zip'
+    export = UserExport(session['user_id'], app.config['ATTACHMENTS_FOLDER'])
+    response = app.response_class(
+        stream_with_context(export.zip() if as_zip else export.ndjson()),
+        mimetype='application/zip' if as_zip else 'application/x-ndjson'
+    )
+    # Runs however the response ends, even if streaming never started
+    response.call_on_close(export.close)
+    # Named by user id: a username may not be Latin-1, which no header can carry as is
+    response.headers.set(
+        'Content-Disposition', 'attachment',
+        filename=f'vibenotes-{session["user_id"]}.{"zip" if as_zip else "ndjson"}'
+    )
+    return response
+
+
+@app.route('/search')
+@login_required
+def search():
+    """Full-text search over your own notes and other users' public notes"""
+    query = request.args.get('q', '').strip()
+    page_number = max(request.args.get('page', 1, type=int), 1)
+    page_size = app.config['NOTES_PAGE_SIZE']
+    results = []
+    has_next = False
+    
+    if query:
+        conn = get_read_db()
+        cur = conn.cursor()
+        # Rank against the GIN-indexed search_vector first, then build
+        # headlines only for the page of notes actually being shown
+        cur.execute(
+            '''
+            SELECT n.id, n.title, n.is_public, n.updated_at, n.user_id, u.username, m.rank,
+                ts_headline('english', n.title, m.query, %s) AS title_snippet,
+                ts_headline('english', COALESCE(n.content, ''), m.query, %s) AS snippet
+            FROM (
+                SELECT id, ts_rank_cd(search_vector, query) AS rank, query
+                FROM notes, websearch_to_tsquery('english', %s) AS query
+                WHERE search_vector @@ query AND (user_id = %s OR is_public = TRUE)
+                ORDER BY rank DESC, id DESC
+                LIMIT %s OFFSET %s
+            ) m
+            JOIN notes n ON n.id = m.id
+            JOIN users u ON u.id = n.user_id
+            ORDER BY m.rank DESC, m.id DESC
+            ''',
+            (
+                SEARCH_TITLE_HEADLINE_OPTIONS, SEARCH_HEADLINE_OPTIONS,
+                query, session['user_id'],
+                page_size + 1, (page_number - 1) * page_size
+            )
+        )
+        results = cur.fetchall()
+        cur.close()
+        has_next = len(results) > page_size
+        results = results[:page_size]
+    
+    return render_template('search.html', query=query, results=results, page_number=page_number, has_next=has_next)
 
 
 @app.route('/notes/create', methods=['GET', 'POST'])
 @login_required
 def create_note():
-		"""Create a new note"""
-		if request.method == 'POST':
-				title = request.form.get('title', '').strip()
-				content = request.form.get('content', '').strip()
-				is_public = request.form.get('is_public') == 'true'
-				
-				# Validation
-				if not title:
-						flash('Title is required', 'error')
-						return render_template('create_note.html')
-				
-				if len(title) > 200:
-						flash('Title must be 200 characters or less', 'error')
-						return render_template('create_note.html')
-				
-				# Create new note
-				conn = get_db_connection()
-				cur = conn.cursor()
-				cur.execute(
-						'INSERT INTO notes (user_id, title, content, is_public) VALUES (%s, %s, %s, %s) RETURNING id',
-						(session['user_id'], title, content, is_public)
-				)
-				note_id = cur.fetchone()['id']
-				conn.commit()
-				
-				# Handle file attachments
-				if 'attachments' in request.files:
-						files = request.files.getlist('attachments')
-						for file in files:
-								if file and file.filename and allowed_attachment(file.filename):
-										# Generate unique filename
-										original_filename = secure_filename(file.filename)
-										ext = original_filename.rsplit('.', 1)[1].lower()
-										unique_filename = f"{uuid.uuid4().hex}.{ext}"
-										file_path = os.path.join(app.config['ATTACHMENTS_FOLDER'], unique_filename)
-										file.save(file_path)
-										
-										# Get file size
-										file_size = os.path.getsize(file_path)
-										
-										# Save attachment info to database
-										cur.execute(
-												'INSERT INTO attachments (note_id, filename, original_filename, file_size) VALUES (%s, %s, %s, %s)',
-												(note_id, unique_filename, original_filename, file_size)
-										)
-										conn.commit()
-				
-				cur.close()
-				conn.close()
-				
-				flash('Note created successfully!', 'success')
-				return redirect(url_for('view_note', note_id=note_id))
-		
-		return render_template('create_note.html')
+    """Create a new note"""
+    if request.method == 'POST':
+        title = request.form.get('title', '').strip()
+        content = request.form.get('content', '').strip()
+        is_public = request.form.get('is_public') == 'true'
+        
+        # Validation
+        if not title:
+            flash('Title is required', 'error')
+            return render_template('create_note.html')
+        
+        if len(title) > 200:
+            flash('Title must be 200 characters or less', 'error')
+            return render_template('create_note.html')
+        
+        # Borrow the connection before writing any files: a pool timeout after
+        # that would leave them behind. The files are written before the first
+        # statement, so the transaction below stays short.
+        conn = get_db()
+        cur = conn.cursor()
+        stored = store_uploads(request.files.getlist('attachments'), app.config['ATTACHMENTS_FOLDER'], allowed_attachment)
+        
+        # Create the note and its attachment rows in one transaction
+        try:
+            cur.execute(
+                'INSERT INTO notes (user_id, title, content, excerpt, content_length, is_public, search_vector) '
+                f'VALUES (%s, %s, %s, %s, %s, %s, {NOTE_SEARCH_VECTOR_SQL}) RETURNING id',
+                (session['user_id'], title, content, note_excerpt(content), len(content), is_public, title, content)
+            )
+            note_id = cur.fetchone()['id']
+            bump_notes_version(cur, session['user_id'])
+            place_blobs(cur, app.config['ATTACHMENTS_FOLDER'], stored)
+            insert_attachments(cur, note_id, stored)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            abandon_uploads(conn, app.config['ATTACHMENTS_FOLDER'], stored)
+            raise
+        finally:
+            cur.close()
+        count_upload('attachment', sum(a['file_size'] for a in stored))
+        if is_public:
+            invalidate_profile(session['user_id'])
+        
+        flash('Note created successfully!', 'success')
+        return redirect(url_for('view_note', note_id=note_id))
+    
+    return render_template('create_note.html')
 
 
 @app.route('/notes/<int:note_id>')
 @login_required
 def view_note(note_id):
-		"""View a specific note"""
-		conn = get_db_connection()
-		cur = conn.cursor()
-		cur.execute(
-				'SELECT id, user_id, title, content, is_public, created_at, updated_at FROM notes WHERE id = %s',
-				(note_id,)
-		)
-		note = cur.fetchone()
-		
-		if not note:
-				cur.close()
-				conn.close()
-				flash('Note not found', 'error')
-				return redirect(url_for('notes'))
-		
-		# Check if user owns this note or if it's public
-		is_owner = note['user_id'] == session['user_id']
-		if not is_owner and not note['is_public']:
-				cur.close()
-				conn.close()
-				flash('You do not have permission to view this note', 'error')
-				return redirect(url_for('notes'))
-		
-		# Get attachments for this note
-		cur.execute(
-				'SELECT id, filename, original_filename, file_size, uploaded_at FROM attachments WHERE note_id = %s ORDER BY uploaded_at',
-				(note_id,)
-		)
-		attachments = cur.fetchall()
-		
-		cur.close()
-		conn.close()
-		
-		return render_template('note_detail.html', note=note, attachments=attachments, is_owner=is_owner)
+    """View a specific note"""
+    # The note, its owner's notes version and its attachments in one round trip
+    cur = get_read_db().cursor()
+    note, attachments = repository.note_with_attachments(cur, note_id)
+    cur.close()
+    
+    if not note:
+        flash('Note not found', 'error')
+        return redirect(url_for('notes'))
+    
+    # Check if user owns this note or if it's public
+    is_owner = note['user_id'] == session['user_id']
+    if not is_owner and not note['is_public']:
+        flash('You do not have permission to view this note', 'error')
+        return redirect(url_for('notes'))
+    
+    # Any change to the note or its attachments bumps the owner's notes version
+    etag = page_etag('note', note_id, note['notes_version'])
+    response = not_modified(etag)
+    if response:
+        return response
+    
+    return revalidate(make_response(render_template('note_detail.html', note=note, attachments=attachments, is_owner=is_owner)), etag)
 
 
 @app.route('/notes/<int:note_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_note(note_id):
-		"""Edit an existing note"""
-		conn = get_db_connection()
-		cur = conn.cursor()
-		
-		# Get the note
-		cur.execute(
-				'SELECT id, user_id, title, content, is_public FROM notes WHERE id = %s',
-				(note_id,)
-		)
-		note = cur.fetchone()
-		
-		if not note:
-				cur.close()
-				conn.close()
-				flash('Note not found', 'error')
-				return redirect(url_for('notes'))
-		
-		# Check if user owns this note
-		if note['user_id'] != session['user_id']:
-				cur.close()
-				conn.close()
-				flash('You do not have permission to edit this note', 'error')
-				return redirect(url_for('notes'))
-		
-		if request.method == 'POST':
-				title = request.form.get('title', '').strip()
-				content = request.form.get('content', '').strip()
-				is_public = request.form.get('is_public') == 'true'
-				
-				# Validation
-				if not title:
-						flash('Title is required', 'error')
-						cur.close()
-						conn.close()
-						return render_template('edit_note.html', note=note)
-				
-				if len(title) > 200:
-						flash('Title must be 200 characters or less', 'error')
-						cur.close()
-						conn.close()
-						return render_template('edit_note.html', note=note)
-				
-				# Update the note
-				cur.execute(
-						'UPDATE notes SET title = %s, content = %s, is_public = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s',
-						(title, content, is_public, note_id)
-				)
-				conn.commit()
-				
-				# Handle file attachments
-				if 'attachments' in request.files:
-						files = request.files.getlist('attachments')
-						for file in files:
-								if file and file.filename and allowed_attachment(file.filename):
-										# Generate unique filename
-										original_filename = secure_filename(file.filename)
-										ext = original_filename.rsplit('.', 1)[1].lower()
-										unique_filename = f"{uuid.uuid4().hex}.{ext}"
-										file_path = os.path.join(app.config['ATTACHMENTS_FOLDER'], unique_filename)
-										file.save(file_path)
-										
-										# Get file size
-										file_size = os.path.getsize(file_path)
-										
-										# Save attachment info to database
-										cur.execute(
-												'INSERT INTO attachments (note_id, filename, original_filename, file_size) VALUES (%s, %s, %s, %s)',
-												(note_id, unique_filename, original_filename, file_size)
-										)
-										conn.commit()
-				
-				cur.close()
-				conn.close()
-				
-				flash('Note updated successfully!', 'success')
-				return redirect(url_for('view_note', note_id=note_id))
-		
-		cur.close()
-		conn.close()
-		return render_template('edit_note.html', note=note)
+    """Edit an existing note"""
+    conn = get_db()
+    error = None
+    
+    if request.method == 'POST':
+        title = request.form.get('title', '').strip()
+        content = request.form.get('content', '').strip()
+        is_public = request.form.get('is_public') == 'true'
+        
+        # Validation
+        if not title:
+            error = 'Title is required'
+        elif len(title) > 200:
+            error = 'Title must be 200 characters or less'
+    
+    if request.method == 'POST' and error is None:
+        # Cursor first: nothing may fail between writing the files and the try that cleans them up
+        cur = conn.cursor()
+        stored = store_uploads(request.files.getlist('attachments'), app.config['ATTACHMENTS_FOLDER'], allowed_attachment)
+        
+        # The ownership check, update and version bump are one statement; new
+        # attachment rows join the same transaction
+        try:
+            result = repository.update_note(cur, note_id, session['user_id'], title, content, note_excerpt(content), is_public)
+            if result and result['done']:
+                place_blobs(cur, app.config['ATTACHMENTS_FOLDER'], stored)
+                insert_attachments(cur, note_id, stored)
+                conn.commit()
+            else:
+                conn.rollback()
+                discard_uploads(stored)
+        except Exception:
+            conn.rollback()
+            abandon_uploads(conn, app.config['ATTACHMENTS_FOLDER'], stored)
+            raise
+        finally:
+            cur.close()
+        
+        if not result:
+            flash('Note not found', 'error')
+            return redirect(url_for('notes'))
+        if not result['done']:
+            flash('You do not have permission to edit this note', 'error')
+            return redirect(url_for('notes'))
+        
+        count_upload('attachment', sum(a['file_size'] for a in stored))
+        # Covers making a public note private as well as editing a public one
+        if is_public or result['was_public']:
+            invalidate_profile(session['user_id'])
+        
+        flash('Note updated successfully!', 'success')
+        return redirect(url_for('view_note', note_id=note_id))
+    
+    cur = conn.cursor()
+    note = repository.note_for_edit(cur, note_id)
+    cur.close()
+    
+    if not note:
+        flash('Note not found', 'error')
+        return redirect(url_for('notes'))
+    
+    # Check if user owns this note
+    if note['user_id'] != session['user_id']:
+        flash('You do not have permission to edit this note', 'error')
+        return redirect(url_for('notes'))
+    
+    if error:
+        flash(error, 'error')
+    return render_template('edit_note.html', note=note)
 
 
 @app.route('/notes/<int:note_id>/delete', methods=['POST'])
 @login_required
 def delete_note(note_id):
-		"""Delete a note"""
-		conn = get_db_connection()
-		cur = conn.cursor()
-		
-		# Get the note
-		cur.execute(
-				'SELECT id, user_id FROM notes WHERE id = %s',
-				(note_id,)
-		)
-		note = cur.fetchone()
-		
-		if not note:
-				cur.close()
-				conn.close()
-				flash('Note not found', 'error')
-				return redirect(url_for('notes'))
-		
-		# Check if user owns this note
-		if note['user_id'] != session['user_id']:
-				cur.close()
-				conn.close()
-				flash('You do not have permission to delete this note', 'error')
-				return redirect(url_for('notes'))
-		
-		# Delete the note (cascade will delete attachments and their files)
-		# Get attachments to delete files from disk
-		cur.execute('SELECT filename FROM attachments WHERE note_id = %s', (note_id,))
-		attachments = cur.fetchall()
-		for attachment in attachments:
-				file_path = os.path.join(app.config['ATTACHMENTS_FOLDER'], attachment['filename'])
-				if os.path.exists(file_path):
-						os.remove(file_path)
-		
-		cur.execute('DELETE FROM notes WHERE id = %s', (note_id,))
-		conn.commit()
-		cur.close()
-		conn.close()
-		
-		flash('Note deleted successfully!', 'success')
-		return redirect(url_for('notes'))
+    """Delete a note"""
+    conn = get_db()
+    cur = conn.cursor()
+    
+    # One statement checks ownership, deletes the note (cascading to its
+    # attachment rows), bumps the notes version and queues a release_blobs
+    # job so the worker drops any stored files no other attachment references
+    result = repository.delete_note(cur, note_id, session['user_id'])
+    conn.commit()
+    cur.close()
+    
+    if not result:
+        flash('Note not found', 'error')
+        return redirect(url_for('notes'))
+    
+    if not result['done']:
+        flash('You do not have permission to delete this note', 'error')
+        return redirect(url_for('notes'))
+    
+    if result['is_public']:
+        invalidate_profile(result['user_id'])
+    
+    flash('Note deleted successfully!', 'success')
+    return redirect(url_for('notes'))
 
 
 @app.route('/attachments/<int:attachment_id>/download')
 @login_required
 def download_attachment(attachment_id):
-		"""Download an attachment"""
-		conn = get_db_connection()
-		cur = conn.cursor()
-		
-		# Get attachment and note info
-		cur.execute(
-				'SELECT a.filename, a.original_filename, n.user_id FROM attachments a JOIN notes n ON a.note_id = n.id WHERE a.id = %s',
-				(attachment_id,)
-		)
-		attachment = cur.fetchone()
-		cur.close()
-		conn.close()
-		
-		if not attachment:
-				flash('Attachment not found', 'error')
-				return redirect(url_for('notes'))
-		
-		# Check if user owns the note this attachment belongs to
-		if attachment['user_id'] != session['user_id']:
-				flash('You do not have permission to access this attachment', 'error')
-				return redirect(url_for('notes'))
-		
-		return send_from_directory(
-				app.config['ATTACHMENTS_FOLDER'],
-				attachment['filename'],
-				as_attachment=True,
-				download_name=attachment['original_filename']
-		)
+    """Download an attachment"""
+    conn = get_read_db()
+    cur = conn.cursor()
+    
+    # Get attachment and note info
+    cur.execute(
+        'SELECT a.filename, a.original_filename, a.file_size, a.checksum, a.uploaded_at, n.user_id '
+        'FROM attachments a JOIN notes n ON a.note_id = n.id WHERE a.id = %s',
+        (attachment_id,)
+    )
+    attachment = cur.fetchone()
+    cur.close()
+    
+    if not attachment:
+        flash('Attachment not found', 'error')
+        return redirect(url_for('notes'))
+    
+    # Check if user owns the note this attachment belongs to
+    if attachment['user_id'] != session['user_id']:
+        flash('You do not have permission to access this attachment', 'error')
+        return redirect(url_for('notes'))
+    
+    # The content hash is a strong validator: answer revalidations without touching the file
+    etag = attachment['checksum']
+    last_modified = attachment['uploaded_at']
+    if etag and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    
+    if app.config['ATTACHMENT_OFFLOAD'] == 'x-accel':
+        # Permission is checked; let nginx stream the file (and handle Range) itself
+        response = app.response_class(mimetype=mimetypes.guess_type(attachment['original_filename'])[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = app.config['ATTACHMENT_ACCEL_PREFIX'].rstrip('/') + '/' + attachment['filename']
+        response.headers.set('Content-Disposition', 'attachment', filename=attachment['original_filename'])
+    else:
+        # Serves byte ranges and 304s itself; with USE_X_SENDFILE the body is
+        # handed to the front web server instead
+        response = send_from_directory(
+            app.config['ATTACHMENTS_FOLDER'],
+            attachment['filename'],
+            as_attachment=True,
+            download_name=attachment['original_filename'],
+            etag=etag or True,
+            last_modified=last_modified,
+            conditional=True
+        )
+        response.accept_ranges = 'bytes'
+    
+    if etag:
+        response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    # Offloaded bodies are sent by the front server, but still count them
+    if response.status_code == 206:
+        count_download('attachment', response.content_length)
+    elif response.status_code == 200:
+        count_download('attachment', attachment['file_size'])
+    return response
 
 
 @app.route('/attachments/<int:attachment_id>/delete', methods=['POST'])
 @login_required
 def delete_attachment(attachment_id):
-		"""Delete an attachment"""
-		conn = get_db_connection()
-		cur = conn.cursor()
-		
-		# Get attachment and note info
-		cur.execute(
-				'SELECT a.filename, a.note_id, n.user_id FROM attachments a JOIN notes n ON a.note_id = n.id WHERE a.id = %s',
-				(attachment_id,)
-		)
-		attachment = cur.fetchone()
-		
-		if not attachment:
-				cur.close()
-				conn.close()
-				flash('Attachment not found', 'error')
-				return redirect(url_for('notes'))
-		
-		# Check if user owns the note this attachment belongs to
-		if attachment['user_id'] != session['user_id']:
-				cur.close()
-				conn.close()
-				flash('You do not have permission to delete this attachment', 'error')
-				return redirect(url_for('notes'))
-		
-		# Delete file from disk
-		file_path = os.path.join(app.config['ATTACHMENTS_FOLDER'], attachment['filename'])
-		if os.path.exists(file_path):
-				os.remove(file_path)
-		
-		# Delete from database
-		cur.execute('DELETE FROM attachments WHERE id = %s', (attachment_id,))
-		conn.commit()
-		cur.close()
-		conn.close()
-		
-		flash('Attachment deleted successfully!', 'success')
-		return redirect(url_for('view_note', note_id=attachment['note_id']))
+    """Delete an attachment"""
+    conn = get_db()
+    cur = conn.cursor()
+    
+    # Ownership check, delete, version bump and the release_blobs job for the
+    # stored file, in one statement
+    result = repository.delete_attachment(cur, attachment_id, session['user_id'])
+    conn.commit()
+    cur.close()
+    
+    if not result:
+        flash('Attachment not found', 'error')
+        return redirect(url_for('notes'))
+    
+    if not result['done']:
+        flash('You do not have permission to delete this attachment', 'error')
+        return redirect(url_for('notes'))
+    
+    flash('Attachment deleted successfully!', 'success')
+    return redirect(url_for('view_note', note_id=result['note_id']))
 
 
 if __name__ == '__main__':
-		app.run(debug=True)
+    app.run(debug=True)
 
@@ -0,0 +1,168 @@
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import sys
+from pathlib import Path
+
+from flask import request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+from config import Config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+# Fingerprinted copies of the static files, served under /assets/
+BUILD_FOLDER = os.path.join(STATIC_FOLDER, 'build')
+MANIFEST = os.path.join(BUILD_FOLDER, 'manifest.json')
+
+# User uploads live under static/ too but are not site assets
+SKIP_DIRS = {'attachments', 'avatars', 'build'}
+
+# Text formats worth storing gzip and brotli variants of
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.map', '.txt', '.xml'}
+
+# Preferred first when a browser accepts both
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Hex digits of the content hash put in fingerprinted names
+HASH_LENGTH = 12
+
+_manifest = {}
+
+
+def source_files(static_folder=STATIC_FOLDER):
+    """Every site asset under static/, as paths relative to it"""
+    for path in sorted(Path(static_folder).rglob('*')):
+        relative = path.relative_to(static_folder)
+        if not path.is_file() or relative.parts[0] in SKIP_DIRS or path.name.startswith('.'):
+            continue
+        yield relative.as_posix()
+
+
+def _write(path, data):
+    """Write a file atomically, so a server reading it never sees it half-written"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _write_smaller(path, compressed, original):
+    """Keep a compressed variant only if it actually saves bytes"""
+    if len(compressed) < len(original):
+        _write(path, compressed)
+
+
+def build(static_folder=STATIC_FOLDER, build_folder=BUILD_FOLDER):
+    """Write a content-hashed copy of every asset, plus gzip and brotli variants, and the manifest
+    
+    Files from earlier builds are left in place so pages that still reference
+    them (in browser caches or the profile cache) keep working. Returns the
+    manifest, which maps each source path to its fingerprinted name.
+    """
+    manifest = {}
+    for name in source_files(static_folder):
+        data = Path(static_folder, name).read_bytes()
+        stem, ext = os.path.splitext(name)
+        hashed = f'{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}'
+        target = os.path.join(build_folder, hashed)
+        manifest[name] = hashed
+        # A name is its content, so files that already exist never need rewriting
+        if ext in COMPRESSIBLE:
+            if not os.path.exists(target + '.gz'):
+                _write_smaller(target + '.gz', gzip.compress(data, compresslevel=9, mtime=0), data)
+            if brotli is not None and not os.path.exists(target + '.br'):
+                _write_smaller(target + '.br', brotli.compress(data, quality=11), data)
+        if not os.path.exists(target):
+            _write(target, data)
+    _write(os.path.join(build_folder, 'manifest.json'), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+def _stale():
+    """Whether any asset changed since the manifest was written"""
+    if not os.path.exists(MANIFEST):
+        return True
+    built_at = os.path.getmtime(MANIFEST)
+    return any(os.path.getmtime(os.path.join(STATIC_FOLDER, name)) > built_at for name in source_files())
+
+
+def load_manifest():
+    global _manifest
+    try:
+        with open(MANIFEST) as f:
+            _manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning('No asset manifest (%s); serving static files without fingerprints', e)
+        _manifest = {}
+    return _manifest
+
+
+def fingerprint():
+    """Digest of the current manifest, which changes whenever any asset does"""
+    return hashlib.sha256(json.dumps(_manifest, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def asset_url(filename):
+    """URL of the fingerprinted build of a static file, or its plain static URL if it has none"""
+    hashed = _manifest.get(filename)
+    if hashed is None:
+        return url_for('static', filename=filename)
+    return url_for('assets', filename=hashed)
+
+
+def serve_asset(filename):
+    """Serve a fingerprinted asset, precompressed when the browser accepts it, cached for good"""
+    path = safe_join(BUILD_FOLDER, filename)
+    encoding = suffix = None
+    if path is not None:
+        for candidate, candidate_suffix in ENCODINGS:
+            if request.accept_encodings[candidate] and os.path.isfile(path + candidate_suffix):
+                encoding, suffix = candidate, candidate_suffix
+                break
+    response = send_from_directory(
+        BUILD_FOLDER,
+        filename + (suffix or ''),
+        mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        max_age=Config.ASSETS_MAX_AGE,
+        conditional=True
+    )
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    # A fingerprinted URL never changes content, so it is never revalidated
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def init_app(app):
+    """Build assets if they changed (unless ASSETS_AUTO_BUILD is off) and serve them on /assets"""
+    if Config.ASSETS_AUTO_BUILD and _stale():
+        build()
+    load_manifest()
+    app.add_url_rule('/assets/<path:filename>', 'assets', serve_asset)
+    app.jinja_env.globals.update(asset_url=asset_url)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['build']:
+        print('Usage: python assets.py build')
+        sys.exit(2)
+    
+    manifest = build()
+    for name, hashed in sorted(manifest.items()):
+        variants = [suffix for _, suffix in ENCODINGS if os.path.exists(os.path.join(BUILD_FOLDER, hashed + suffix))]
+        print(f'{name} -> {hashed}' + (f' ({", ".join(variants)})' if variants else ''))
+    if brotli is None:
+        print('brotli is not installed; only gzip variants were written (pip install brotli)')
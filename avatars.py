@@ -0,0 +1,133 @@
+import hashlib
+import io
+import os
+import re
+import sys
+
+from flask import url_for
+from PIL import Image, ImageOps
+
+from cache import invalidate_profile
+
+# Square sizes generated for every avatar: 80px user cards and the 150px
+# profile header, each with a 2x variant for high-density screens
+AVATAR_SIZES = (80, 160, 300)
+
+# Processed avatars are stored as user_<id>_<digest>-<size>.<webp|jpg|png> and
+# users.avatar holds user_<id>_<digest>.<jpg|png>. The content digest in the
+# name changes with every new image, so browsers never see a stale avatar.
+# Anything else in users.avatar is a legacy full-size upload.
+PROCESSED_AVATAR = re.compile(r'^(user_\d+_[0-9a-f]{12})\.(jpg|png)$')
+
+
+class InvalidAvatar(Exception):
+    """Raised when an uploaded avatar cannot be decoded as an image"""
+
+
+def process_avatar(stream, folder, user_id):
+    """Resize an uploaded image into every avatar size, as WebP plus JPEG/PNG
+    
+    Returns the value to store in users.avatar.
+    """
+    data = stream.read()
+    stem = f'user_{user_id}_{hashlib.sha256(data).hexdigest()[:12]}'
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.seek(0)
+        image = ImageOps.exif_transpose(image)
+        # Keep transparency (PNG fallback) only when the upload actually has some
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise InvalidAvatar(str(e)) from e
+    ext = 'png' if has_alpha else 'jpg'
+    
+    for size in AVATAR_SIZES:
+        thumb = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        thumb.save(os.path.join(folder, f'{stem}-{size}.webp'), 'WEBP', quality=80, method=4)
+        if has_alpha:
+            thumb.save(os.path.join(folder, f'{stem}-{size}.png'), 'PNG', optimize=True)
+        else:
+            thumb.save(os.path.join(folder, f'{stem}-{size}.jpg'), 'JPEG', quality=85, optimize=True, progressive=True)
+    return f'{stem}.{ext}'
+
+
+def avatar_files(avatar):
+    """Every file on disk belonging to a users.avatar value"""
+    match = PROCESSED_AVATAR.match(avatar or '')
+    if not match:
+        return [avatar] if avatar else []
+    stem, ext = match.groups()
+    return [f'{stem}-{size}.{fmt}' for size in AVATAR_SIZES for fmt in ('webp', ext)]
+
+
+def remove_avatar(folder, avatar):
+    """Delete the files of an avatar that is no longer in use"""
+    for filename in avatar_files(avatar):
+        path = os.path.join(folder, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def avatar_url(avatar, size, fmt=None):
+    """URL of the smallest stored variant at least size pixels wide
+    
+    Legacy avatars only exist at their original size, which is returned as is.
+    """
+    match = PROCESSED_AVATAR.match(avatar or '')
+    if not match:
+        return url_for('static', filename='avatars/' + avatar)
+    stem, ext = match.groups()
+    stored = next((s for s in AVATAR_SIZES if s >= size), AVATAR_SIZES[-1])
+    return url_for('static', filename=f'avatars/{stem}-{stored}.{fmt or ext}')
+
+
+def avatar_srcset(avatar, size, fmt=None):
+    """srcset with 1x and 2x variants for an avatar displayed at size pixels"""
+    return f'{avatar_url(avatar, size, fmt)} 1x, {avatar_url(avatar, size * 2, fmt)} 2x'
+
+
+def is_processed_avatar(avatar):
+    """Whether an avatar has been resized into AVATAR_SIZES (rather than a legacy upload)"""
+    return bool(PROCESSED_AVATAR.match(avatar or ''))
+
+
+def backfill_avatars(conn, folder):
+    """Process every legacy full-size avatar into sized variants
+    
+    Returns (converted, failed) counts; failed avatars are left untouched.
+    """
+    cur = conn.cursor()
+    cur.execute('SELECT id, avatar FROM users WHERE avatar IS NOT NULL ORDER BY id')
+    legacy = [row for row in cur.fetchall() if not is_processed_avatar(row['avatar'])]
+    converted = failed = 0
+    for row in legacy:
+        path = os.path.join(folder, row['avatar'])
+        try:
+            with open(path, 'rb') as f:
+                avatar = process_avatar(f, folder, row['id'])
+        except (OSError, InvalidAvatar) as e:
+            print(f'Skipping avatar of user {row["id"]} ({row["avatar"]}): {e}')
+            failed += 1
+            continue
+        cur.execute('UPDATE users SET avatar = %s WHERE id = %s', (avatar, row['id']))
+        conn.commit()
+        invalidate_profile(row['id'])
+        os.remove(path)
+        converted += 1
+    cur.close()
+    return converted, failed
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['backfill']:
+        print('Usage: python avatars.py backfill')
+        sys.exit(2)
+    
+    from app import UPLOAD_FOLDER
+    from database import get_db_connection
+    
+    conn = get_db_connection()
+    converted, failed = backfill_avatars(conn, UPLOAD_FOLDER)
+    conn.close()
+    print(f'Converted {converted} avatars ({failed} could not be processed)')
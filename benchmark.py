@@ -0,0 +1,364 @@
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+from database import get_db_connection
+from seed import seed_dataset, SEED_USERNAME_PATTERN, SEED_PASSWORD
+
+# Relative weight of each route in the request mix; edit, delete only ever
+# touch notes the benchmark created itself, so the seeded data stays as it was
+DEFAULT_MIX = {
+    'login': 1,
+    'notes': 20,
+    'note': 20,
+    'users': 5,
+    'user': 15,
+    'search': 5,
+    'create': 5,
+    'edit': 5,
+    'delete': 4,
+    'download': 10,
+}
+
+# Notes and attachments of its seed user each virtual user picks from
+SAMPLE_NOTES = 50
+SAMPLE_ATTACHMENTS = 5
+
+# Seeded attachment rows have no file; downloads are given one of at most this size
+MAX_ATTACHMENT_FILE = 256 * 1024
+
+# Scratch attachment store for those files, so they never land among real
+# uploads; the server under test is started with ATTACHMENTS_FOLDER set to it
+DEFAULT_ATTACHMENTS_FOLDER = os.path.join(tempfile.gettempdir(), 'vibenotes-benchmark-attachments')
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+class Client:
+    """One virtual user: a keep-alive HTTP connection with its own session cookie"""
+    
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        self.prefix = parts.path.rstrip('/')
+        self.cookies = SimpleCookie()
+    
+    def request(self, method, path, form=None):
+        """Send a request and read the whole body; returns (status, headers)"""
+        headers = {}
+        body = None
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{name}={morsel.value}' for name, morsel in self.cookies.items())
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            self.conn.request(method, self.prefix + path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            response.read()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()
+            raise
+        for value in response.headers.get_all('Set-Cookie') or []:
+            self.cookies.load(value)
+        return response.status, response.headers
+    
+    def close(self):
+        self.conn.close()
+
+
+class VirtualUser:
+    """Runs the weighted route mix as one seeded user"""
+    
+    def __init__(self, url, sample, rng):
+        self.client = Client(url)
+        self.sample = sample
+        self.rng = rng
+        self.created = []
+    
+    def login(self):
+        status, _ = self.client.request('POST', '/login', {'username': self.sample['username'], 'password': SEED_PASSWORD})
+        return status == 302
+    
+    def notes(self):
+        status, _ = self.client.request('GET', '/notes')
+        return status == 200
+    
+    def note(self):
+        status, _ = self.client.request('GET', f'/notes/{self.rng.choice(self.sample["note_ids"])}')
+        return status == 200
+    
+    def users(self):
+        status, _ = self.client.request('GET', '/users')
+        return status == 200
+    
+    def user(self):
+        status, _ = self.client.request('GET', f'/user/{self.rng.choice(self.sample["user_ids"])}')
+        return status == 200
+    
+    def search(self):
+        status, _ = self.client.request('GET', '/search?' + urlencode({'q': self.rng.choice(self.sample['words'])}))
+        return status == 200
+    
+    def create(self):
+        status, headers = self.client.request('POST', '/notes/create', self._note_form())
+        if status != 302:
+            return False
+        location = headers.get('Location', '')
+        note_id = location.rstrip('/').rsplit('/', 1)[-1]
+        if not note_id.isdigit():
+            return False
+        self.created.append(int(note_id))
+        return True
+    
+    def edit(self):
+        if not self.created:
+            return self.create()
+        status, _ = self.client.request('POST', f'/notes/{self.rng.choice(self.created)}/edit', self._note_form())
+        return status == 302
+    
+    def delete(self):
+        if not self.created:
+            return self.create()
+        note_id = self.created.pop(self.rng.randrange(len(self.created)))
+        status, _ = self.client.request('POST', f'/notes/{note_id}/delete')
+        return status == 302
+    
+    def download(self):
+        if not self.sample['attachment_ids']:
+            return self.note()
+        status, _ = self.client.request('GET', f'/attachments/{self.rng.choice(self.sample["attachment_ids"])}/download')
+        return status == 200
+    
+    def _note_form(self):
+        words = ' '.join(self.rng.choice(self.sample['words']) for _ in range(self.rng.randint(10, 600)))
+        return {
+            'title': f'Benchmark note {self.rng.getrandbits(32):08x}',
+            'content': words,
+            'is_public': 'true' if self.rng.random() < 0.2 else 'false',
+        }
+    
+    def cleanup(self):
+        """Delete the notes this user created and close the connection (not measured)"""
+        for note_id in self.created:
+            try:
+                self.client.request('POST', f'/notes/{note_id}/delete')
+            except (http.client.HTTPException, OSError):
+                pass
+        self.created = []
+        self.client.close()
+
+
+def load_samples(conn, count, attachments_folder):
+    """Pick a seeded user for each virtual user, with ids and search words to request
+    
+    Gives the sampled seed attachments a file in attachments_folder, since
+    the seed only inserts their rows.
+    """
+    cur = conn.cursor()
+    cur.execute('SELECT id, username FROM users WHERE username LIKE %s ORDER BY id', (SEED_USERNAME_PATTERN,))
+    users = cur.fetchall()
+    if not users:
+        cur.close()
+        raise SystemExit('No seeded users; run with --seed (or python seed.py) first')
+    user_ids = [user['id'] for user in users]
+    samples = []
+    for i in range(count):
+        user = users[i % len(users)]
+        cur.execute('SELECT id, title FROM notes WHERE user_id = %s ORDER BY id LIMIT %s', (user['id'], SAMPLE_NOTES))
+        notes = cur.fetchall()
+        cur.execute(
+            '''
+            SELECT a.id, a.filename, a.file_size FROM attachments a JOIN notes n ON n.id = a.note_id
+            WHERE n.user_id = %s ORDER BY a.id LIMIT %s
+            ''',
+            (user['id'], SAMPLE_ATTACHMENTS)
+        )
+        attachments = cur.fetchall()
+        for attachment in attachments:
+            path = os.path.join(attachments_folder, attachment['filename'])
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(b'x' * min(attachment['file_size'] or 0, MAX_ATTACHMENT_FILE))
+        samples.append({
+            'username': user['username'],
+            'note_ids': [note['id'] for note in notes],
+            'attachment_ids': [attachment['id'] for attachment in attachments],
+            'user_ids': user_ids,
+            'words': [note['title'].split()[-1] for note in notes] or ['note'],
+        })
+    cur.close()
+    return samples
+
+
+def run(url, samples, mix, duration, warmup, random_seed):
+    """Drive the mix from one thread per sample; returns ({route: [ms, ...]}, {route: errors}, seconds)"""
+    routes = [route for route in mix if mix[route] > 0]
+    weights = [mix[route] for route in routes]
+    latencies = {route: [] for route in routes}
+    errors = {route: 0 for route in routes}
+    lock = threading.Lock()
+    window = {}
+    
+    def start_window():
+        window['start'] = time.monotonic() + warmup
+        window['end'] = window['start'] + duration
+    
+    # Everyone logs in first; the clock starts once all are ready
+    ready = threading.Barrier(len(samples) + 1, action=start_window)
+    
+    def worker(index, sample):
+        vu = VirtualUser(url, sample, random.Random(random_seed + index))
+        try:
+            logged_in = vu.login()
+        except (http.client.HTTPException, OSError):
+            logged_in = False
+        ready.wait()
+        if not logged_in:
+            with lock:
+                errors['login'] = errors.get('login', 0) + 1
+            vu.cleanup()
+            return
+        try:
+            while time.monotonic() < window['end']:
+                route = vu.rng.choices(routes, weights)[0]
+                started = time.perf_counter()
+                try:
+                    ok = getattr(vu, route)()
+                except (http.client.HTTPException, OSError):
+                    ok = False
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                if time.monotonic() < window['start']:
+                    continue
+                with lock:
+                    if ok:
+                        latencies[route].append(elapsed_ms)
+                    else:
+                        errors[route] += 1
+        finally:
+            vu.cleanup()
+    
+    threads = [threading.Thread(target=worker, args=(i, sample), daemon=True) for i, sample in enumerate(samples)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, duration
+
+
+def summarize(latencies, errors, seconds):
+    """Per-route and total throughput and latency percentiles (ms)"""
+    def stats(values, error_count):
+        values = sorted(values)
+        return {
+            'requests': len(values),
+            'errors': error_count,
+            'rps': round(len(values) / seconds, 1),
+            'p50': round(percentile(values, 50), 2) if values else None,
+            'p95': round(percentile(values, 95), 2) if values else None,
+            'p99': round(percentile(values, 99), 2) if values else None,
+        }
+    routes = {route: stats(latencies.get(route, []), errors.get(route, 0)) for route in sorted(set(latencies) | set(errors))}
+    total = stats([ms for values in latencies.values() for ms in values], sum(errors.values()))
+    return routes, total
+
+
+def _ms(value):
+    return f'{value:8.1f}' if value is not None else '       -'
+
+
+def print_report(routes, total, baseline=None):
+    header = f'{"route":<10} {"reqs":>7} {"errs":>5} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}'
+    if baseline:
+        header += f' {"base p95":>8} {"change":>8}'
+    print(header)
+    for route, row in list(routes.items()) + [('TOTAL', total)]:
+        line = f'{route:<10} {row["requests"]:>7} {row["errors"]:>5} {row["rps"]:>8.1f} {_ms(row["p50"])} {_ms(row["p95"])} {_ms(row["p99"])}'
+        if baseline:
+            base = baseline['total'] if route == 'TOTAL' else baseline['routes'].get(route)
+            if base and base.get('p95') and row['p95'] is not None:
+                line += f' {_ms(base["p95"])} {(row["p95"] / base["p95"] - 1) * 100:+7.1f}%'
+        print(line)
+
+
+def parse_mix(text):
+    mix = dict(DEFAULT_MIX)
+    if text:
+        mix = {route: 0 for route in DEFAULT_MIX}
+        for item in text.split(','):
+            route, _, weight = item.partition('=')
+            if route not in DEFAULT_MIX:
+                raise SystemExit(f'Unknown route {route!r}; choose from {", ".join(DEFAULT_MIX)}')
+            mix[route] = float(weight or 1)
+    return mix
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load-test a running VibeNotes server with seeded users')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='server to drive (default: %(default)s)')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='virtual users, one thread each')
+    parser.add_argument('-d', '--duration', type=float, default=30, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=5, help='unmeasured seconds before measuring')
+    parser.add_argument('--mix', help='route weights, e.g. "notes=3,note=1" (default: the built-in mix)')
+    parser.add_argument('--random-seed', type=int, default=1, help='seed for the request sequence of each virtual user')
+    parser.add_argument('--seed', action='store_true', help='insert a synthetic dataset first (see seed.py)')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--notes-per-user', type=int, default=200)
+    parser.add_argument(
+        '--attachments-folder', default=DEFAULT_ATTACHMENTS_FOLDER,
+        help="where the seeded attachments' files are written; must be the server's ATTACHMENTS_FOLDER (default: %(default)s)"
+    )
+    parser.add_argument('--save', metavar='FILE', help='write the results as JSON, to compare later runs against')
+    parser.add_argument('--compare', metavar='FILE', help='show the p95 change against a saved baseline')
+    args = parser.parse_args()
+    
+    mix = parse_mix(args.mix)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    
+    conn = get_db_connection()
+    if args.seed:
+        print('Seeded {} users, {} notes, {} attachments'.format(
+            *seed_dataset(conn, users=args.users, notes_per_user=args.notes_per_user)
+        ))
+    samples = load_samples(conn, args.concurrency, args.attachments_folder)
+    conn.close()
+    
+    print(f'Driving {args.url} with {args.concurrency} virtual users for {args.duration:g}s (after {args.warmup:g}s warm-up)')
+    latencies, errors, seconds = run(args.url, samples, mix, args.duration, args.warmup, args.random_seed)
+    routes, total = summarize(latencies, errors, seconds)
+    print_report(routes, total, baseline)
+    
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'url': args.url,
+                'concurrency': args.concurrency,
+                'duration': args.duration,
+                'mix': mix,
+                'routes': routes,
+                'total': total,
+            }, f, indent=2)
+        print(f'Saved results to {args.save}')
+    sys.exit(1 if total['requests'] == 0 else 0)
@@ -0,0 +1,149 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from config import Config
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryCache:
+    """Thread-safe in-process LRU cache whose entries expire after ttl seconds
+    
+    Counters live outside the LRU so they are never evicted: a generation
+    counter that silently reset to zero could bring old entries back.
+    """
+    
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._counters = {}
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def counter(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+    
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+
+class RedisCache:
+    """Cache shared by every worker through Redis, for multi-process deployments
+    
+    A Redis outage degrades to cache misses rather than failed requests.
+    """
+    
+    def __init__(self, url, ttl=300):
+        if redis is None:
+            raise RuntimeError('CACHE_BACKEND=redis requires the redis package (pip install redis)')
+        self.ttl = ttl
+        self._client = redis.Redis.from_url(url)
+    
+    def get(self, key):
+        try:
+            value = self._client.get(key)
+        except redis.RedisError as e:
+            logger.warning('Cache read failed: %s', e)
+            return None
+        return value.decode() if value is not None else None
+    
+    def set(self, key, value):
+        try:
+            self._client.set(key, value, ex=self.ttl)
+        except redis.RedisError as e:
+            logger.warning('Cache write failed: %s', e)
+    
+    def counter(self, key):
+        try:
+            return int(self._client.get(key) or 0)
+        except redis.RedisError as e:
+            logger.warning('Cache read failed: %s', e)
+            return 0
+    
+    def incr(self, key):
+        try:
+            return self._client.incr(key)
+        except redis.RedisError as e:
+            logger.warning('Cache invalidation failed, entries may be stale for up to %ss: %s', self.ttl, e)
+            return None
+
+
+class NullCache:
+    """Cache that stores nothing, used when CACHE_BACKEND is 'none'"""
+    
+    def get(self, key):
+        return None
+    
+    def set(self, key, value):
+        pass
+    
+    def counter(self, key):
+        return 0
+    
+    def incr(self, key):
+        return 0
+
+
+_cache = None
+_cache_pid = None
+
+
+def get_cache():
+    """Return the configured cache backend, created on first use in each process"""
+    global _cache, _cache_pid
+    if _cache is None or _cache_pid != os.getpid():
+        if Config.CACHE_BACKEND == 'redis':
+            _cache = RedisCache(Config.CACHE_URL, ttl=Config.CACHE_TTL)
+        elif Config.CACHE_BACKEND == 'none':
+            _cache = NullCache()
+        else:
+            _cache = MemoryCache(max_entries=Config.CACHE_MAX_ENTRIES, ttl=Config.CACHE_TTL)
+        _cache_pid = os.getpid()
+    return _cache
+
+
+def profile_cache_key(user_id, *parts):
+    """Cache key for a rendering of a user's public profile
+    
+    The key embeds the user's current generation, so invalidate_profile makes
+    every cached page of that profile unreachable at once. Read it before
+    querying the data to be cached: a render racing with an invalidation is
+    then stored under the old generation and never served.
+    """
+    generation = get_cache().counter(f'profile-generation:{user_id}')
+    return ':'.join(['profile', str(user_id), str(generation)] + [part or '' for part in parts])
+
+
+def invalidate_profile(user_id):
+    """Drop every cached rendering of a user's public profile; call after committing the change"""
+    get_cache().incr(f'profile-generation:{user_id}')
@@ -0,0 +1,113 @@
+import zlib
+
+from flask import request
+from config import Config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses worth compressing on the fly; files (attachments, /assets) and
+# exports are sent as they are
+COMPRESSIBLE_MIMETYPES = {'text/html', 'text/plain', 'text/css', 'application/json'}
+
+
+class _Gzip:
+    def __init__(self, level):
+        # wbits 31: zlib deflate with a gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    
+    def compress(self, data):
+        return self._compressor.compress(data)
+    
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+    
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class _Brotli:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+    
+    def compress(self, data):
+        return self._compressor.process(data)
+    
+    def flush(self):
+        return self._compressor.flush()
+    
+    def finish(self):
+        return self._compressor.finish()
+
+
+def _choose_encoding():
+    """The best encoding the client accepts: brotli if installed, else gzip, else None"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def _compressor(encoding):
+    if encoding == 'br':
+        return _Brotli(Config.COMPRESS_BROTLI_QUALITY)
+    return _Gzip(Config.COMPRESS_GZIP_LEVEL)
+
+
+def _compress_stream(chunks, compressor):
+    """Compress a streamed body chunk by chunk, flushing each so the client can render it at once"""
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if chunk:
+                yield compressor.compress(chunk) + compressor.flush()
+        yield compressor.finish()
+    finally:
+        # Closing this generator does not close the one it wraps
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response):
+    """Compress a text response for clients that accept gzip or brotli, streamed or not"""
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or 'Content-Encoding' in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+        or request.method == 'HEAD'
+    ):
+        return response
+    
+    # The body differs per Accept-Encoding even when this client gets it plain
+    response.vary.add('Accept-Encoding')
+    encoding = _choose_encoding()
+    if encoding is None:
+        return response
+    
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, _compressor(encoding))
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < Config.COMPRESS_MIN_SIZE:
+            return response
+        compressor = _compressor(encoding)
+        response.set_data(compressor.compress(data) + compressor.finish())
+    response.content_encoding = encoding
+    # A strong validator promises identical bytes, which no longer holds
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    """Compress text responses on the fly (COMPRESS_RESPONSES), including streamed pages"""
+    if Config.COMPRESS_RESPONSES:
+        app.after_request(compress_response)
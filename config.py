@@ -5,13 +5,102 @@ load_dotenv()
 
 
 class Config:
-		"""Application configuration"""
-		SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key')
-		
-		# Database configuration
-		DB_HOST = os.getenv('DB_HOST', 'localhost')
-		DB_PORT = os.getenv('DB_PORT', '5432')
-		DB_USER = os.getenv('DB_USER', 'postgres')
-		DB_PASSWORD = os.getenv('DB_PASSWORD', 'password')
-		DB_NAME = os.getenv('DB_NAME', 'vibenotes1')
-
+    """Application configuration"""
+    SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key')
+    
+    # Database configuration
+    DB_HOST = os.getenv('DB_HOST', 'localhost')
+    DB_PORT = os.getenv('DB_PORT', '5432')
+    DB_USER = os.getenv('DB_USER', 'postgres')
+    DB_PASSWORD = os.getenv('DB_PASSWORD', 'password')
+    DB_NAME = os.getenv('DB_NAME', 'vibenotes1')
+    
+    # Connection pool configuration
+    DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+    DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+    DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))  # seconds to wait for a free connection
+    DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', '1800'))  # seconds before a connection is recycled
+    DB_POOL_HEALTH_CHECK_INTERVAL = float(os.getenv('DB_POOL_HEALTH_CHECK_INTERVAL', '30'))  # idle seconds before re-checking
+    
+    # Read replicas: comma-separated libpq DSNs or postgresql:// URIs. Read-only
+    # views use a replica lagging at most DB_REPLICA_MAX_LAG seconds (checked
+    # every DB_REPLICA_CHECK_INTERVAL), except for READ_YOUR_WRITES_SECONDS
+    # after a session changed something, when they read from the primary
+    DB_REPLICA_URLS = [url.strip() for url in os.getenv('DB_REPLICA_URLS', '').split(',') if url.strip()]
+    DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', '5'))
+    DB_REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', '5'))
+    READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', '10'))
+    
+    # Slow-query log: statements slower than SLOW_QUERY_MS (0 disables) are
+    # logged with their route; a SLOW_QUERY_EXPLAIN_SAMPLE fraction of slow
+    # SELECTs is planned again under EXPLAIN (never executed) to log the plan
+    SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '200'))
+    SLOW_QUERY_EXPLAIN_SAMPLE = float(os.getenv('SLOW_QUERY_EXPLAIN_SAMPLE', '0'))
+    QUERY_BUDGET = int(os.getenv('QUERY_BUDGET', '20'))  # queries per request before a warning, 0 disables
+    
+    # Number of notes shown per page on the notes list and profile pages
+    NOTES_PAGE_SIZE = int(os.getenv('NOTES_PAGE_SIZE', '20'))
+    
+    # Attachment downloads: '' serves files from Flask, 'x-accel' hands them to
+    # nginx via X-Accel-Redirect, 'x-sendfile' to Apache/lighttpd via X-Sendfile
+    ATTACHMENT_OFFLOAD = os.getenv('ATTACHMENT_OFFLOAD', '')
+    # Internal nginx location aliased to static/attachments (x-accel mode only)
+    ATTACHMENT_ACCEL_PREFIX = os.getenv('ATTACHMENT_ACCEL_PREFIX', '/protected-attachments/')
+    # Where attachment files are stored (load tests point it at a scratch folder)
+    ATTACHMENTS_FOLDER = os.getenv(
+        'ATTACHMENTS_FOLDER', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'attachments')
+    )
+    
+    # Fingerprinted static assets (python assets.py build) served on /assets
+    # with far-future immutable caching; unless turned off, the app rebuilds
+    # them at startup when a file under static/ changed
+    ASSETS_AUTO_BUILD = os.getenv('ASSETS_AUTO_BUILD', 'true').lower() == 'true'
+    ASSETS_MAX_AGE = int(os.getenv('ASSETS_MAX_AGE', '31536000'))  # one year
+    
+    # Long list pages (users, notes, own profile) are streamed while they
+    # render, and HTML/JSON/text responses are gzip or brotli (needs the
+    # brotli package) compressed on the fly, streamed ones chunk by chunk
+    STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', '8192'))  # characters of HTML per chunk sent
+    STREAM_CURSOR_ITERSIZE = int(os.getenv('STREAM_CURSOR_ITERSIZE', '500'))  # rows per server-side cursor fetch
+    COMPRESS_RESPONSES = os.getenv('COMPRESS_RESPONSES', 'true').lower() == 'true'
+    COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))  # smaller buffered responses go out as they are
+    COMPRESS_GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL', '6'))
+    COMPRESS_BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', '5'))
+    
+    # Cache for rendered public profiles: 'memory' (per worker process),
+    # 'redis' (shared by all workers, needs the redis package) or 'none'
+    CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memory')
+    CACHE_URL = os.getenv('CACHE_URL', 'redis://localhost:6379/0')
+    CACHE_TTL = int(os.getenv('CACHE_TTL', '300'))  # seconds an entry may be served
+    CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '1024'))  # memory backend only
+    
+    # Password hashing: werkzeug method string (e.g. 'scrypt' or
+    # 'pbkdf2:sha256:600000'); stored hashes made with other parameters are
+    # upgraded at the next login
+    PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt')
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))  # worker processes per app process, 0 hashes inline
+    PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv('PASSWORD_HASH_QUEUE_LIMIT', '8'))  # hashes running or waiting before a 503
+    PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', '5'))  # seconds a request waits for its hash
+    
+    # JSON API (/api/v1) limits
+    API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE', '200'))  # largest ?limit= honoured on listings
+    API_BULK_LIMIT = int(os.getenv('API_BULK_LIMIT', '1000'))  # notes per bulk create/update/delete request
+    API_MAX_NOTE_EDITS = int(os.getenv('API_MAX_NOTE_EDITS', '1000'))  # content edits per PATCH /api/v1/notes/<id>
+    
+    # Exports stream over their own database connection each; further export
+    # requests in a process get the busy page until one finishes
+    EXPORT_MAX_CONCURRENT = int(os.getenv('EXPORT_MAX_CONCURRENT', '2'))
+    
+    # Background jobs (python jobs.py worker): file cleanup after deletes and
+    # a periodic sweep removing files the database no longer refers to
+    JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '10'))  # seconds between polls when no NOTIFY arrives
+    JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '600'))  # before a dead worker's job is run again
+    JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+    SWEEP_INTERVAL = int(os.getenv('SWEEP_INTERVAL', '86400'))  # seconds between sweeps
+    SWEEP_GRACE_SECONDS = int(os.getenv('SWEEP_GRACE_SECONDS', '3600'))  # files younger than this are never swept
+    SWEEP_BATCH_SIZE = int(os.getenv('SWEEP_BATCH_SIZE', '500'))  # files checked per query
+    
+    # Request, query and template timings served on /metrics for Prometheus;
+    # with METRICS_TOKEN set, scrapes must send "Authorization: Bearer <token>"
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules are flat files in the repository root; make them importable
+# however pytest is started
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -1,122 +1,584 @@
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from functools import partial
+
 import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, parse_dsn
 from psycopg2.extras import RealDictCursor
+from flask import g, has_request_context, request, session
 from config import Config
 
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes free within the wait timeout"""
+
+
+def normalize_sql(query):
+    """Statement text with literals replaced by ? and whitespace collapsed, for grouping in logs"""
+    if isinstance(query, bytes):
+        query = query.decode(errors='replace')
+    query = re.sub(r"'(?:[^']|'')*'", '?', str(query))
+    query = re.sub(r'\b\d+(?:\.\d+)?\b', '?', query)
+    query = re.sub(r'\s+', ' ', query).strip()
+    # Multi-row VALUES lists (execute_values) collapse to their first row
+    return re.sub(r'(\([^()]*\))(?:\s*,\s*\([^()]*\))+', r'\1, ...', query)
+
+
+def _route():
+    return (request.endpoint or request.path) if has_request_context() else 'cli'
+
+
+class TimedCursor(RealDictCursor):
+    """RealDictCursor that times every statement
+    
+    Count and time, including the fetches of named cursors, are added up per
+    request (for metrics.py and the query budget); statements slower than
+    SLOW_QUERY_MS are logged with their route, and a SLOW_QUERY_EXPLAIN_SAMPLE
+    fraction of slow SELECTs is planned again under plain EXPLAIN to log the
+    plan.
+    """
+    
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._record(query, vars, time.perf_counter() - started)
+    
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._record(query, None, time.perf_counter() - started)
+    
+    def __iter__(self):
+        if not self.name:
+            yield from super().__iter__()
+            return
+        # A named (server-side) cursor fetches itersize rows per round trip,
+        # usually while a page streams; each fetch counts as a query
+        while True:
+            started = time.perf_counter()
+            try:
+                rows = self.fetchmany(self.itersize)
+            finally:
+                self._record(f'FETCH FORWARD {self.itersize} FROM {self.name}', None, time.perf_counter() - started)
+            yield from rows
+            if len(rows) < self.itersize:
+                return
+    
+    def _record(self, query, vars, elapsed):
+        if has_request_context():
+            g.db_queries = g.get('db_queries', 0) + 1
+            g.db_seconds = g.get('db_seconds', 0.0) + elapsed
+        if Config.SLOW_QUERY_MS <= 0 or elapsed * 1000 < Config.SLOW_QUERY_MS:
+            return
+        plan = None
+        if random.random() < Config.SLOW_QUERY_EXPLAIN_SAMPLE:
+            plan = self._explain(query, vars)
+        logger.warning(
+            'Slow query (%.1f ms) in %s: %s%s',
+            elapsed * 1000, _route(), normalize_sql(query), '\n' + plan if plan else ''
+        )
+    
+    def _explain(self, query, vars):
+        """EXPLAIN a SELECT that just succeeded, or None
+        
+        Never ANALYZE: that executes the statement a second time, and a SELECT
+        can have side effects (pg_advisory_lock, nextval, pg_notify, ...).
+        """
+        text = query.decode(errors='replace') if isinstance(query, bytes) else str(query)
+        if self.name or not text.lstrip().upper().startswith('SELECT') or self.connection.status != psycopg2.extensions.STATUS_IN_TRANSACTION:
+            return None
+        # A savepoint keeps a failed EXPLAIN from aborting the caller's transaction
+        cur = self.connection.cursor(cursor_factory=psycopg2.extensions.cursor)
+        try:
+            cur.execute('SAVEPOINT slow_query_explain')
+            try:
+                cur.execute('EXPLAIN ' + text, vars)
+                plan = '\n'.join(row[0] for row in cur.fetchall())
+                cur.execute('RELEASE SAVEPOINT slow_query_explain')
+                return plan
+            except psycopg2.Error as e:
+                cur.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+                return f'(EXPLAIN failed: {e})'
+        except psycopg2.Error:
+            return None
+        finally:
+            cur.close()
+
+
+def _log_over_budget(request_g, method, path, route):
+    queries = request_g.get('db_queries', 0)
+    if Config.QUERY_BUDGET and queries > Config.QUERY_BUDGET:
+        logger.warning(
+            'Query budget exceeded in %s %s (%s): %s queries, budget %s, %.1f ms in the database',
+            method, path, route, queries, Config.QUERY_BUDGET, request_g.get('db_seconds', 0.0) * 1000
+        )
+
+
+def _check_query_budget(response):
+    """Log requests that issued more queries than QUERY_BUDGET"""
+    check = partial(_log_over_budget, g._get_current_object(), request.method, request.path, _route())
+    if response.is_streamed:
+        # A streamed page runs most of its queries while it renders, after this
+        response.call_on_close(check)
+    else:
+        check()
+    return response
+
+
+def _connect_kwargs():
+    """Connection parameters shared by direct and pooled connections"""
+    return dict(
+        host=Config.DB_HOST,
+        port=Config.DB_PORT,
+        user=Config.DB_USER,
+        password=Config.DB_PASSWORD,
+        database=Config.DB_NAME,
+        cursor_factory=TimedCursor
+    )
+
 
 def get_db_connection():
-		"""Create and return a database connection"""
-		conn = psycopg2.connect(
-				host=Config.DB_HOST,
-				port=Config.DB_PORT,
-				user=Config.DB_USER,
-				password=Config.DB_PASSWORD,
-				database=Config.DB_NAME,
-				cursor_factory=RealDictCursor
-		)
-		return conn
+    """Create and return a database connection"""
+    conn = psycopg2.connect(**_connect_kwargs())
+    return conn
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of PostgreSQL connections
+    
+    Connections are handed out LIFO so the hottest ones stay warm. A connection
+    idle for longer than health_check_interval is pinged before reuse, and one
+    older than max_lifetime is replaced instead of being reused. configure, if
+    given, is called with every new connection before it is first handed out.
+    """
+    
+    def __init__(self, min_size=1, max_size=10, timeout=5.0, max_lifetime=1800.0, health_check_interval=30.0, configure=None, **connect_kwargs):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError('Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.configure = configure
+        self.connect_kwargs = connect_kwargs
+        self.pid = os.getpid()
+        
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._created_at = {}
+        self._last_used = {}
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+        
+        # Counters exposed through stats()
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+        self._connections_created = 0
+        self._connections_closed = 0
+        
+        for _ in range(min_size):
+            conn = self._connect()
+            with self._cond:
+                self._size += 1
+                self._idle.append(conn)
+                self._last_used[conn] = time.monotonic()
+    
+    def _connect(self):
+        conn = psycopg2.connect(**self.connect_kwargs)
+        if self.configure is not None:
+            try:
+                self.configure(conn)
+            except Exception:
+                conn.close()
+                raise
+        with self._cond:
+            self._created_at[conn] = time.monotonic()
+            self._connections_created += 1
+        return conn
+    
+    def _discard(self, conn):
+        """Close a connection that is no longer counted in the pool size"""
+        with self._cond:
+            self._created_at.pop(conn, None)
+            self._last_used.pop(conn, None)
+            self._connections_closed += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+    
+    def _expired(self, conn):
+        created_at = self._created_at.get(conn, 0)
+        return time.monotonic() - created_at > self.max_lifetime
+    
+    def _healthy(self, conn):
+        """Ping connections that have been idle long enough to have gone stale"""
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(conn, 0) < self.health_check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    def getconn(self):
+        """Borrow a connection, waiting up to timeout seconds for one to free up"""
+        deadline = time.monotonic() + self.timeout
+        wait_started = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.InterfaceError('Connection pool is closed')
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    if wait_started is not None:
+                        self._wait_time += time.monotonic() - wait_started
+                    raise PoolTimeout(
+                        f'No database connection available after {self.timeout:.1f}s '
+                        f'(max_size={self.max_size})'
+                    )
+                if wait_started is None:
+                    wait_started = time.monotonic()
+                    self._waits += 1
+                self._waiting += 1
+                self._cond.wait(remaining)
+                self._waiting -= 1
+            if wait_started is not None:
+                self._wait_time += time.monotonic() - wait_started
+            self._in_use += 1
+        
+        try:
+            if conn is not None and (self._expired(conn) or not self._healthy(conn)):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+    
+    def putconn(self, conn):
+        """Return a borrowed connection, rolling back any open transaction"""
+        discard = self._closed or conn.closed or self._expired(conn)
+        if not discard:
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                discard = True
+        
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._size -= 1
+            else:
+                self._idle.append(conn)
+                self._last_used[conn] = time.monotonic()
+            self._cond.notify()
+        if discard:
+            self._discard(conn)
+    
+    def close(self):
+        """Close idle connections; borrowed ones are closed as they come back"""
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
+    
+    def stats(self):
+        """Snapshot of pool usage, for sizing min_size/max_size"""
+        with self._cond:
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'waits': self._waits,
+                'wait_time_seconds': round(self._wait_time, 6),
+                'timeouts': self._timeouts,
+                'connections_created': self._connections_created,
+                'connections_closed': self._connections_closed,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use
+    
+    The pool is recreated after a fork so worker processes never share sockets
+    inherited from a preloading parent.
+    """
+    # Imported here because repository.py builds on the helpers in this module
+    from repository import prepare_statements
+    
+    global _pool
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ConnectionPool(
+                    min_size=Config.DB_POOL_MIN_SIZE,
+                    max_size=Config.DB_POOL_MAX_SIZE,
+                    timeout=Config.DB_POOL_TIMEOUT,
+                    max_lifetime=Config.DB_POOL_MAX_LIFETIME,
+                    health_check_interval=Config.DB_POOL_HEALTH_CHECK_INTERVAL,
+                    configure=prepare_statements,
+                    **_connect_kwargs()
+                )
+    return _pool
+
+
+# How far a replica is behind: zero once it has replayed everything it
+# received (so an idle primary does not look like lag), and zero for a server
+# that is not in recovery at all
+REPLICA_LAG_SQL = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END AS lag
+'''
+
+
+class Replica:
+    """A read replica's connection pool plus its most recently measured lag"""
+    
+    def __init__(self, dsn, check_interval=5.0, configure=None, **pool_kwargs):
+        self.dsn = dsn
+        self.check_interval = check_interval
+        self.pool = ConnectionPool(dsn=dsn, cursor_factory=TimedCursor, configure=configure, **pool_kwargs)
+        self.lag = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+    
+    def current_lag(self):
+        """Replication lag in seconds, re-measured at most every check_interval; None if unreachable"""
+        if self._checked_at is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return self.lag
+        # One request measures while the others keep using the previous value
+        if not self._lock.acquire(blocking=False):
+            return self.lag
+        try:
+            conn = self.pool.getconn()
+            try:
+                cur = conn.cursor()
+                cur.execute(REPLICA_LAG_SQL)
+                self.lag = float(cur.fetchone()['lag'])
+                cur.close()
+            finally:
+                self.pool.putconn(conn)
+        except (psycopg2.Error, PoolTimeout) as e:
+            logger.warning('Replica %s unavailable: %s', self.host(), e)
+            self.lag = None
+        finally:
+            self._checked_at = time.monotonic()
+            self._lock.release()
+        return self.lag
+    
+    def usable(self, max_lag):
+        lag = self.current_lag()
+        return lag is not None and lag <= max_lag
+    
+    def host(self):
+        """host:port/dbname of the DSN, leaving out credentials, for logs and stats"""
+        params = parse_dsn(self.dsn)
+        return f"{params.get('host', 'localhost')}:{params.get('port', '5432')}/{params.get('dbname', '')}"
+    
+    def stats(self):
+        return dict(self.pool.stats(), dsn=self.host(), lag_seconds=self.lag)
+
+
+_replicas = None
+
+
+def get_replicas():
+    """Return the process-wide replica pools (one per DB_REPLICA_URLS entry), recreated after a fork"""
+    from repository import prepare_statements
+    
+    global _replicas
+    if _replicas is None or (_replicas and _replicas[0].pool.pid != os.getpid()):
+        with _pool_lock:
+            if _replicas is None or (_replicas and _replicas[0].pool.pid != os.getpid()):
+                _replicas = [
+                    Replica(
+                        dsn,
+                        check_interval=Config.DB_REPLICA_CHECK_INTERVAL,
+                        configure=lambda conn: prepare_statements(conn, readonly=True),
+                        min_size=0,
+                        max_size=Config.DB_POOL_MAX_SIZE,
+                        timeout=Config.DB_POOL_TIMEOUT,
+                        max_lifetime=Config.DB_POOL_MAX_LIFETIME,
+                        health_check_interval=Config.DB_POOL_HEALTH_CHECK_INTERVAL
+                    )
+                    for dsn in Config.DB_REPLICA_URLS
+                ]
+    return _replicas
+
+
+def get_db():
+    """Borrow a pooled connection for the current request
+    
+    The same connection is returned for the rest of the request and handed back
+    to the pool by close_db when the app context tears down.
+    """
+    if 'db' not in g:
+        g.db = get_pool().getconn()
+    return g.db
+
+
+def get_read_db():
+    """Borrow a connection for a request that only reads, from a replica when possible
+    
+    Falls back to the primary when no replica is configured or within
+    DB_REPLICA_MAX_LAG, when this session wrote within the last
+    READ_YOUR_WRITES_SECONDS, and once the request already holds the primary
+    connection. Never write through the returned connection.
+    """
+    if 'db' in g:
+        return g.db
+    if 'read_db' in g:
+        return g.read_db
+    if time.time() - session.get('db_write_at', 0) < Config.READ_YOUR_WRITES_SECONDS:
+        return get_db()
+    candidates = [replica for replica in get_replicas() if replica.usable(Config.DB_REPLICA_MAX_LAG)]
+    random.shuffle(candidates)
+    for replica in candidates:
+        try:
+            g.read_db = replica.pool.getconn()
+        except (psycopg2.Error, PoolTimeout) as e:
+            logger.warning('Replica %s unavailable: %s', replica.host(), e)
+            continue
+        g.read_db_replica = replica
+        return g.read_db
+    return get_db()
+
+
+def _remember_write(response):
+    """Start the read-your-writes window for a session that may have just written"""
+    if 'db' in g and request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        session['db_write_at'] = time.time()
+    return response
+
+
+def close_db(e=None):
+    """Return the request's connections to their pools"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_pool().putconn(conn)
+    read_conn = g.pop('read_db', None)
+    if read_conn is not None:
+        g.pop('read_db_replica').pool.putconn(read_conn)
+
+
+def init_app(app):
+    """Bind pooled connections to the Flask request lifecycle"""
+    app.after_request(_check_query_budget)
+    app.after_request(_remember_write)
+    app.teardown_appcontext(close_db)
+
+
+def _gevent_wait(conn, timeout=None):
+    """psycopg2 wait callback that parks the current greenlet instead of the process"""
+    from gevent.socket import wait_read, wait_write
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f'Bad result from poll: {state!r}')
+
+
+def enable_green_connections():
+    """Run every psycopg2 connection in asynchronous mode under gevent
+    
+    While a query waits on the server, other greenlets (requests) keep running,
+    so one process can hold far more requests than it has threads. COPY is not
+    available on connections in this mode.
+    """
+    psycopg2.extensions.set_wait_callback(_gevent_wait)
+
+
+# Length of the stored preview shown on note cards
+NOTE_EXCERPT_LENGTH = 150
+
+# Rows updated per transaction when backfilling new columns
+BACKFILL_BATCH_SIZE = 5000
+
+
+def note_excerpt(content):
+    """Preview text stored alongside a note so list pages never read the full body"""
+    return (content or '')[:NOTE_EXCERPT_LENGTH]
+
+
+def note_search_vector_sql(title='%s', content='%s'):
+    """SQL for a note's weighted full-text document; title matches rank above body matches"""
+    return (
+        f"setweight(to_tsvector('english', COALESCE({title}, '')), 'A') || "
+        f"setweight(to_tsvector('english', COALESCE({content}, '')), 'B')"
+    )
+
+
+# Search document built from bound (title, content) parameters
+NOTE_SEARCH_VECTOR_SQL = note_search_vector_sql()
+
+
+def bump_notes_version(cur, user_id):
+    """Mark a user's notes as changed; run in the transaction making the change"""
+    cur.execute('UPDATE users SET notes_version = notes_version + 1 WHERE id = %s', (user_id,))
 
 
 def init_db():
-		"""Initialize the database with required tables"""
-		conn = get_db_connection()
-		cur = conn.cursor()
-		
-		# Create users table
-		cur.execute('''
-				CREATE TABLE IF NOT EXISTS users (
-						id SERIAL PRIMARY KEY,
-						username VARCHAR(80) UNIQUE NOT NULL,
-						password_hash VARCHAR(255) NOT NULL,
-						description TEXT,
-						avatar VARCHAR(255),
-						created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-				)
-		''')
-		
-		# Create notes table
-		cur.execute('''
-				CREATE TABLE IF NOT EXISTS notes (
-						id SERIAL PRIMARY KEY,
-						user_id INTEGER NOT NULL,
-						title VARCHAR(200) NOT NULL,
-						content TEXT,
-						is_public BOOLEAN DEFAULT FALSE,
-						created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-						updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-						FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-				)
-		''')
-		
-		# Create attachments table
-		cur.execute('''
-				CREATE TABLE IF NOT EXISTS attachments (
-						id SERIAL PRIMARY KEY,
-						note_id INTEGER NOT NULL,
-						filename VARCHAR(255) NOT NULL,
-						original_filename VARCHAR(255) NOT NULL,
-						file_size INTEGER,
-						uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-						FOREIGN KEY (note_id) REFERENCES notes (id) ON DELETE CASCADE
-				)
-		''')
-		
-		conn.commit()
-		cur.close()
-		conn.close()
-		print("Database initialized successfully!")
-
-
-def migrate_db():
-		"""Add new columns to existing tables"""
-		conn = get_db_connection()
-		cur = conn.cursor()
-		
-		# Add description column if it doesn't exist
-		cur.execute("""
-				DO $$ 
-				BEGIN
-						IF NOT EXISTS (
-								SELECT 1 FROM information_schema.columns 
-								WHERE table_name='users' AND column_name='description'
-						) THEN
-								ALTER TABLE users ADD COLUMN description TEXT;
-						END IF;
-				END $$;
-		""")
-		
-		# Add avatar column if it doesn't exist
-		cur.execute("""
-				DO $$ 
-				BEGIN
-						IF NOT EXISTS (
-								SELECT 1 FROM information_schema.columns 
-								WHERE table_name='users' AND column_name='avatar'
-						) THEN
-								ALTER TABLE users ADD COLUMN avatar VARCHAR(255);
-						END IF;
-				END $$;
-		""")
-		
-		# Add is_public column to notes table if it doesn't exist
-		cur.execute("""
-				DO $$ 
-				BEGIN
-						IF NOT EXISTS (
-								SELECT 1 FROM information_schema.columns 
-								WHERE table_name='notes' AND column_name='is_public'
-						) THEN
-								ALTER TABLE notes ADD COLUMN is_public BOOLEAN DEFAULT FALSE;
-						END IF;
-				END $$;
-		""")
-		
-		conn.commit()
-		cur.close()
-		conn.close()
-		print("Database migration completed successfully!")
+    """Create or upgrade the schema by applying any pending migrations"""
+    # Imported here because migrations.py builds on the helpers in this module
+    from migrations import migrate
+    migrate()
+    print("Database initialized successfully!")
 
 
 if __name__ == '__main__':
-		init_db()
-		migrate_db()
-
+    init_db()
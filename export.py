@@ -0,0 +1,205 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import zipfile
+
+from config import Config
+from database import get_db_connection
+
+# Rows fetched per round trip from the server-side cursors
+EXPORT_BATCH_SIZE = 500
+
+# Bytes buffered before a chunk is handed to the client
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# Every note with its attachment metadata aggregated in, in id order
+NOTES_SQL = '''
+    SELECT n.id, n.title, n.content, n.is_public, n.created_at, n.updated_at,
+        COALESCE((
+            SELECT json_agg(json_build_object(
+                'id', a.id, 'filename', a.original_filename, 'file_size', a.file_size,
+                'checksum', a.checksum, 'uploaded_at', a.uploaded_at
+            ) ORDER BY a.uploaded_at, a.id)
+            FROM attachments a WHERE a.note_id = n.id
+        ), '[]') AS attachments
+    FROM notes n WHERE n.user_id = %s ORDER BY n.id
+'''
+
+ATTACHMENTS_SQL = '''
+    SELECT a.id, a.note_id, a.filename, a.original_filename FROM attachments a
+    JOIN notes n ON n.id = a.note_id WHERE n.user_id = %s ORDER BY a.note_id, a.id
+'''
+
+_slots = None
+_slots_lock = threading.Lock()
+
+
+class ExportBusy(Exception):
+    """Raised when EXPORT_MAX_CONCURRENT exports are already streaming in this process"""
+
+
+def _export_slots():
+    global _slots
+    with _slots_lock:
+        if _slots is None:
+            _slots = threading.BoundedSemaphore(Config.EXPORT_MAX_CONCURRENT)
+        return _slots
+
+
+def _json_default(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def attachment_path(note_id, attachment_id, filename):
+    """Where an attachment is placed inside the export zip"""
+    return f'attachments/{note_id}/{attachment_id}-{filename}'
+
+
+class _ChunkSink:
+    """Write-only, unseekable file object that collects output until drained
+    
+    zipfile writes data descriptors instead of seeking back when its target
+    cannot seek, so an archive can be produced front to back in chunks.
+    """
+    
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self.size = 0
+        return data
+
+
+class UserExport:
+    """Stream all of a user's notes from one consistent, read-only snapshot
+    
+    Each export uses its own connection rather than a pooled one, since it
+    stays open for as long as the client takes to download; at most
+    EXPORT_MAX_CONCURRENT exports run per process. Rows are read through
+    server-side cursors in batches, so memory use does not grow with the
+    size of the account. Call close() (or use as a context manager) when done.
+    """
+    
+    def __init__(self, user_id, attachments_folder):
+        self.user_id = user_id
+        self.attachments_folder = attachments_folder
+        self._slots = _export_slots()
+        if not self._slots.acquire(blocking=False):
+            raise ExportBusy('Too many exports in progress')
+        try:
+            self.conn = get_db_connection()
+            self.conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        except Exception:
+            self._slots.release()
+            raise
+        self._closed = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.conn.close()
+            self._slots.release()
+    
+    def _rows(self, name, sql):
+        cur = self.conn.cursor(name=name)
+        cur.itersize = EXPORT_BATCH_SIZE
+        try:
+            cur.execute(sql, (self.user_id,))
+            yield from cur
+        finally:
+            cur.close()
+    
+    def _note_lines(self, with_paths=False):
+        for note in self._rows('export_notes', NOTES_SQL):
+            if with_paths:
+                for attachment in note['attachments']:
+                    attachment['path'] = attachment_path(note['id'], attachment['id'], attachment['filename'])
+            yield (json.dumps(note, default=_json_default) + '\n').encode()
+    
+    def ndjson(self):
+        """Yield the notes as newline-delimited JSON, one note per line, in chunks"""
+        buffer = []
+        size = 0
+        for line in self._note_lines():
+            buffer.append(line)
+            size += len(line)
+            if size >= EXPORT_CHUNK_SIZE:
+                yield b''.join(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield b''.join(buffer)
+    
+    def zip(self):
+        """Yield a zip archive of notes.ndjson plus every attachment file, in chunks
+        
+        Attachment files missing from storage are left out of the archive.
+        """
+        sink = _ChunkSink()
+        with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            with archive.open('notes.ndjson', 'w', force_zip64=True) as entry:
+                for line in self._note_lines(with_paths=True):
+                    entry.write(line)
+                    if sink.size >= EXPORT_CHUNK_SIZE:
+                        yield sink.drain()
+            for attachment in self._rows('export_attachments', ATTACHMENTS_SQL):
+                path = os.path.join(self.attachments_folder, attachment['filename'])
+                if not os.path.exists(path):
+                    continue
+                info = zipfile.ZipInfo(attachment_path(attachment['note_id'], attachment['id'], attachment['original_filename']))
+                info.compress_type = zipfile.ZIP_STORED
+                with open(path, 'rb') as src, archive.open(info, 'w', force_zip64=True) as entry:
+                    while True:
+                        chunk = src.read(EXPORT_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        entry.write(chunk)
+                        if sink.size >= EXPORT_CHUNK_SIZE:
+                            yield sink.drain()
+        yield sink.drain()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export a user's notes as NDJSON, or as a zip with attachments")
+    parser.add_argument('username')
+    parser.add_argument('--zip', action='store_true', help='write a zip archive including attachment files')
+    parser.add_argument('-o', '--output', help='output file (default: stdout)')
+    args = parser.parse_args()
+    
+    from app import ATTACHMENTS_FOLDER
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT id FROM users WHERE username = %s', (args.username,))
+    user = cur.fetchone()
+    conn.close()
+    if not user:
+        sys.exit(f'No user named {args.username}')
+    
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    with UserExport(user['id'], ATTACHMENTS_FOLDER) as export:
+        for chunk in (export.zip() if args.zip else export.ndjson()):
+            out.write(chunk)
+    if args.output:
+        out.close()
@@ -0,0 +1,25 @@
+"""Cooperative (gevent) entry point serving the same app.py routes
+
+Each request runs in a greenlet that yields while it waits on PostgreSQL, so
+a single process can hold many more in-flight requests than it has threads:
+    
+    gunicorn -k gevent --worker-connections 500 gevent_app:app
+    python gevent_app.py
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+
+from gevent.pywsgi import WSGIServer
+
+from database import enable_green_connections
+
+enable_green_connections()
+
+from app import app
+
+if __name__ == '__main__':
+    port = int(os.getenv('PORT', '5000'))
+    print(f'Serving on http://0.0.0.0:{port} (gevent)')
+    WSGIServer(('0.0.0.0', port), app).serve_forever()
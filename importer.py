@@ -0,0 +1,382 @@
+import argparse
+import csv
+import json
+import os
+import time
+from datetime import datetime
+
+from werkzeug.datastructures import FileStorage
+
+from cache import invalidate_profile
+from database import get_db_connection, note_search_vector_sql, NOTE_EXCERPT_LENGTH
+from storage import store_uploads, place_blobs, insert_attachments, abandon_uploads
+
+# Staged rows merged into notes per transaction
+IMPORT_BATCH_SIZE = 5000
+
+# Rejected rows listed in the final report
+REPORT_ERRORS = 10
+
+STAGING_COLUMNS = ('line_no', 'username', 'title', 'content', 'is_public', 'created_at', 'updated_at', 'attachments', 'error')
+
+
+def _copy_field(value):
+    """One COPY ... (FORMAT csv) field: quoted text, or an unquoted \\N for NULL"""
+    if value is None:
+        return '\\N'
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+class _CopySource:
+    """File-like object feeding generated lines to cursor.copy_expert"""
+    
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buffer = b''
+    
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line.encode()
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _parse_bool(value):
+    if value is None or value == '' or isinstance(value, bool):
+        return bool(value)
+    text = str(value).strip().lower()
+    if text in ('true', 't', '1', 'yes'):
+        return True
+    if text in ('false', 'f', '0', 'no'):
+        return False
+    raise ValueError(f'is_public must be a boolean, not {value!r}')
+
+
+def _parse_text(value, field):
+    # JSON records can carry numbers, lists or objects where text belongs
+    if value is None or isinstance(value, str):
+        return value
+    raise ValueError(f'{field} must be a string, not {type(value).__name__}')
+
+
+def _parse_timestamp(value, field):
+    if value is None or value == '':
+        return None
+    try:
+        return datetime.fromisoformat(str(value)).isoformat()
+    except ValueError:
+        raise ValueError(f'{field} is not an ISO 8601 timestamp: {value!r}')
+
+
+def _parse_attachments(value):
+    """Attachment list as [{"path", "filename"}]
+    
+    Accepts paths (a list, or '|'-separated in CSV) or objects with "path" and
+    optionally "filename", as in the notes.ndjson of an export.py zip. Objects
+    without a "path" are skipped: a plain NDJSON export lists its attachments'
+    metadata but carries no files.
+    """
+    if value is None or value == '':
+        return []
+    if isinstance(value, str):
+        value = [path for path in value.split('|') if path]
+    if not isinstance(value, list):
+        raise ValueError('attachments must be a list')
+    attachments = []
+    for item in value:
+        if isinstance(item, str):
+            item = {'path': item}
+        if isinstance(item, dict) and 'path' not in item:
+            continue
+        if not isinstance(item, dict) or not isinstance(item.get('path'), str):
+            raise ValueError('each attachment needs a "path"')
+        if not isinstance(item.get('filename') or '', str):
+            raise ValueError('attachment filename must be a string')
+        attachments.append({'path': item['path'], 'filename': item.get('filename') or os.path.basename(item['path'])})
+    return attachments
+
+
+def read_records(path, fmt):
+    """Yield (line_no, record or None, parse error or None) from an NDJSON or CSV file"""
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            for line_no, record in enumerate(csv.DictReader(f), 1):
+                yield line_no, record, None
+            return
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_no, None, f'invalid JSON: {e}'
+                continue
+            if not isinstance(record, dict):
+                yield line_no, None, 'each line must be a JSON object'
+                continue
+            yield line_no, record, None
+
+
+def staging_lines(path, fmt, default_username):
+    """COPY lines for every record, with parse failures recorded in the error column"""
+    for line_no, record, error in read_records(path, fmt):
+        values = {'line_no': line_no, 'error': error}
+        if record is not None:
+            try:
+                username = _parse_text(record.get('username'), 'username') or default_username
+                # Would not fit the staging column; no account can have such a name
+                if username and len(username) > 80:
+                    raise ValueError(f'username too long ({len(username)} characters, at most 80)')
+                values.update(
+                    username=username,
+                    title=_parse_text(record.get('title'), 'title'),
+                    content=_parse_text(record.get('content'), 'content') or '',
+                    is_public=_parse_bool(record.get('is_public')),
+                    created_at=_parse_timestamp(record.get('created_at'), 'created_at'),
+                    updated_at=_parse_timestamp(record.get('updated_at'), 'updated_at'),
+                    attachments=json.dumps(_parse_attachments(record.get('attachments'))),
+                )
+            except ValueError as e:
+                values = {'line_no': line_no, 'error': str(e)}
+        yield ','.join(_copy_field(values.get(column)) for column in STAGING_COLUMNS) + '\n'
+
+
+def find_or_create_job(cur, source, fingerprint, again):
+    """Resume the unfinished job for this exact file, or start a new one"""
+    cur.execute(
+        'SELECT * FROM import_jobs WHERE source = %s AND fingerprint = %s ORDER BY id DESC LIMIT 1',
+        (source, fingerprint)
+    )
+    job = cur.fetchone()
+    if job and job['status'] == 'done' and not again:
+        raise SystemExit(f'{source} was already imported by job {job["id"]}; pass --again to import it again')
+    if job and job['status'] != 'done':
+        print(f'Resuming import job {job["id"]} ({job["status"]}, merged through line {job["merged_through"]})')
+        return job
+    cur.execute(
+        'INSERT INTO import_jobs (source, fingerprint) VALUES (%s, %s) RETURNING *',
+        (source, fingerprint)
+    )
+    return cur.fetchone()
+
+
+def load(conn, job, path, fmt, default_username):
+    """COPY the whole file into the staging table in one transaction"""
+    cur = conn.cursor()
+    cur.execute('DELETE FROM import_rows WHERE job_id = %s', (job['id'],))
+    started = time.monotonic()
+    cur.copy_expert(
+        f'''COPY import_rows (job_id, {", ".join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')''',
+        _CopySource(f'{job["id"]},{line}' for line in staging_lines(path, fmt, default_username))
+    )
+    loaded = cur.rowcount
+    cur.execute(
+        "UPDATE import_jobs SET status = 'loaded', rows_loaded = %s WHERE id = %s",
+        (loaded, job['id'])
+    )
+    conn.commit()
+    cur.close()
+    elapsed = time.monotonic() - started
+    print(f'Loaded {loaded} rows in {elapsed:.1f}s ({loaded / max(elapsed, 1e-6):.0f} rows/s)')
+    job.update(status='loaded', rows_loaded=loaded)
+
+
+def validate(conn, job):
+    """Reject rows with bad titles or unknown owners, set-based over the whole job"""
+    cur = conn.cursor()
+    cur.execute(
+        '''
+        UPDATE import_rows SET error = CASE
+            WHEN title IS NULL OR btrim(title) = '' THEN 'title is required'
+            ELSE 'title must be 200 characters or less' END
+        WHERE job_id = %s AND error IS NULL AND (title IS NULL OR btrim(title) = '' OR char_length(btrim(title)) > 200)
+        ''',
+        (job['id'],)
+    )
+    cur.execute(
+        '''
+        UPDATE import_rows r SET user_id = u.id FROM users u
+        WHERE r.job_id = %s AND r.error IS NULL AND u.username = r.username
+        ''',
+        (job['id'],)
+    )
+    cur.execute(
+        '''
+        UPDATE import_rows SET error = CASE WHEN username IS NULL THEN 'no username (use --user)'
+            ELSE 'unknown user ' || username END
+        WHERE job_id = %s AND error IS NULL AND user_id IS NULL
+        ''',
+        (job['id'],)
+    )
+    cur.execute("UPDATE import_jobs SET status = 'validated' WHERE id = %s", (job['id'],))
+    conn.commit()
+    cur.close()
+    job['status'] = 'validated'
+
+
+def _store_attachment_files(rows, attachments_dir, folder, allowed, stored):
+    """Copy a batch's attachment files into the incoming area, filling stored ({note_id: entries})
+    
+    Returns the number of files that were not found.
+    """
+    missing = 0
+    for row in rows:
+        files = []
+        for attachment in row['attachments']:
+            path = os.path.join(attachments_dir, attachment['path'])
+            if not os.path.isfile(path):
+                missing += 1
+                continue
+            files.append(FileStorage(stream=open(path, 'rb'), filename=attachment['filename']))
+        try:
+            stored[row['note_id']] = store_uploads(files, folder, allowed)
+        finally:
+            for file in files:
+                file.stream.close()
+    return missing
+
+
+def merge(conn, job, attachments_dir, folder, allowed, batch_size):
+    """Insert validated rows into notes batch by batch, recording progress with each batch"""
+    cur = conn.cursor()
+    cur.execute('SELECT COALESCE(MAX(line_no), 0) AS last FROM import_rows WHERE job_id = %s', (job['id'],))
+    last_line = cur.fetchone()['last']
+    started = time.monotonic()
+    merged = 0
+    missing_files = 0
+    while job['merged_through'] < last_line:
+        start, end = job['merged_through'], job['merged_through'] + batch_size
+        stored = {}
+        try:
+            # Note ids are assigned up front so attachments can be matched to them
+            cur.execute(
+                f'''
+                WITH batch AS (
+                    UPDATE import_rows SET note_id = nextval(pg_get_serial_sequence('notes', 'id'))
+                    WHERE job_id = %s AND line_no > %s AND line_no <= %s AND error IS NULL
+                    RETURNING note_id, user_id, btrim(title) AS title, content, is_public, created_at, updated_at
+                )
+                INSERT INTO notes (id, user_id, title, content, excerpt, content_length, is_public, search_vector, created_at, updated_at)
+                SELECT note_id, user_id, title, content, LEFT(content, %s), CHAR_LENGTH(content), is_public,
+                    {note_search_vector_sql('title', 'content')},
+                    COALESCE(created_at, now()), COALESCE(updated_at, created_at, now())
+                FROM batch
+                RETURNING user_id, is_public
+                ''',
+                (job['id'], start, end, NOTE_EXCERPT_LENGTH)
+            )
+            inserted = cur.fetchall()
+            cur.execute(
+                '''
+                SELECT note_id, attachments FROM import_rows
+                WHERE job_id = %s AND line_no > %s AND line_no <= %s AND error IS NULL AND attachments <> '[]'
+                ''',
+                (job['id'], start, end)
+            )
+            missing_files += _store_attachment_files(cur.fetchall(), attachments_dir, folder, allowed, stored)
+            # One call for the whole batch, so blob locks are taken in a single sorted order
+            place_blobs(cur, folder, [a for note_stored in stored.values() for a in note_stored])
+            for note_id, note_stored in stored.items():
+                insert_attachments(cur, note_id, note_stored)
+            user_ids = sorted({row['user_id'] for row in inserted})
+            cur.execute('UPDATE users SET notes_version = notes_version + 1 WHERE id = ANY(%s)', (user_ids,))
+            cur.execute(
+                'UPDATE import_jobs SET merged_through = %s, rows_imported = rows_imported + %s WHERE id = %s',
+                (min(end, last_line), len(inserted), job['id'])
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            abandon_uploads(conn, folder, [a for note_stored in stored.values() for a in note_stored])
+            raise
+        for user_id in sorted({row['user_id'] for row in inserted if row['is_public']}):
+            invalidate_profile(user_id)
+        job['merged_through'] = min(end, last_line)
+        merged += len(inserted)
+        elapsed = time.monotonic() - started
+        print(f'Merged through line {job["merged_through"]}/{last_line}: {merged} notes ({merged / max(elapsed, 1e-6):.0f} rows/s)')
+    cur.close()
+    return merged, missing_files
+
+
+def finish(conn, job):
+    """Report rejected rows, drop the job's staging rows and mark it done"""
+    cur = conn.cursor()
+    cur.execute(
+        'SELECT error, COUNT(*) AS count, MIN(line_no) AS first_line FROM import_rows '
+        'WHERE job_id = %s AND error IS NOT NULL GROUP BY error ORDER BY count DESC LIMIT %s',
+        (job['id'], REPORT_ERRORS)
+    )
+    errors = cur.fetchall()
+    for error in errors:
+        print(f'Rejected {error["count"]} rows: {error["error"]} (first at line {error["first_line"]})')
+    cur.execute('DELETE FROM import_rows WHERE job_id = %s', (job['id'],))
+    cur.execute(
+        "UPDATE import_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = %s RETURNING rows_loaded, rows_imported",
+        (job['id'],)
+    )
+    totals = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return totals
+
+
+def import_file(conn, path, fmt, attachments_dir, folder, allowed, default_username=None, batch_size=IMPORT_BATCH_SIZE, again=False):
+    """Run (or resume) the import of one file; returns (rows loaded, notes imported)
+    
+    The file is first COPYed into the staging table and validated, then
+    merged into notes in batches. Each batch commits together with the job's
+    progress, so after an interruption the same command continues with the
+    first unmerged batch.
+    """
+    source = os.path.abspath(path)
+    stat = os.stat(source)
+    cur = conn.cursor()
+    job = find_or_create_job(cur, source, f'{stat.st_size}:{stat.st_mtime_ns}', again)
+    conn.commit()
+    if job['status'] != 'loading':
+        # Staging is UNLOGGED: a database crash empties it, so reload if needed
+        cur.execute('SELECT COUNT(*) AS count FROM import_rows WHERE job_id = %s', (job['id'],))
+        if cur.fetchone()['count'] < job['rows_loaded']:
+            print('Staged rows were lost (database restart); reloading the file')
+            job['status'] = 'loading'
+    cur.close()
+    if job['status'] == 'loading':
+        load(conn, job, source, fmt, default_username)
+    if job['status'] == 'loaded':
+        validate(conn, job)
+    merged, missing_files = merge(conn, job, attachments_dir, folder, allowed, batch_size)
+    if missing_files:
+        print(f'Skipped {missing_files} attachment files that were not found')
+    totals = finish(conn, job)
+    return totals['rows_loaded'], totals['rows_imported']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk import notes (and attachment files) from NDJSON or CSV')
+    parser.add_argument('file')
+    parser.add_argument('--format', choices=('ndjson', 'csv'), help='default: from the file extension')
+    parser.add_argument('--user', help='owner for records without a "username"')
+    parser.add_argument('--attachments-dir', help='base directory of attachment paths (default: the file\'s directory)')
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument('--again', action='store_true', help='import a file that was already imported')
+    args = parser.parse_args()
+    
+    from app import ATTACHMENTS_FOLDER, allowed_attachment
+    
+    fmt = args.format or ('csv' if args.file.lower().endswith('.csv') else 'ndjson')
+    attachments_dir = args.attachments_dir or os.path.dirname(os.path.abspath(args.file))
+    conn = get_db_connection()
+    started = time.monotonic()
+    loaded, imported = import_file(
+        conn, args.file, fmt, attachments_dir, ATTACHMENTS_FOLDER, allowed_attachment,
+        default_username=args.user, batch_size=args.batch_size, again=args.again
+    )
+    conn.close()
+    elapsed = time.monotonic() - started
+    print(f'Done: {imported} of {loaded} rows imported ({elapsed:.1f}s this run)')
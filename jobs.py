@@ -0,0 +1,339 @@
+import argparse
+import json
+import logging
+import os
+import re
+import select
+import time
+
+from avatars import remove_avatar, PROCESSED_AVATAR
+from config import Config
+from database import get_db_connection
+from storage import release_blobs, INCOMING_DIR
+
+logger = logging.getLogger(__name__)
+
+# Channel enqueue() notifies, so an idle worker wakes up at commit instead of at its next poll
+JOBS_CHANNEL = 'jobs'
+
+# Serializes schedule_sweep between workers, so two idle ones never both queue a sweep
+SWEEP_SCHEDULE_LOCK_ID = 5910002
+
+# Files on disk for one size of a processed avatar: user_<id>_<digest>-<size>.<ext>
+AVATAR_VARIANT = re.compile(r'^(user_(\d+)_[0-9a-f]{12})-\d+\.(webp|jpg|png)$')
+
+
+def enqueue(cur, kind, payload, delay=0):
+    """Queue a job inside the caller's transaction; it becomes visible when that commits
+    
+    Queuing file cleanup in the same transaction as the delete that orphaned
+    the files means it can neither run early nor be lost.
+    """
+    cur.execute(
+        "INSERT INTO jobs (kind, payload, run_at) VALUES (%s, %s, CURRENT_TIMESTAMP + %s * interval '1 second')",
+        (kind, json.dumps(payload), delay)
+    )
+    cur.execute('SELECT pg_notify(%s, %s)', (JOBS_CHANNEL, kind))
+
+
+def claim(conn):
+    """Lease the next due job to this worker and commit, or return None
+    
+    SKIP LOCKED lets any number of workers poll the queue without blocking
+    each other. A worker that dies keeps its jobs only until the lease
+    (JOB_LEASE_SECONDS) runs out; after that another worker picks them up.
+    """
+    cur = conn.cursor()
+    cur.execute(
+        '''
+        UPDATE jobs SET attempts = attempts + 1, locked_until = CURRENT_TIMESTAMP + %s * interval '1 second'
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE status = 'queued' AND run_at <= CURRENT_TIMESTAMP
+                AND (locked_until IS NULL OR locked_until < CURRENT_TIMESTAMP)
+            ORDER BY run_at, id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING id, kind, payload, attempts
+        ''',
+        (Config.JOB_LEASE_SECONDS,)
+    )
+    job = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return job
+
+
+def complete(conn, job):
+    cur = conn.cursor()
+    cur.execute('DELETE FROM jobs WHERE id = %s', (job['id'],))
+    conn.commit()
+    cur.close()
+
+
+def fail(conn, job, error):
+    """Retry with exponential backoff, or park the job as failed after JOB_MAX_ATTEMPTS"""
+    cur = conn.cursor()
+    if job['attempts'] >= Config.JOB_MAX_ATTEMPTS:
+        cur.execute(
+            "UPDATE jobs SET status = 'failed', locked_until = NULL, last_error = %s WHERE id = %s",
+            (error, job['id'])
+        )
+    else:
+        cur.execute(
+            '''
+            UPDATE jobs SET locked_until = NULL, last_error = %s,
+                run_at = CURRENT_TIMESTAMP + %s * interval '1 second'
+            WHERE id = %s
+            ''',
+            (error, 2 ** job['attempts'], job['id'])
+        )
+    conn.commit()
+    cur.close()
+
+
+class Worker:
+    """Runs queued jobs; each kind of job is handled by its handle_<kind> method
+    
+    Handlers must be safe to run more than once, since a job whose worker
+    died is run again.
+    """
+    
+    def __init__(self, conn, attachments_folder, avatars_folder):
+        self.conn = conn
+        self.attachments_folder = attachments_folder
+        self.avatars_folder = avatars_folder
+    
+    def handle_release_blobs(self, payload):
+        """Delete attachment files that lost their last reference"""
+        release_blobs(self.conn, self.attachments_folder, payload['filenames'])
+    
+    def handle_remove_avatar(self, payload):
+        """Delete a replaced avatar's files, unless it was set again meanwhile"""
+        cur = self.conn.cursor()
+        cur.execute('SELECT 1 FROM users WHERE id = %s AND avatar = %s', (payload['user_id'], payload['avatar']))
+        in_use = cur.fetchone() is not None
+        self.conn.commit()
+        cur.close()
+        if not in_use:
+            remove_avatar(self.avatars_folder, payload['avatar'])
+    
+    def handle_sweep(self, payload):
+        """Remove orphaned files; run queues the next sweep once this one is gone"""
+        sweep(self.conn, self.attachments_folder, self.avatars_folder)
+    
+    def run_one(self):
+        """Run the next due job; returns False if there was none"""
+        job = claim(self.conn)
+        if job is None:
+            return False
+        handler = getattr(self, f'handle_{job["kind"]}', None)
+        try:
+            if handler is None:
+                raise ValueError(f'unknown job kind {job["kind"]!r}')
+            handler(job['payload'])
+        except Exception as e:
+            self.conn.rollback()
+            logger.exception('Job %s (%s) failed on attempt %s', job['id'], job['kind'], job['attempts'])
+            fail(self.conn, job, f'{type(e).__name__}: {e}')
+        else:
+            complete(self.conn, job)
+        return True
+    
+    def run(self, poll_interval):
+        """Work the queue until interrupted, sleeping on LISTEN between jobs"""
+        self.conn.autocommit = True
+        self.conn.cursor().execute(f'LISTEN {JOBS_CHANNEL}')
+        self.conn.autocommit = False
+        schedule_sweep(self.conn, 0)
+        while True:
+            while self.run_one():
+                pass
+            # Whether the last sweep completed or was parked as failed, there
+            # is always a next one
+            schedule_sweep(self.conn, Config.SWEEP_INTERVAL)
+            if select.select([self.conn], [], [], poll_interval) != ([], [], []):
+                self.conn.poll()
+                self.conn.notifies.clear()
+
+
+def schedule_sweep(conn, delay):
+    """Queue a sweep unless one is already queued, running or waiting for a retry"""
+    cur = conn.cursor()
+    cur.execute('SELECT pg_advisory_xact_lock(%s)', (SWEEP_SCHEDULE_LOCK_ID,))
+    cur.execute(
+        '''
+        INSERT INTO jobs (kind, run_at)
+        SELECT 'sweep', CURRENT_TIMESTAMP + %s * interval '1 second'
+        WHERE NOT EXISTS (SELECT 1 FROM jobs WHERE kind = 'sweep' AND status = 'queued')
+        ''',
+        (delay,)
+    )
+    conn.commit()
+    cur.close()
+
+
+def _old_enough(path, cutoff):
+    try:
+        return os.path.getmtime(path) < cutoff
+    except OSError:
+        return False
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _attachment_files(folder):
+    """Storage keys of every file under the attachments folder, except the incoming area"""
+    for root, dirs, files in os.walk(folder):
+        if root == folder and INCOMING_DIR in dirs:
+            dirs.remove(INCOMING_DIR)
+        for name in files:
+            if name.startswith('.'):
+                continue
+            yield os.path.relpath(os.path.join(root, name), folder).replace(os.sep, '/')
+
+
+def sweep_attachments(conn, folder, cutoff, dry_run=False):
+    """Remove attachment files no row references, one batch of keys per query; returns the count
+    
+    The actual deletion goes through release_blobs, which re-checks each file
+    under its advisory lock, so an upload placing the same blob is never lost.
+    """
+    cur = conn.cursor()
+    removed = 0
+    for batch in _batches(_attachment_files(folder), Config.SWEEP_BATCH_SIZE):
+        cur.execute('SELECT DISTINCT filename FROM attachments WHERE filename = ANY(%s)', (batch,))
+        referenced = {row['filename'] for row in cur.fetchall()}
+        conn.commit()
+        orphans = [key for key in batch if key not in referenced and _old_enough(os.path.join(folder, key), cutoff)]
+        if orphans and not dry_run:
+            release_blobs(conn, folder, orphans)
+        removed += len(orphans)
+    cur.close()
+    
+    # Uploads abandoned before place_blobs moved them into storage
+    incoming = os.path.join(folder, INCOMING_DIR)
+    if os.path.isdir(incoming):
+        for name in os.listdir(incoming):
+            path = os.path.join(incoming, name)
+            if _old_enough(path, cutoff):
+                if not dry_run:
+                    os.remove(path)
+                removed += 1
+    return removed
+
+
+def sweep_avatars(conn, folder, cutoff, dry_run=False):
+    """Remove avatar files no user's avatar refers to, in batches; returns the count"""
+    cur = conn.cursor()
+    removed = 0
+    names = (name for name in os.listdir(folder) if not name.startswith('.') and os.path.isfile(os.path.join(folder, name)))
+    for batch in _batches(names, Config.SWEEP_BATCH_SIZE):
+        # Processed variants carry their owner's id; anything else is a legacy upload
+        user_ids = sorted({int(m.group(2)) for m in map(AVATAR_VARIANT.match, batch) if m})
+        cur.execute(
+            'SELECT avatar FROM users WHERE id = ANY(%s) OR avatar = ANY(%s)',
+            (user_ids, [name for name in batch if not AVATAR_VARIANT.match(name)])
+        )
+        in_use = set()
+        for row in cur.fetchall():
+            match = PROCESSED_AVATAR.match(row['avatar'] or '')
+            in_use.add(match.group(1) if match else row['avatar'])
+        conn.commit()
+        for name in batch:
+            match = AVATAR_VARIANT.match(name)
+            if (match.group(1) if match else name) in in_use or not _old_enough(os.path.join(folder, name), cutoff):
+                continue
+            if not dry_run:
+                os.remove(os.path.join(folder, name))
+            removed += 1
+    cur.close()
+    return removed
+
+
+def sweep(conn, attachments_folder, avatars_folder, dry_run=False):
+    """Reconcile both upload folders with the database, removing orphaned files
+    
+    Files younger than SWEEP_GRACE_SECONDS are kept, since an upload writes
+    its files before committing the row that refers to them.
+    """
+    cutoff = time.time() - Config.SWEEP_GRACE_SECONDS
+    attachments = sweep_attachments(conn, attachments_folder, cutoff, dry_run)
+    avatars = sweep_avatars(conn, avatars_folder, cutoff, dry_run)
+    logger.info('Sweep %s %s attachment and %s avatar files', 'found' if dry_run else 'removed', attachments, avatars)
+    return attachments, avatars
+
+
+def print_status(conn):
+    cur = conn.cursor()
+    cur.execute(
+        '''
+        SELECT kind, status, COUNT(*) AS count, MIN(run_at) AS next_run FROM jobs
+        GROUP BY kind, status ORDER BY kind, status
+        '''
+    )
+    rows = cur.fetchall()
+    if not rows:
+        print('No jobs queued')
+    for row in rows:
+        print(f'{row["kind"]:<15} {row["status"]:<8} {row["count"]:>6}  next run {row["next_run"]:%Y-%m-%d %H:%M:%S}')
+    cur.execute("SELECT id, kind, attempts, last_error FROM jobs WHERE status = 'failed' ORDER BY id DESC LIMIT 10")
+    for row in cur.fetchall():
+        print(f'failed job {row["id"]} ({row["kind"]}, {row["attempts"]} attempts): {row["last_error"]}')
+    cur.close()
+
+
+def retry_failed(conn):
+    cur = conn.cursor()
+    cur.execute(
+        "UPDATE jobs SET status = 'queued', attempts = 0, run_at = CURRENT_TIMESTAMP WHERE status = 'failed'"
+    )
+    count = cur.rowcount
+    conn.commit()
+    cur.close()
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Background job worker and orphaned file sweeper')
+    commands = parser.add_subparsers(dest='command', required=True)
+    worker_parser = commands.add_parser('worker', help='run queued jobs until interrupted (also schedules sweeps)')
+    worker_parser.add_argument('--once', action='store_true', help='run every due job, then exit')
+    sweep_parser = commands.add_parser('sweep', help='remove orphaned attachment and avatar files now')
+    sweep_parser.add_argument('--dry-run', action='store_true', help='only count the orphans')
+    commands.add_parser('status', help='show queued and failed jobs')
+    commands.add_parser('retry', help='queue failed jobs again')
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    from app import ATTACHMENTS_FOLDER, UPLOAD_FOLDER
+    
+    conn = get_db_connection()
+    if args.command == 'worker':
+        worker = Worker(conn, ATTACHMENTS_FOLDER, UPLOAD_FOLDER)
+        if args.once:
+            while worker.run_one():
+                pass
+        else:
+            try:
+                worker.run(Config.JOB_POLL_INTERVAL)
+            except KeyboardInterrupt:
+                pass
+    elif args.command == 'sweep':
+        found = sweep(conn, ATTACHMENTS_FOLDER, UPLOAD_FOLDER, dry_run=args.dry_run)
+        print('{} {} attachment and {} avatar files'.format('Found' if args.dry_run else 'Removed', *found))
+    elif args.command == 'status':
+        print_status(conn)
+    elif args.command == 'retry':
+        print(f'Queued {retry_failed(conn)} failed jobs again')
+    conn.close()
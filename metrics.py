@@ -0,0 +1,117 @@
+import hmac
+import os
+import time
+from functools import partial
+
+from flask import g, request, Response, abort, template_rendered, before_render_template
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+from config import Config
+
+# Set for multi-worker servers (gunicorn); every worker writes its samples there
+MULTIPROCESS = bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+
+REQUEST_DURATION = Histogram(
+    'vibenotes_request_duration_seconds', 'Time spent handling a request',
+    ['endpoint', 'method', 'status']
+)
+REQUEST_DB_QUERIES = Histogram(
+    'vibenotes_request_db_queries', 'Database queries issued by a request',
+    ['endpoint'], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+)
+REQUEST_DB_DURATION = Histogram(
+    'vibenotes_request_db_seconds', 'Time a request spent waiting on database queries',
+    ['endpoint']
+)
+TEMPLATE_DURATION = Histogram(
+    'vibenotes_template_render_seconds', 'Time spent rendering a template',
+    ['template']
+)
+UPLOAD_BYTES = Counter('vibenotes_upload_bytes', 'Bytes of uploaded files accepted', ['kind'])
+DOWNLOAD_BYTES = Counter('vibenotes_download_bytes', 'Bytes of attachment downloads served', ['kind'])
+
+
+def count_upload(kind, size):
+    """Record size bytes of accepted uploads ('attachment' or 'avatar')"""
+    if size:
+        UPLOAD_BYTES.labels(kind).inc(size)
+
+
+def count_download(kind, size):
+    """Record size bytes of a served download"""
+    if size:
+        DOWNLOAD_BYTES.labels(kind).inc(size)
+
+
+def _endpoint():
+    # Unmatched URLs share one label so scanners cannot create unbounded series
+    return request.endpoint or 'unmatched'
+
+
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+
+def _observe(request_g, endpoint, method, status):
+    started = request_g.pop('request_started', None)
+    if started is None:
+        return
+    REQUEST_DURATION.labels(endpoint, method, str(status)).observe(time.perf_counter() - started)
+    # Counted by database.TimedCursor
+    REQUEST_DB_QUERIES.labels(endpoint).observe(request_g.get('db_queries', 0))
+    REQUEST_DB_DURATION.labels(endpoint).observe(request_g.get('db_seconds', 0.0))
+
+
+def _after_request(response):
+    observe = partial(_observe, g._get_current_object(), _endpoint(), request.method, response.status_code)
+    if response.is_streamed:
+        # A streamed page renders, and runs most of its queries, while the
+        # client reads it; observe it once it has been sent in full
+        response.call_on_close(observe)
+    else:
+        observe()
+    return response
+
+
+def _teardown_request(error):
+    # Only reached with a timer still running when no response was produced
+    # (or a streamed one failed part way)
+    if error is not None:
+        _observe(g._get_current_object(), _endpoint(), request.method, 500)
+
+
+def _template_started(app, template, context, **extra):
+    g.setdefault('template_started', []).append(time.perf_counter())
+
+
+def _template_finished(app, template, context, **extra):
+    stack = g.get('template_started')
+    if stack:
+        TEMPLATE_DURATION.labels(template.name or 'string').observe(time.perf_counter() - stack.pop())
+
+
+def metrics_view():
+    """Prometheus text exposition of every metric, summed over all worker processes"""
+    if Config.METRICS_TOKEN:
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied.encode(), f'Bearer {Config.METRICS_TOKEN}'.encode()):
+            abort(401)
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    """Time every request and template and serve the results on /metrics"""
+    if not Config.METRICS_ENABLED:
+        return
+    app.before_request(_start_timer)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,300 @@
+import sys
+
+from database import get_db_connection, note_search_vector_sql, NOTE_EXCERPT_LENGTH, BACKFILL_BATCH_SIZE
+
+# Advisory lock key held while migrating, so two deploys never migrate at once
+MIGRATION_LOCK_ID = 5910001
+
+
+class Migration:
+    """One schema version: an ordered list of SQL strings or callables taking a cursor
+    
+    Transactional migrations run all their steps in a single transaction.
+    Non-transactional ones run in autocommit mode so they can build indexes
+    CONCURRENTLY and backfill in small batches without holding long locks;
+    each of their steps must therefore be safe to re-run after a failure.
+    """
+    
+    def __init__(self, version, name, steps, transactional=True):
+        self.version = version
+        self.name = name
+        self.steps = steps
+        self.transactional = transactional
+
+
+def add_column(table, column, definition):
+    """Step that adds a column unless it already exists"""
+    return f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}'
+
+
+def backfill(table, assignments, pending, params=()):
+    """Step that fills in a new column in id ranges, committing after each range"""
+    def step(cur):
+        cur.execute(f'SELECT COALESCE(MAX(id), 0) AS max_id FROM {table}')
+        max_id = cur.fetchone()['max_id']
+        for start in range(0, max_id, BACKFILL_BATCH_SIZE):
+            cur.execute(
+                f'UPDATE {table} SET {assignments} WHERE id > %s AND id <= %s AND {pending}',
+                tuple(params) + (start, start + BACKFILL_BATCH_SIZE)
+            )
+    return step
+
+
+def set_not_null(table, column):
+    """Step that adds NOT NULL without scanning the table under an exclusive lock
+    
+    The column is first proven non-null by a NOT VALID check constraint that is
+    validated under a weaker lock; SET NOT NULL then reuses that proof.
+    """
+    constraint = f'{table}_{column}_not_null'
+    
+    def step(cur):
+        cur.execute('SELECT 1 FROM pg_constraint WHERE conname = %s', (constraint,))
+        if not cur.fetchone():
+            cur.execute(f'ALTER TABLE {table} ADD CONSTRAINT {constraint} CHECK ({column} IS NOT NULL) NOT VALID')
+        cur.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT {constraint}')
+        cur.execute(f'ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL')
+        cur.execute(f'ALTER TABLE {table} DROP CONSTRAINT {constraint}')
+    return step
+
+
+def create_index(name, definition):
+    """Step that builds an index without blocking writes
+    
+    An interrupted CREATE INDEX CONCURRENTLY leaves an invalid index behind,
+    which IF NOT EXISTS would happily skip, so such leftovers are dropped first.
+    """
+    def step(cur):
+        cur.execute(
+            'SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s',
+            (name,)
+        )
+        existing = cur.fetchone()
+        if existing and not existing['indisvalid']:
+            cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+        cur.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}')
+    return step
+
+
+MIGRATIONS = [
+    Migration(1, 'create users, notes and attachments tables', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(80) UNIQUE NOT NULL,
+            password_hash VARCHAR(255) NOT NULL,
+            description TEXT,
+            avatar VARCHAR(255),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS notes (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            title VARCHAR(200) NOT NULL,
+            content TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS attachments (
+            id SERIAL PRIMARY KEY,
+            note_id INTEGER NOT NULL,
+            filename VARCHAR(255) NOT NULL,
+            original_filename VARCHAR(255) NOT NULL,
+            file_size INTEGER,
+            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (note_id) REFERENCES notes (id) ON DELETE CASCADE
+        )
+        ''',
+    ]),
+    Migration(2, 'add profile columns and public notes', [
+        add_column('users', 'description', 'TEXT'),
+        add_column('users', 'avatar', 'VARCHAR(255)'),
+        add_column('notes', 'is_public', 'BOOLEAN DEFAULT FALSE'),
+    ]),
+    Migration(3, 'store note excerpts and content length', [
+        add_column('notes', 'excerpt', 'VARCHAR(150)'),
+        add_column('notes', 'content_length', 'INTEGER'),
+        backfill(
+            'notes',
+            "excerpt = LEFT(COALESCE(content, ''), %s), content_length = CHAR_LENGTH(COALESCE(content, ''))",
+            'content_length IS NULL',
+            (NOTE_EXCERPT_LENGTH,)
+        ),
+        "ALTER TABLE notes ALTER COLUMN excerpt SET DEFAULT '', ALTER COLUMN content_length SET DEFAULT 0",
+        set_not_null('notes', 'excerpt'),
+        set_not_null('notes', 'content_length'),
+    ], transactional=False),
+    Migration(4, 'add full-text search vector', [
+        add_column('notes', 'search_vector', 'TSVECTOR'),
+        backfill('notes', f'search_vector = {note_search_vector_sql("title", "content")}', 'search_vector IS NULL'),
+        create_index('notes_search_idx', 'notes USING GIN (search_vector)'),
+    ], transactional=False),
+    Migration(5, 'add indexes for route queries', [
+        # /notes: WHERE user_id ORDER BY (updated_at, id) DESC, keyset-paginated
+        create_index('notes_user_updated_idx', 'notes (user_id, updated_at DESC, id DESC)'),
+        # /profile and /user/<id>: public notes ORDER BY (created_at, id) DESC
+        create_index('notes_user_public_created_idx', 'notes (user_id, created_at DESC, id DESC) WHERE is_public = TRUE'),
+        # /notes/<id> attachment list, delete_note and the ON DELETE CASCADE from notes
+        create_index('attachments_note_idx', 'attachments (note_id, uploaded_at)'),
+    ], transactional=False),
+    Migration(6, 'add attachment checksums', [
+        add_column('attachments', 'checksum', 'CHAR(64)'),
+    ]),
+    Migration(7, 'index attachment storage keys for reference counting', [
+        # storage.release_blobs: is any other attachment row still using this file?
+        create_index('attachments_filename_idx', 'attachments (filename)'),
+    ], transactional=False),
+    Migration(8, 'add per-user notes version for conditional GETs', [
+        # Bumped in every transaction that changes a user's notes or their attachments
+        add_column('users', 'notes_version', 'BIGINT NOT NULL DEFAULT 0'),
+    ]),
+    Migration(9, 'add bulk import jobs and staging rows', [
+        '''
+        CREATE TABLE IF NOT EXISTS import_jobs (
+            id SERIAL PRIMARY KEY,
+            source TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'loading',
+            rows_loaded INTEGER NOT NULL DEFAULT 0,
+            merged_through INTEGER NOT NULL DEFAULT 0,
+            rows_imported INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''',
+        # Staging only: UNLOGGED skips WAL for COPY, and importer.py reloads
+        # the source file if a database crash empties it
+        '''
+        CREATE UNLOGGED TABLE IF NOT EXISTS import_rows (
+            job_id INTEGER NOT NULL REFERENCES import_jobs (id) ON DELETE CASCADE,
+            line_no INTEGER NOT NULL,
+            username VARCHAR(80),
+            title TEXT,
+            content TEXT,
+            is_public BOOLEAN,
+            created_at TIMESTAMP,
+            updated_at TIMESTAMP,
+            attachments JSONB,
+            error TEXT,
+            user_id INTEGER,
+            note_id INTEGER,
+            PRIMARY KEY (job_id, line_no)
+        )
+        ''',
+    ]),
+    Migration(10, 'add background job queue', [
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id BIGSERIAL PRIMARY KEY,
+            kind VARCHAR(50) NOT NULL,
+            payload JSONB NOT NULL DEFAULT '{}',
+            status VARCHAR(20) NOT NULL DEFAULT 'queued',
+            run_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            locked_until TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # jobs.claim: the next due queued job; failed jobs stay out of the index
+        "CREATE INDEX IF NOT EXISTS jobs_queued_idx ON jobs (run_at, id) WHERE status = 'queued'",
+    ]),
+    Migration(11, 'add per-note version for incremental saves', [
+        # Bumped by every update of a note; PATCH /api/v1/notes/<id> applies
+        # content edits only against the version they were made on
+        add_column('notes', 'version', 'INTEGER NOT NULL DEFAULT 1'),
+    ]),
+    Migration(12, 'index users by signup time for the API user list', [
+        # /api/v1/users: ORDER BY (created_at, id) DESC, keyset-paginated
+        create_index('users_created_idx', 'users (created_at DESC, id DESC)'),
+    ], transactional=False),
+]
+
+
+def _ensure_version_table(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(200) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _applied_versions(cur):
+    cur.execute('SELECT version FROM schema_version')
+    return {row['version'] for row in cur.fetchall()}
+
+
+def _run_steps(cur, migration):
+    for step in migration.steps:
+        if callable(step):
+            step(cur)
+        else:
+            cur.execute(step)
+    cur.execute(
+        'INSERT INTO schema_version (version, name) VALUES (%s, %s)',
+        (migration.version, migration.name)
+    )
+
+
+def migrate(target=None):
+    """Apply every pending migration up to target (default: latest), in order"""
+    conn = get_db_connection()
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK_ID,))
+    try:
+        _ensure_version_table(cur)
+        applied = _applied_versions(cur)
+        for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+            if migration.version in applied or (target is not None and migration.version > target):
+                continue
+            print(f'Applying migration {migration.version}: {migration.name}')
+            if migration.transactional:
+                conn.autocommit = False
+                try:
+                    _run_steps(cur, migration)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    conn.autocommit = True
+            else:
+                _run_steps(cur, migration)
+    finally:
+        cur.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK_ID,))
+        cur.close()
+        conn.close()
+
+
+def status():
+    """Print which migrations have been applied and which are pending"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    _ensure_version_table(cur)
+    conn.commit()
+    applied = _applied_versions(cur)
+    cur.close()
+    conn.close()
+    for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+        state = 'applied' if migration.version in applied else 'pending'
+        print(f'{migration.version:>4}  {state:<8} {migration.name}')
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'migrate'
+    if command == 'migrate':
+        migrate(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+        print("Database migration completed successfully!")
+    elif command == 'status':
+        status()
+    else:
+        print('Usage: python migrations.py [migrate [VERSION] | status]')
+        sys.exit(2)
@@ -0,0 +1,80 @@
+import base64
+import binascii
+from datetime import datetime
+
+
+class Page:
+    """One page of rows plus the cursors that lead to the neighbouring pages"""
+    
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+    
+    @property
+    def has_other_pages(self):
+        return bool(self.next_cursor or self.prev_cursor)
+
+
+def encode_cursor(sort_value, row_id):
+    """Encode a (timestamp, id) position as an opaque URL-safe token"""
+    raw = f'{sort_value.isoformat()}|{row_id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a token from encode_cursor, returning None if it is missing or malformed"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        sort_value, row_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(sort_value), int(row_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+def fetch_page(cur, query, params, sort_column, page_size, after=None, before=None, id_column='id'):
+    """Run a keyset-paginated query, newest first
+    
+    query must be a SELECT with a WHERE clause and no ORDER BY/LIMIT, and must
+    select both sort_column and id_column. Rows are ordered by (sort_column,
+    id_column) descending; after/before are cursors from a previous Page.
+    Only page_size + 1 rows are ever read, however many rows match.
+    """
+    sort_key = sort_column.rsplit('.', 1)[-1]
+    id_key = id_column.rsplit('.', 1)[-1]
+    after = decode_cursor(after)
+    before = decode_cursor(before) if after is None else None
+    
+    if before is not None:
+        # Walk backwards from the cursor, then flip the rows into display order
+        cur.execute(
+            f'{query} AND ({sort_column}, {id_column}) > (%s, %s) '
+            f'ORDER BY {sort_column} ASC, {id_column} ASC LIMIT %s',
+            tuple(params) + (before[0], before[1], page_size + 1)
+        )
+        rows = cur.fetchall()
+        has_prev = len(rows) > page_size
+        items = list(reversed(rows[:page_size]))
+        has_next = bool(items)
+    else:
+        if after is not None:
+            cur.execute(
+                f'{query} AND ({sort_column}, {id_column}) < (%s, %s) '
+                f'ORDER BY {sort_column} DESC, {id_column} DESC LIMIT %s',
+                tuple(params) + (after[0], after[1], page_size + 1)
+            )
+        else:
+            cur.execute(
+                f'{query} ORDER BY {sort_column} DESC, {id_column} DESC LIMIT %s',
+                tuple(params) + (page_size + 1,)
+            )
+        rows = cur.fetchall()
+        has_next = len(rows) > page_size
+        items = rows[:page_size]
+        has_prev = after is not None and bool(items)
+    
+    next_cursor = encode_cursor(items[-1][sort_key], items[-1][id_key]) if has_next else None
+    prev_cursor = encode_cursor(items[0][sort_key], items[0][id_key]) if has_prev else None
+    return Page(items, next_cursor=next_cursor, prev_cursor=prev_cursor)
@@ -0,0 +1,147 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+from config import Config
+
+
+class HashingBusy(Exception):
+    """Raised when the password hashing queue is full or a hash does not finish in time"""
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _check(password_hash, password):
+    return check_password_hash(password_hash, password)
+
+
+def _method_prefix(method):
+    """The parameter prefix ("scrypt:32768:8:1") werkzeug writes for a method setting"""
+    return generate_password_hash('', method=method).split('$', 1)[0]
+
+
+class PasswordHasher:
+    """Runs password hashing in a bounded pool of worker processes
+    
+    Hashing is deliberately CPU-heavy and holds the GIL, so it runs in
+    separate processes where it cannot stall other requests. At most
+    queue_limit hashes may be running or waiting at once; beyond that, or when
+    a hash takes longer than timeout seconds, HashingBusy is raised instead of
+    letting requests pile up. With workers=0 hashing runs inline.
+    """
+    
+    def __init__(self, method='scrypt', workers=2, queue_limit=8, timeout=5.0):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self.current_prefix = _method_prefix(method)
+        self._slots = threading.BoundedSemaphore(queue_limit)
+        self._lock = threading.Lock()
+        self._executor = None
+    
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: never fork a process holding threads and pooled sockets
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+    
+    def _run(self, fn, *args):
+        if self.workers == 0:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy('Password hashing queue is full')
+        # Until the done callback owns the slot, any failure must give it back
+        try:
+            executor = self._get_executor()
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._reset(executor)
+            raise HashingBusy('Password hashing workers were restarted')
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the hash really finishes, even after a timeout
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            raise HashingBusy(f'Password hashing took longer than {self.timeout}s')
+        except BrokenProcessPool:
+            self._reset(executor)
+            raise HashingBusy('Password hashing workers were restarted')
+    
+    def _reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+    
+    def hash(self, password):
+        """Hash a password with the configured method"""
+        return self._run(_hash, password, self.method)
+    
+    def verify(self, password_hash, password):
+        """Check a password, returning (matches, needs_rehash)
+        
+        needs_rehash is true when the stored hash was made with other
+        parameters than the configured method.
+        """
+        if not self._run(_check, password_hash, password):
+            return False, False
+        return True, password_hash.split('$', 1)[0] != self.current_prefix
+    
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+_hasher = None
+_hasher_lock = threading.Lock()
+
+
+def get_hasher():
+    """Return the process-wide password hasher, recreated after a fork"""
+    global _hasher
+    if _hasher is None or _hasher.pid != os.getpid():
+        with _hasher_lock:
+            if _hasher is None or _hasher.pid != os.getpid():
+                _hasher = PasswordHasher(
+                    method=Config.PASSWORD_HASH_METHOD,
+                    workers=Config.PASSWORD_HASH_WORKERS,
+                    queue_limit=Config.PASSWORD_HASH_QUEUE_LIMIT,
+                    timeout=Config.PASSWORD_HASH_TIMEOUT
+                )
+    return _hasher
+
+
+def authenticate(conn, username, password):
+    """Return the user row (id, username) if the password matches, else None
+    
+    A stored hash made with outdated parameters is replaced, unless it changed
+    meanwhile; a busy hasher just leaves the upgrade for the next login.
+    """
+    cur = conn.cursor()
+    cur.execute('SELECT id, username, password_hash FROM users WHERE username = %s', (username,))
+    user = cur.fetchone()
+    matches, needs_rehash = get_hasher().verify(user['password_hash'], password) if user else (False, False)
+    if matches and needs_rehash:
+        try:
+            cur.execute(
+                'UPDATE users SET password_hash = %s WHERE id = %s AND password_hash = %s',
+                (get_hasher().hash(password), user['id'], user['password_hash'])
+            )
+            conn.commit()
+        except HashingBusy:
+            pass
+    cur.close()
+    return {'id': user['id'], 'username': user['username']} if matches else None
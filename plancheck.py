@@ -0,0 +1,152 @@
+import argparse
+import sys
+
+from database import get_db_connection
+from repository import prepare_statements
+from seed import seed_dataset
+
+# The statements each route issues, mirroring app.py, with sample parameters
+# filled in from the database. A route listed with a reason is expected to
+# scan its whole table and is reported without failing the check.
+ROUTE_QUERIES = [
+    ('/login', 'SELECT id, username, password_hash FROM users WHERE username = %(username)s', None),
+    ('/users', 'SELECT id, username, description, avatar FROM users ORDER BY username', 'lists every user'),
+    ('/user/<id>', 'SELECT id, username, description, avatar FROM users WHERE id = %(user_id)s', None),
+    ('/user/<id>, /profile (public notes)', '''
+        SELECT id, title, excerpt, content_length, created_at FROM notes
+        WHERE user_id = %(user_id)s AND is_public = TRUE
+        ORDER BY created_at DESC, id DESC LIMIT %(limit)s
+    ''', None),
+    ('/user/<id>, /profile (public notes, next page)', '''
+        SELECT id, title, excerpt, content_length, created_at FROM notes
+        WHERE user_id = %(user_id)s AND is_public = TRUE AND (created_at, id) < (%(created_at)s, %(note_id)s)
+        ORDER BY created_at DESC, id DESC LIMIT %(limit)s
+    ''', None),
+    ('/api/v1/users', '''
+        SELECT id, username, description, avatar, created_at FROM users WHERE TRUE
+        ORDER BY created_at DESC, id DESC LIMIT %(limit)s
+    ''', None),
+    ('/api/v1/users (next page)', '''
+        SELECT id, username, description, avatar, created_at FROM users
+        WHERE TRUE AND (created_at, id) < (%(user_created_at)s, %(user_id)s)
+        ORDER BY created_at DESC, id DESC LIMIT %(limit)s
+    ''', None),
+    ('/notes (validator)', 'SELECT notes_version FROM users WHERE id = %(user_id)s', None),
+    ('/notes', '''
+        SELECT id, title, excerpt, content_length, created_at, updated_at FROM notes
+        WHERE user_id = %(user_id)s ORDER BY updated_at DESC, id DESC LIMIT %(limit)s
+    ''', None),
+    ('/notes (next page)', '''
+        SELECT id, title, excerpt, content_length, created_at, updated_at FROM notes
+        WHERE user_id = %(user_id)s AND (updated_at, id) < (%(updated_at)s, %(note_id)s)
+        ORDER BY updated_at DESC, id DESC LIMIT %(limit)s
+    ''', None),
+    # Prepared statements from repository.py, each a route's single round trip
+    ('/notes/<id>', 'EXECUTE note_view (%(note_id)s)', None),
+    ('/notes/<id>/edit', 'EXECUTE note_for_edit (%(note_id)s)', None),
+    ('/notes/<id>/edit (update)', "EXECUTE note_update (%(note_id)s, %(user_id)s, %(title)s, '', '', 0, FALSE)", None),
+    ('/notes/<id>/delete', 'EXECUTE note_delete (%(note_id)s, %(user_id)s)', None),
+    ('/attachments/<id>/delete', 'EXECUTE attachment_delete (%(attachment_id)s, %(user_id)s)', None),
+    ('/attachments/<id>/download', '''
+        SELECT a.filename, a.original_filename, n.user_id FROM attachments a
+        JOIN notes n ON a.note_id = n.id WHERE a.id = %(attachment_id)s
+    ''', None),
+    ('/attachments/<id>/delete (file references)', 'SELECT 1 FROM attachments WHERE filename = %(filename)s LIMIT 1', None),
+    ('/api/v1/notes (attachments of a page)', '''
+        SELECT id, note_id, original_filename, file_size, checksum, uploaded_at FROM attachments
+        WHERE note_id = ANY(%(note_ids)s) ORDER BY uploaded_at, id
+    ''', None),
+    ('/search', '''
+        SELECT id, ts_rank_cd(search_vector, query) AS rank
+        FROM notes, websearch_to_tsquery('english', %(search)s) AS query
+        WHERE search_vector @@ query AND (user_id = %(user_id)s OR is_public = TRUE)
+        ORDER BY rank DESC, id DESC LIMIT %(limit)s
+    ''', None),
+]
+
+
+def sample_parameters(cur):
+    """Pick realistic parameter values: the user with the most notes and one of their notes"""
+    cur.execute('''
+        SELECT u.id AS user_id, u.username, u.created_at AS user_created_at FROM users u
+        JOIN notes n ON n.user_id = u.id
+        GROUP BY u.id ORDER BY COUNT(*) DESC LIMIT 1
+    ''')
+    user = cur.fetchone()
+    if not user:
+        return None
+    cur.execute(
+        'SELECT id AS note_id, title, created_at, updated_at FROM notes WHERE user_id = %s ORDER BY updated_at DESC LIMIT 1 OFFSET 20',
+        (user['user_id'],)
+    )
+    note = cur.fetchone()
+    if not note:
+        cur.execute(
+            'SELECT id AS note_id, title, created_at, updated_at FROM notes WHERE user_id = %s LIMIT 1',
+            (user['user_id'],)
+        )
+        note = cur.fetchone()
+    cur.execute('SELECT id AS attachment_id, filename FROM attachments ORDER BY id LIMIT 1')
+    attachment = cur.fetchone() or {'attachment_id': 0, 'filename': ''}
+    params = dict(user)
+    params.update(note)
+    params.update(attachment)
+    params['limit'] = 21
+    params['note_ids'] = [note['note_id']]
+    params['search'] = note['title'].split()[-1]
+    return params
+
+
+def seq_scans(plan):
+    """Yield the relation name of every Seq Scan node in an EXPLAIN (FORMAT JSON) plan"""
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan.get('Relation Name')
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child)
+
+
+def check_plans(conn):
+    """EXPLAIN every route query and return the routes with unexpected sequential scans"""
+    prepare_statements(conn)
+    cur = conn.cursor()
+    params = sample_parameters(cur)
+    if params is None:
+        cur.close()
+        raise SystemExit('No notes in the database; run with --seed or load data first')
+    
+    # On a small table a seq scan is cheaper than any index, so the planner
+    # would pick one even with the right index in place. Disabling them makes
+    # it use an index whenever one fits; a seq scan then means there is none.
+    cur.execute('SET LOCAL enable_seqscan = off')
+    failures = []
+    for route, sql, allowed_reason in ROUTE_QUERIES:
+        cur.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cur.fetchone()['QUERY PLAN'][0]['Plan']
+        tables = sorted(set(seq_scans(plan)))
+        if not tables:
+            print(f'ok        {route}')
+        elif allowed_reason:
+            print(f'allowed   {route}: seq scan on {", ".join(tables)} ({allowed_reason})')
+        else:
+            print(f'SEQ SCAN  {route}: seq scan on {", ".join(tables)}')
+            failures.append(route)
+    conn.rollback()
+    cur.close()
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report route queries that still use sequential scans')
+    parser.add_argument('--seed', action='store_true', help='insert a synthetic dataset first (see seed.py)')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--notes-per-user', type=int, default=200)
+    args = parser.parse_args()
+    
+    conn = get_db_connection()
+    if args.seed:
+        print('Seeded {} users, {} notes, {} attachments'.format(
+            *seed_dataset(conn, users=args.users, notes_per_user=args.notes_per_user)
+        ))
+    failures = check_plans(conn)
+    conn.close()
+    sys.exit(1 if failures else 0)
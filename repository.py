@@ -0,0 +1,150 @@
+from database import note_search_vector_sql
+from jobs import JOBS_CHANNEL
+
+# Server-side prepared statements for the note routes, each doing a route's
+# whole database work (ownership check included) in one round trip. Every
+# pooled connection prepares them once when it is opened; name: (parameter
+# types, read-only, SQL).
+STATEMENTS = {
+    # A note with its owner's notes version and its attachments, one row per
+    # attachment (a single row of NULL attachment columns if there are none)
+    'note_view': ('integer', True, '''
+        SELECT n.id, n.user_id, n.title, n.content, n.is_public, n.created_at, n.updated_at, u.notes_version,
+            a.id AS attachment_id, a.filename, a.original_filename, a.file_size, a.uploaded_at
+        FROM notes n JOIN users u ON u.id = n.user_id
+        LEFT JOIN attachments a ON a.note_id = n.id
+        WHERE n.id = $1
+        ORDER BY a.uploaded_at, a.id
+    '''),
+    'note_for_edit': ('integer', True, '''
+        SELECT id, user_id, title, content, is_public, version FROM notes WHERE id = $1
+    '''),
+    # $1 note, $2 acting user, $3 title, $4 content, $5 excerpt, $6 length, $7 public;
+    # only the owner's update applies, and it bumps their notes version
+    'note_update': ('integer, integer, text, text, text, integer, boolean', False, f'''
+        WITH note AS (SELECT id, user_id, is_public FROM notes WHERE id = $1),
+        updated AS (
+            UPDATE notes n SET title = $3, content = $4, excerpt = $5, content_length = $6, is_public = $7,
+                search_vector = {note_search_vector_sql('$3', '$4')}, version = n.version + 1,
+                updated_at = CURRENT_TIMESTAMP
+            FROM note WHERE n.id = note.id AND note.user_id = $2
+            RETURNING n.id
+        ),
+        bumped AS (
+            UPDATE users SET notes_version = notes_version + 1
+            WHERE id = $2 AND EXISTS (SELECT 1 FROM updated)
+        )
+        SELECT note.user_id, note.is_public AS was_public, EXISTS (SELECT 1 FROM updated) AS done FROM note
+    '''),
+    # Deletes the owner's note (attachment rows cascade), bumps their notes
+    # version and queues a release_blobs job for the files it referenced
+    'note_delete': ('integer, integer', False, f'''
+        WITH note AS (SELECT id, user_id, is_public FROM notes WHERE id = $1),
+        deleted AS (
+            DELETE FROM notes n USING note WHERE n.id = note.id AND note.user_id = $2
+            RETURNING n.id
+        ),
+        files AS (SELECT a.filename FROM attachments a JOIN deleted ON a.note_id = deleted.id),
+        bumped AS (
+            UPDATE users SET notes_version = notes_version + 1
+            WHERE id = $2 AND EXISTS (SELECT 1 FROM deleted)
+        ),
+        queued AS (
+            INSERT INTO jobs (kind, payload)
+            SELECT 'release_blobs', jsonb_build_object('filenames', jsonb_agg(filename)) FROM files
+            HAVING COUNT(*) > 0
+            RETURNING kind
+        ),
+        notified AS MATERIALIZED (SELECT pg_notify('{JOBS_CHANNEL}', kind) FROM queued)
+        SELECT note.user_id, note.is_public, EXISTS (SELECT 1 FROM deleted) AS done,
+            (SELECT COUNT(*) FROM notified) AS jobs_queued
+        FROM note
+    '''),
+    # Deletes an attachment of one of the acting user's notes, bumps their
+    # notes version and queues a release_blobs job for its file
+    'attachment_delete': ('integer, integer', False, f'''
+        WITH target AS (
+            SELECT a.id, a.filename, a.note_id, n.user_id FROM attachments a
+            JOIN notes n ON n.id = a.note_id WHERE a.id = $1
+        ),
+        deleted AS (
+            DELETE FROM attachments a USING target WHERE a.id = target.id AND target.user_id = $2
+            RETURNING a.filename
+        ),
+        bumped AS (
+            UPDATE users SET notes_version = notes_version + 1
+            WHERE id = $2 AND EXISTS (SELECT 1 FROM deleted)
+        ),
+        queued AS (
+            INSERT INTO jobs (kind, payload)
+            SELECT 'release_blobs', jsonb_build_object('filenames', jsonb_build_array(filename)) FROM deleted
+            RETURNING kind
+        ),
+        notified AS MATERIALIZED (SELECT pg_notify('{JOBS_CHANNEL}', kind) FROM queued)
+        SELECT target.note_id, target.user_id, EXISTS (SELECT 1 FROM deleted) AS done,
+            (SELECT COUNT(*) FROM notified) AS jobs_queued
+        FROM target
+    '''),
+}
+
+
+def prepare_statements(conn, readonly=False):
+    """PREPARE every statement on a new connection in one round trip (read-only ones only on replicas)"""
+    sql = ';'.join(
+        f'PREPARE {name} ({types}) AS {statement}'
+        for name, (types, is_readonly, statement) in STATEMENTS.items()
+        if is_readonly or not readonly
+    )
+    cur = conn.cursor()
+    cur.execute(sql)
+    cur.close()
+    conn.commit()
+
+
+def _execute(cur, name, *params):
+    cur.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+    return cur.fetchall()
+
+
+def note_with_attachments(cur, note_id):
+    """Return (note, attachments) for a note, or (None, []) if it does not exist"""
+    rows = _execute(cur, 'note_view', note_id)
+    if not rows:
+        return None, []
+    attachment_columns = ('attachment_id', 'filename', 'original_filename', 'file_size', 'uploaded_at')
+    note = {key: value for key, value in rows[0].items() if key not in attachment_columns}
+    attachments = [
+        {
+            'id': row['attachment_id'],
+            'filename': row['filename'],
+            'original_filename': row['original_filename'],
+            'file_size': row['file_size'],
+            'uploaded_at': row['uploaded_at'],
+        }
+        for row in rows if row['attachment_id'] is not None
+    ]
+    return note, attachments
+
+
+def note_for_edit(cur, note_id):
+    """Return the editable fields of a note, or None if it does not exist"""
+    rows = _execute(cur, 'note_for_edit', note_id)
+    return rows[0] if rows else None
+
+
+def update_note(cur, note_id, user_id, title, content, excerpt, is_public):
+    """Update a note if user_id owns it; returns {user_id, was_public, done} or None if there is no such note"""
+    rows = _execute(cur, 'note_update', note_id, user_id, title, content, excerpt, len(content), is_public)
+    return rows[0] if rows else None
+
+
+def delete_note(cur, note_id, user_id):
+    """Delete a note if user_id owns it; returns {user_id, is_public, done} or None if there is no such note"""
+    rows = _execute(cur, 'note_delete', note_id, user_id)
+    return rows[0] if rows else None
+
+
+def delete_attachment(cur, attachment_id, user_id):
+    """Delete an attachment if user_id owns its note; returns {note_id, user_id, done} or None if there is none"""
+    rows = _execute(cur, 'attachment_delete', attachment_id, user_id)
+    return rows[0] if rows else None
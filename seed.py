@@ -0,0 +1,109 @@
+import argparse
+
+from werkzeug.security import generate_password_hash
+from database import get_db_connection, note_search_vector_sql, NOTE_EXCERPT_LENGTH
+
+# Every seeded account uses this prefix and password, so seeded data is easy
+# to recognise, log into from load tests, and remove again
+SEED_USER_PREFIX = 'seed_'
+SEED_USERNAME_PATTERN = 'seed\\_%'
+SEED_PASSWORD = 'seed-password'
+
+
+def seed_dataset(conn, users=200, notes_per_user=200, public_ratio=0.2, attachments_per_note=0.5, content_words=300):
+    """Insert a synthetic dataset of users, notes of varying size and attachment rows
+    
+    Rows are generated server-side with generate_series, so even large datasets
+    load in seconds. Safe to run again: it only fills in what is missing.
+    Returns the number of (users, notes, attachments) added.
+    """
+    cur = conn.cursor()
+    password_hash = generate_password_hash(SEED_PASSWORD)
+    cur.execute(
+        '''
+        INSERT INTO users (username, password_hash, description)
+        SELECT %s || g, %s, 'Seeded user number ' || g
+        FROM generate_series(1, %s) g
+        ON CONFLICT (username) DO NOTHING
+        ''',
+        (SEED_USER_PREFIX, password_hash, users)
+    )
+    users_added = cur.rowcount
+    
+    # Note bodies are random hex words; their length varies from a few words
+    # up to twice content_words so list and detail pages see realistic spread.
+    # Only seeded users without notes get any, and only notes added here get
+    # attachment rows, so running the seed again adds nothing twice.
+    cur.execute(
+        f'''
+        WITH new_notes AS (
+            INSERT INTO notes (user_id, title, content, excerpt, content_length, is_public, search_vector, created_at, updated_at)
+            SELECT user_id, title, content, LEFT(content, %s), CHAR_LENGTH(content), is_public,
+                {note_search_vector_sql('title', 'content')}, created_at, LEAST(now(), created_at + random() * interval '30 days')
+            FROM (
+                SELECT u.id AS user_id,
+                    'Seed note ' || n || ' ' || md5(random()::text) AS title,
+                    repeat(md5(random()::text) || ' ', 1 + (random() * %s * 2)::int) AS content,
+                    random() < %s AS is_public,
+                    now() - random() * interval '365 days' AS created_at
+                FROM users u CROSS JOIN generate_series(1, %s) n
+                WHERE u.username LIKE %s AND NOT EXISTS (SELECT 1 FROM notes WHERE user_id = u.id)
+            ) generated
+            RETURNING id, created_at
+        ),
+        new_attachments AS (
+            INSERT INTO attachments (note_id, filename, original_filename, file_size, uploaded_at)
+            SELECT id, 'seed-' || id || '.txt', 'attachment-' || id || '.txt', (random() * 1000000)::int, created_at
+            FROM new_notes WHERE random() < %s
+            RETURNING id
+        )
+        SELECT (SELECT COUNT(*) FROM new_notes) AS notes, (SELECT COUNT(*) FROM new_attachments) AS attachments
+        ''',
+        (NOTE_EXCERPT_LENGTH, content_words, public_ratio, notes_per_user, SEED_USERNAME_PATTERN, attachments_per_note)
+    )
+    added = cur.fetchone()
+    notes_added, attachments_added = added['notes'], added['attachments']
+    
+    conn.commit()
+    cur.execute('ANALYZE users')
+    cur.execute('ANALYZE notes')
+    cur.execute('ANALYZE attachments')
+    conn.commit()
+    cur.close()
+    return users_added, notes_added, attachments_added
+
+
+def remove_seed_data(conn):
+    """Delete every seeded user; their notes and attachments cascade with them"""
+    cur = conn.cursor()
+    cur.execute('DELETE FROM users WHERE username LIKE %s', (SEED_USERNAME_PATTERN,))
+    removed = cur.rowcount
+    conn.commit()
+    cur.close()
+    return removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Seed the configured database with synthetic VibeNotes data')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--notes-per-user', type=int, default=200)
+    parser.add_argument('--public-ratio', type=float, default=0.2)
+    parser.add_argument('--attachments-per-note', type=float, default=0.5)
+    parser.add_argument('--content-words', type=int, default=300)
+    parser.add_argument('--remove', action='store_true', help='delete previously seeded users instead')
+    args = parser.parse_args()
+    
+    conn = get_db_connection()
+    if args.remove:
+        print(f'Removed {remove_seed_data(conn)} seeded users')
+    else:
+        added = seed_dataset(
+            conn,
+            users=args.users,
+            notes_per_user=args.notes_per_user,
+            public_ratio=args.public_ratio,
+            attachments_per_note=args.attachments_per_note,
+            content_words=args.content_words
+        )
+        print('Seeded {} users, {} notes, {} attachments'.format(*added))
+    conn.close()
@@ -0,0 +1,131 @@
+// Debounced autosave for the edit page. Each save sends only what changed
+// since the last one: the changed middle of the content as a single text
+// edit, plus the title or visibility if those changed, to
+// PATCH /api/v1/notes/<id>, against the version the page last saw.
+(function () {
+    var form = document.querySelector('form[data-autosave-url]');
+    if (!form || !window.fetch || !window.JSON) {
+        return;
+    }
+    
+    var DELAY = 1500;
+    var url = form.dataset.autosaveUrl;
+    var version = parseInt(form.dataset.version, 10);
+    var title = form.querySelector('#title');
+    var content = form.querySelector('#content');
+    var isPublic = form.querySelector('#is_public');
+    var status = form.querySelector('.autosave-status');
+    var saved = {title: title.value, content: content.value, isPublic: isPublic.checked};
+    var timer = null;
+    var saving = false;
+    var stopped = false;
+    
+    function show(message) {
+        status.textContent = message;
+    }
+    
+    // The smallest single edit turning before into after: everything between
+    // their common prefix and common suffix. Offsets are string indices
+    // (UTF-16 code units), which is what the server counts.
+    function diff(before, after) {
+        var start = 0;
+        var shorter = Math.min(before.length, after.length);
+        while (start < shorter && before.charCodeAt(start) === after.charCodeAt(start)) {
+            start++;
+        }
+        var endBefore = before.length;
+        var endAfter = after.length;
+        while (endBefore > start && endAfter > start && before.charCodeAt(endBefore - 1) === after.charCodeAt(endAfter - 1)) {
+            endBefore--;
+            endAfter--;
+        }
+        return {start: start, end: endBefore, text: after.slice(start, endAfter)};
+    }
+    
+    function schedule() {
+        if (stopped) {
+            return;
+        }
+        clearTimeout(timer);
+        timer = setTimeout(save, DELAY);
+    }
+    
+    function save() {
+        timer = null;
+        if (stopped) {
+            return;
+        }
+        if (saving) {
+            schedule();
+            return;
+        }
+        var current = {title: title.value, content: content.value, isPublic: isPublic.checked};
+        var body = {version: version};
+        if (current.content !== saved.content) {
+            body.content_edits = [diff(saved.content, current.content)];
+        }
+        // An empty title would be rejected; the form's own validation covers it
+        if (current.title !== saved.title && current.title.trim()) {
+            body.title = current.title;
+        }
+        if (current.isPublic !== saved.isPublic) {
+            body.is_public = current.isPublic;
+        }
+        if (Object.keys(body).length === 1) {
+            return;
+        }
+        
+        saving = true;
+        show('Saving...');
+        fetch(url, {
+            method: 'PATCH',
+            credentials: 'same-origin',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify(body),
+            // Lets the last save finish when the page is being left
+            keepalive: true
+        }).then(function (response) {
+            return response.json().then(function (data) {
+                return {status: response.status, data: data};
+            });
+        }).then(function (result) {
+            saving = false;
+            if (result.status === 200) {
+                version = result.data.version;
+                saved.content = current.content;
+                if ('title' in body) {
+                    saved.title = current.title;
+                }
+                if ('is_public' in body) {
+                    saved.isPublic = current.isPublic;
+                }
+                show('Saved');
+            } else if (result.status === 409) {
+                stopped = true;
+                show('This note was changed elsewhere. Reload the page to keep editing the latest version.');
+            } else {
+                show('Not saved: ' + (result.data.error || 'error ' + result.status));
+            }
+        }).catch(function () {
+            saving = false;
+            show('Not saved; retrying...');
+            schedule();
+        });
+    }
+    
+    title.addEventListener('input', schedule);
+    content.addEventListener('input', schedule);
+    isPublic.addEventListener('change', schedule);
+    // Save what is pending when the page is hidden or left
+    window.addEventListener('pagehide', function () {
+        if (timer !== null) {
+            clearTimeout(timer);
+            save();
+        }
+    });
+    // Submitting the form saves everything (and any new attachments) itself
+    form.addEventListener('submit', function () {
+        stopped = true;
+        clearTimeout(timer);
+    });
+})();
@@ -0,0 +1,222 @@
+import hashlib
+import os
+import sys
+import uuid
+
+from psycopg2.extras import execute_values
+from werkzeug.utils import secure_filename
+
+# Bytes read from an upload per write/hash iteration
+CHUNK_SIZE = 64 * 1024
+
+# Uploads are written here first, on the same filesystem as the blobs so
+# moving one into place is an atomic rename
+INCOMING_DIR = '.incoming'
+
+# Legacy attachment rows converted per transaction by migrate_flat_files
+MIGRATE_BATCH_SIZE = 500
+
+
+def blob_key(checksum):
+    """Storage key for content with the given SHA-256, sharded two levels deep
+    
+    Attachments are stored once per distinct content as ab/cd/abcd..., so the
+    top-level directories never hold more than 256 entries each.
+    """
+    return f'{checksum[:2]}/{checksum[2:4]}/{checksum}'
+
+
+def _lock_id(filename):
+    """Map a storage key to a signed 64-bit Postgres advisory lock id"""
+    digest = hashlib.sha256(filename.encode()).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def _hash_stream(stream, out=None):
+    """Read a stream to the end, returning (size, sha256 hex) and copying it to out if given"""
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        size += len(chunk)
+        if out is not None:
+            out.write(chunk)
+    return size, digest.hexdigest()
+
+
+def store_uploads(files, folder, allowed):
+    """Write every allowed upload to the incoming area and return its attachment metadata
+    
+    Each file is streamed to disk once, computing its size and checksum as it
+    goes. The returned entries are moved into content-addressed storage by
+    place_blobs inside the transaction that references them. If any file
+    fails, everything written so far is removed again.
+    """
+    incoming = os.path.join(folder, INCOMING_DIR)
+    os.makedirs(incoming, exist_ok=True)
+    stored = []
+    try:
+        for file in files:
+            if not (file and file.filename and allowed(file.filename)):
+                continue
+            ext = file.filename.rsplit('.', 1)[1].lower()
+            original_filename = secure_filename(file.filename) or f'attachment.{ext}'
+            temp_path = os.path.join(incoming, uuid.uuid4().hex)
+            try:
+                with open(temp_path, 'wb') as out:
+                    file_size, checksum = _hash_stream(file.stream, out)
+            except Exception:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            stored.append({
+                'filename': blob_key(checksum),
+                'original_filename': original_filename,
+                'file_size': file_size,
+                'checksum': checksum,
+                'temp_path': temp_path,
+                'created': False,
+            })
+    except Exception:
+        discard_uploads(stored)
+        raise
+    return stored
+
+
+def place_blobs(cur, folder, stored):
+    """Move uploaded files into content-addressed storage, deduplicating identical content
+    
+    Must run inside the transaction that inserts the attachment rows: the
+    per-blob transaction-level advisory lock it takes keeps release_blobs from
+    deleting a blob between this check and that transaction's commit.
+    """
+    for attachment in sorted(stored, key=lambda a: a['filename']):
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (_lock_id(attachment['filename']),))
+        path = os.path.join(folder, attachment['filename'])
+        if os.path.exists(path):
+            os.remove(attachment['temp_path'])
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(attachment['temp_path'], path)
+            attachment['created'] = True
+        attachment['temp_path'] = None
+
+
+def discard_uploads(stored):
+    """Remove incoming files that were never moved into storage"""
+    for attachment in stored:
+        if attachment.get('temp_path') and os.path.exists(attachment['temp_path']):
+            os.remove(attachment['temp_path'])
+            attachment['temp_path'] = None
+
+
+def abandon_uploads(conn, folder, stored):
+    """Clean up after the transaction for stored was rolled back"""
+    discard_uploads(stored)
+    release_blobs(conn, folder, [a['filename'] for a in stored if a['created']])
+
+
+def insert_attachments(cur, note_id, stored):
+    """Insert the metadata rows for a note's new attachments in one statement"""
+    if not stored:
+        return
+    execute_values(
+        cur,
+        'INSERT INTO attachments (note_id, filename, original_filename, file_size, checksum) VALUES %s',
+        [
+            (note_id, a['filename'], a['original_filename'], a['file_size'], a['checksum'])
+            for a in stored
+        ]
+    )
+
+
+def release_blobs(conn, folder, filenames):
+    """Delete stored files that no attachment row references any more
+    
+    Call after committing the deletes that dropped the references. Each blob
+    is checked and removed under a session-level advisory lock, so a
+    concurrent upload of the same content either sees the blob still in place
+    or finds it gone and writes it again.
+    """
+    cur = conn.cursor()
+    for filename in sorted(set(filenames)):
+        lock_id = _lock_id(filename)
+        cur.execute('SELECT pg_advisory_lock(%s)', (lock_id,))
+        try:
+            cur.execute('SELECT 1 FROM attachments WHERE filename = %s LIMIT 1', (filename,))
+            if cur.fetchone() is None:
+                path = os.path.join(folder, filename)
+                if os.path.exists(path):
+                    os.remove(path)
+        finally:
+            cur.execute('SELECT pg_advisory_unlock(%s)', (lock_id,))
+            conn.commit()
+    cur.close()
+
+
+def migrate_flat_files(conn, folder):
+    """Move attachments saved under the old flat uuid naming into content-addressed storage
+    
+    Rows are converted in batches: each legacy file is hashed, hard-linked (or
+    copied) to its blob path, the row is repointed and committed, and only then
+    is the old file removed, so an interrupted run can simply be restarted.
+    Returns (converted, missing) row counts.
+    """
+    cur = conn.cursor()
+    converted = missing = 0
+    last_id = 0
+    while True:
+        cur.execute(
+            "SELECT id, filename FROM attachments WHERE filename NOT LIKE '%%/%%' AND id > %s ORDER BY id LIMIT %s",
+            (last_id, MIGRATE_BATCH_SIZE)
+        )
+        rows = cur.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]['id']
+        moved = []
+        for row in rows:
+            old_path = os.path.join(folder, row['filename'])
+            if not os.path.exists(old_path):
+                missing += 1
+                continue
+            with open(old_path, 'rb') as f:
+                _, checksum = _hash_stream(f)
+            key = blob_key(checksum)
+            cur.execute('SELECT pg_advisory_xact_lock(%s)', (_lock_id(key),))
+            new_path = os.path.join(folder, key)
+            if not os.path.exists(new_path):
+                os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                try:
+                    os.link(old_path, new_path)
+                except OSError:
+                    with open(old_path, 'rb') as src, open(new_path, 'wb') as dst:
+                        _hash_stream(src, dst)
+            cur.execute(
+                'UPDATE attachments SET filename = %s, checksum = %s WHERE id = %s',
+                (key, checksum, row['id'])
+            )
+            moved.append(old_path)
+        conn.commit()
+        for old_path in moved:
+            os.remove(old_path)
+        converted += len(moved)
+    cur.close()
+    return converted, missing
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['migrate-flat']:
+        print('Usage: python storage.py migrate-flat')
+        sys.exit(2)
+    
+    from app import ATTACHMENTS_FOLDER
+    from database import get_db_connection
+    
+    conn = get_db_connection()
+    converted, missing = migrate_flat_files(conn, ATTACHMENTS_FOLDER)
+    conn.close()
+    print(f'Moved {converted} attachments into content-addressed storage ({missing} rows had no file on disk)')
@@ -0,0 +1,40 @@
+import csv
+import io
+import json
+
+import pytest
+
+from importer import STAGING_COLUMNS, staging_lines
+
+
+def _staged(tmp_path, *records):
+    path = tmp_path / 'notes.ndjson'
+    path.write_text(''.join(json.dumps(record) + '\n' for record in records))
+    lines = ''.join(staging_lines(str(path), 'ndjson', 'alice'))
+    return [dict(zip(STAGING_COLUMNS, row)) for row in csv.reader(io.StringIO(lines))]
+
+
+@pytest.mark.parametrize('record, error', [
+    ({'username': 12345, 'title': 'Note'}, 'username must be a string, not int'),
+    ({'title': {'text': 'Note'}}, 'title must be a string, not dict'),
+    ({'title': 'Note', 'content': ['a', 'b']}, 'content must be a string, not list'),
+    ({'username': 'u' * 81, 'title': 'Note'}, 'username too long (81 characters, at most 80)'),
+])
+def test_bad_fields_are_rejected_per_row(tmp_path, record, error):
+    bad, good = _staged(tmp_path, record, {'title': 'Fine'})
+    assert bad['error'] == error
+    assert good['error'] == '\\N'
+    assert good['username'] == 'alice'
+
+
+def test_plain_export_imports_without_its_attachment_metadata(tmp_path):
+    # What export.py's plain NDJSON export writes: attachment metadata, no files
+    metadata = {'id': 7, 'filename': 'report.pdf', 'file_size': 1024, 'checksum': 'ab' * 32}
+    (row,) = _staged(tmp_path, {'title': 'Note', 'attachments': [metadata]})
+    assert row['error'] == '\\N'
+    assert json.loads(row['attachments']) == []
+
+
+def test_zip_export_attachments_keep_their_paths(tmp_path):
+    (row,) = _staged(tmp_path, {'title': 'Note', 'attachments': [{'path': 'attachments/1/7/report.pdf', 'filename': 'report.pdf'}]})
+    assert json.loads(row['attachments']) == [{'path': 'attachments/1/7/report.pdf', 'filename': 'report.pdf'}]
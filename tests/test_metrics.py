@@ -0,0 +1,38 @@
+from flask import Flask, g, stream_with_context
+from prometheus_client import REGISTRY
+
+import metrics
+
+
+def _streaming_app():
+    app = Flask(__name__)
+    metrics.init_app(app)
+    
+    @app.route('/streamed')
+    def streamed():
+        def rows():
+            # What database.TimedCursor does for every fetch while the page streams
+            for row in range(3):
+                g.db_queries = g.get('db_queries', 0) + 1
+                yield f'{row}\n'
+        return app.response_class(stream_with_context(rows()), mimetype='text/plain')
+    
+    return app
+
+
+def _sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_streamed_response_is_observed_once_fully_sent():
+    client = _streaming_app().test_client()
+    requests_before = _sample('vibenotes_request_duration_seconds_count', endpoint='streamed', method='GET', status='200')
+    queries_before = _sample('vibenotes_request_db_queries_sum', endpoint='streamed')
+    
+    response = client.get('/streamed')
+    assert _sample('vibenotes_request_duration_seconds_count', endpoint='streamed', method='GET', status='200') == requests_before
+    
+    assert response.get_data() == b'0\n1\n2\n'
+    response.close()
+    assert _sample('vibenotes_request_duration_seconds_count', endpoint='streamed', method='GET', status='200') == requests_before + 1
+    assert _sample('vibenotes_request_db_queries_sum', endpoint='streamed') == queries_before + 3
@@ -0,0 +1,19 @@
+import pytest
+
+from passwords import PasswordHasher
+
+
+class _FailingExecutor:
+    def submit(self, fn, *args):
+        raise RuntimeError('cannot schedule new futures after shutdown')
+
+
+def test_failed_submit_gives_its_queue_slot_back():
+    hasher = PasswordHasher(workers=1, queue_limit=1)
+    hasher._executor = _FailingExecutor()
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            hasher.hash('secret')
+    # With the slot leaked, the full queue would raise HashingBusy instead
+    assert hasher._slots.acquire(blocking=False)
+    hasher._slots.release()
@@ -0,0 +1,25 @@
+from flask import Flask, g, stream_with_context
+
+import database
+from config import Config
+
+
+def test_queries_run_while_streaming_count_toward_the_budget(monkeypatch, caplog):
+    monkeypatch.setattr(Config, 'QUERY_BUDGET', 2)
+    app = Flask(__name__)
+    database.init_app(app)
+    
+    @app.route('/streamed')
+    def streamed():
+        def rows():
+            # What database.TimedCursor does for every fetch while the page streams
+            for row in range(3):
+                g.db_queries = g.get('db_queries', 0) + 1
+                yield f'{row}\n'
+        return app.response_class(stream_with_context(rows()), mimetype='text/plain')
+    
+    response = app.test_client().get('/streamed')
+    assert 'Query budget exceeded' not in caplog.text
+    response.get_data()
+    response.close()
+    assert 'Query budget exceeded in GET /streamed (streamed): 3 queries, budget 2' in caplog.text
@@ -0,0 +1,131 @@
+import threading
+import time
+
+import psycopg2
+import pytest
+
+from config import Config
+from database import TimedCursor, get_db_connection
+from storage import _lock_id, release_blobs
+
+
+class _StubConnection:
+    """Stands in for a psycopg2 connection inside a transaction, recording what the EXPLAIN cursor runs"""
+    
+    status = psycopg2.extensions.STATUS_IN_TRANSACTION
+    
+    def __init__(self, fail=None):
+        self.executed = []
+        self.fail = fail
+    
+    def cursor(self, cursor_factory=None):
+        return _StubCursor(self)
+
+
+class _StubCursor:
+    def __init__(self, conn):
+        self.conn = conn
+    
+    def execute(self, query, vars=None):
+        self.conn.executed.append(query)
+        if self.conn.fail and query.startswith('EXPLAIN'):
+            raise psycopg2.ProgrammingError(self.conn.fail)
+    
+    def fetchall(self):
+        return [('Seq Scan on notes',)]
+    
+    def close(self):
+        pass
+
+
+class _SampledCursor:
+    """TimedCursor's slow-query logging on a stub connection, so it runs without a database"""
+    
+    _record = TimedCursor._record
+    _explain = TimedCursor._explain
+    name = None
+    
+    def __init__(self, connection):
+        self.connection = connection
+
+
+@pytest.fixture
+def sample_every_slow_query(monkeypatch):
+    monkeypatch.setattr(Config, 'SLOW_QUERY_MS', 50)
+    monkeypatch.setattr(Config, 'SLOW_QUERY_EXPLAIN_SAMPLE', 1.0)
+
+
+def test_sampled_plan_uses_plain_explain_in_a_savepoint(sample_every_slow_query, caplog):
+    conn = _StubConnection()
+    _SampledCursor(conn)._record('SELECT pg_advisory_lock(%s)', (1,), 0.1)
+    assert conn.executed == [
+        'SAVEPOINT slow_query_explain',
+        'EXPLAIN SELECT pg_advisory_lock(%s)',
+        'RELEASE SAVEPOINT slow_query_explain',
+    ]
+    assert 'Seq Scan on notes' in caplog.text
+
+
+def test_failed_explain_rolls_back_to_the_savepoint(sample_every_slow_query, caplog):
+    conn = _StubConnection(fail='boom')
+    _SampledCursor(conn)._record('SELECT 1', None, 0.1)
+    assert conn.executed[-1] == 'ROLLBACK TO SAVEPOINT slow_query_explain'
+    assert '(EXPLAIN failed: boom)' in caplog.text
+
+
+@pytest.mark.parametrize('query, elapsed', [
+    ('UPDATE notes SET title = %s', 0.1),
+    ('SELECT 1', 0.01),
+])
+def test_only_slow_selects_are_explained(sample_every_slow_query, query, elapsed):
+    conn = _StubConnection()
+    _SampledCursor(conn)._record(query, None, elapsed)
+    assert conn.executed == []
+
+
+@pytest.fixture
+def connect():
+    conns = []
+    
+    def open_connection():
+        try:
+            conn = get_db_connection()
+        except psycopg2.OperationalError as e:
+            pytest.skip(f'database not available: {e}')
+        conns.append(conn)
+        return conn
+    yield open_connection
+    for conn in conns:
+        conn.close()
+
+
+def test_contended_release_blobs_leaves_no_advisory_lock(connect, monkeypatch, tmp_path):
+    """A slow, sampled pg_advisory_lock must not be executed a second time by the plan logging"""
+    monkeypatch.setattr(Config, 'SLOW_QUERY_MS', 50)
+    monkeypatch.setattr(Config, 'SLOW_QUERY_EXPLAIN_SAMPLE', 1.0)
+    filename = 'zz/zz/slow-query-explain-test'
+    lock_id = _lock_id(filename)
+    
+    holder = connect()
+    holder_cur = holder.cursor()
+    holder_cur.execute('SELECT pg_advisory_xact_lock(%s)', (lock_id,))
+    releaser = threading.Timer(0.3, holder.commit)
+    releaser.start()
+    
+    conn = connect()
+    started = time.monotonic()
+    release_blobs(conn, str(tmp_path), [filename])
+    releaser.join()
+    assert time.monotonic() - started >= 0.2
+    
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT COUNT(*) AS held FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid()"
+    )
+    assert cur.fetchone()['held'] == 0
+    cur.close()
+    
+    other = connect().cursor()
+    other.execute('SELECT pg_try_advisory_lock(%s) AS acquired', (lock_id,))
+    assert other.fetchone()['acquired']
+    other.execute('SELECT pg_advisory_unlock(%s)', (lock_id,))